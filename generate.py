@@ -8,36 +8,49 @@
 """Generate random images using the techniques described in the paper
 "Elucidating the Design Space of Diffusion-Based Generative Models"."""
 
-import os
 import re
 import click
 import tqdm
 import pickle
 import numpy as np
 import torch
-import PIL.Image
 import dnnlib
 from torch_utils import distributed as dist
+from torch_utils.rng import PhiloxRandomGenerator
+from posterior.precision import precision_names, precision_policy, precision_net
+from posterior.sampler import iddpm_sigmas
+from posterior.schedules import load_schedule
+from posterior.sink import OutputSink, network_samples
 
 #----------------------------------------------------------------------------
-# Proposed EDM sampler (Algorithm 2).
+# Proposed EDM sampler (Algorithm 2). sigma_steps optionally replaces the
+# time step discretization with precomputed noise levels. precision selects
+# the dtypes of the sampler state and the network (see
+# posterior/precision.py).
 
 def edm_sampler(
     net, latents, class_labels=None, randn_like=torch.randn_like,
     num_steps=18, sigma_min=0.002, sigma_max=80, rho=7,
-    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1,
+    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1, sigma_steps=None, precision='float64',
 ):
+    precision = precision_policy(precision)
+    net = precision_net(net, precision)
+
     # Adjust noise levels based on what's supported by the network.
     sigma_min = max(sigma_min, net.sigma_min)
     sigma_max = min(sigma_max, net.sigma_max)
 
     # Time step discretization.
-    step_indices = torch.arange(num_steps, dtype=torch.float64, device=latents.device)
-    t_steps = (sigma_max ** (1 / rho) + step_indices / (num_steps - 1) * (sigma_min ** (1 / rho) - sigma_max ** (1 / rho))) ** rho
+    if sigma_steps is not None:
+        t_steps = torch.as_tensor(sigma_steps, dtype=torch.float64, device=latents.device)
+        num_steps = len(t_steps)
+    else:
+        step_indices = torch.arange(num_steps, dtype=torch.float64, device=latents.device)
+        t_steps = (sigma_max ** (1 / rho) + step_indices / (num_steps - 1) * (sigma_min ** (1 / rho) - sigma_max ** (1 / rho))) ** rho
     t_steps = torch.cat([net.round_sigma(t_steps), torch.zeros_like(t_steps[:1])]) # t_N = 0
 
     # Main sampling loop.
-    x_next = latents.to(torch.float64) * t_steps[0]
+    x_next = latents.to(precision.state) * t_steps[0]
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])): # 0, ..., N-1
         x_cur = x_next
 
@@ -47,13 +60,13 @@ def edm_sampler(
         x_hat = x_cur + (t_hat ** 2 - t_cur ** 2).sqrt() * S_noise * randn_like(x_cur)
 
         # Euler step.
-        denoised = net(x_hat, t_hat, class_labels).to(torch.float64)
+        denoised = net(x_hat, t_hat, class_labels).to(precision.state)
         d_cur = (x_hat - denoised) / t_hat
         x_next = x_hat + (t_next - t_hat) * d_cur
 
         # Apply 2nd order correction.
         if i < num_steps - 1:
-            denoised = net(x_next, t_next, class_labels).to(torch.float64)
+            denoised = net(x_next, t_next, class_labels).to(precision.state)
             d_prime = (x_next - denoised) / t_next
             x_next = x_hat + (t_next - t_hat) * (0.5 * d_cur + 0.5 * d_prime)
 
@@ -61,19 +74,26 @@ def edm_sampler(
 
 #----------------------------------------------------------------------------
 # Generalized ablation sampler, representing the superset of all sampling
-# methods discussed in the paper.
+# methods discussed in the paper. sigma_steps optionally replaces the time
+# step discretization with precomputed noise levels. precision is as in
+# edm_sampler().
 
 def ablation_sampler(
     net, latents, class_labels=None, randn_like=torch.randn_like,
     num_steps=18, sigma_min=None, sigma_max=None, rho=7,
     solver='heun', discretization='edm', schedule='linear', scaling='none',
     epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000, alpha=1,
-    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1,
+    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1, sigma_steps=None, precision='float64',
 ):
     assert solver in ['euler', 'heun']
     assert discretization in ['vp', 've', 'iddpm', 'edm']
     assert schedule in ['vp', 've', 'linear']
     assert scaling in ['vp', 'none']
+    precision = precision_policy(precision)
+    net = precision_net(net, precision)
+    if sigma_steps is not None:
+        sigma_steps = torch.as_tensor(sigma_steps, dtype=torch.float64, device=latents.device)
+        num_steps, sigma_min, sigma_max = len(sigma_steps), float(sigma_steps[-1]), float(sigma_steps[0])
 
     # Helper functions for VP & VE noise level schedules.
     vp_sigma = lambda beta_d, beta_min: lambda t: (np.e ** (0.5 * beta_d * (t ** 2) + beta_min * t) - 1) ** 0.5
@@ -101,17 +121,16 @@ def ablation_sampler(
 
     # Define time steps in terms of noise level.
     step_indices = torch.arange(num_steps, dtype=torch.float64, device=latents.device)
-    if discretization == 'vp':
+    if sigma_steps is not None:
+        pass
+    elif discretization == 'vp':
         orig_t_steps = 1 + step_indices / (num_steps - 1) * (epsilon_s - 1)
         sigma_steps = vp_sigma(vp_beta_d, vp_beta_min)(orig_t_steps)
     elif discretization == 've':
         orig_t_steps = (sigma_max ** 2) * ((sigma_min ** 2 / sigma_max ** 2) ** (step_indices / (num_steps - 1)))
         sigma_steps = ve_sigma(orig_t_steps)
     elif discretization == 'iddpm':
-        u = torch.zeros(M + 1, dtype=torch.float64, device=latents.device)
-        alpha_bar = lambda j: (0.5 * np.pi * j / M / (C_2 + 1)).sin() ** 2
-        for j in torch.arange(M, 0, -1, device=latents.device): # M, ..., 1
-            u[j - 1] = ((u[j] ** 2 + 1) / (alpha_bar(j - 1) / alpha_bar(j)).clip(min=C_1) - 1).sqrt()
+        u = iddpm_sigmas(M, C_1, C_2).to(latents.device)
         u_filtered = u[torch.logical_and(u >= sigma_min, u <= sigma_max)]
         sigma_steps = u_filtered[((len(u_filtered) - 1) / (num_steps - 1) * step_indices).round().to(torch.int64)]
     else:
@@ -148,7 +167,7 @@ def ablation_sampler(
 
     # Main sampling loop.
     t_next = t_steps[0]
-    x_next = latents.to(torch.float64) * (sigma(t_next) * s(t_next))
+    x_next = latents.to(precision.state) * (sigma(t_next) * s(t_next))
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])): # 0, ..., N-1
         x_cur = x_next
 
@@ -159,7 +178,7 @@ def ablation_sampler(
 
         # Euler step.
         h = t_next - t_hat
-        denoised = net(x_hat / s(t_hat), sigma(t_hat), class_labels).to(torch.float64)
+        denoised = net(x_hat / s(t_hat), sigma(t_hat), class_labels).to(precision.state)
         d_cur = (sigma_deriv(t_hat) / sigma(t_hat) + s_deriv(t_hat) / s(t_hat)) * x_hat - sigma_deriv(t_hat) * s(t_hat) / sigma(t_hat) * denoised
         x_prime = x_hat + alpha * h * d_cur
         t_prime = t_hat + alpha * h
@@ -169,7 +188,7 @@ def ablation_sampler(
             x_next = x_hat + h * d_cur
         else:
             assert solver == 'heun'
-            denoised = net(x_prime / s(t_prime), sigma(t_prime), class_labels).to(torch.float64)
+            denoised = net(x_prime / s(t_prime), sigma(t_prime), class_labels).to(precision.state)
             d_prime = (sigma_deriv(t_prime) / sigma(t_prime) + s_deriv(t_prime) / s(t_prime)) * x_prime - sigma_deriv(t_prime) * s(t_prime) / sigma(t_prime) * denoised
             x_next = x_hat + h * ((1 - 1 / (2 * alpha)) * d_cur + 1 / (2 * alpha) * d_prime)
 
@@ -195,6 +214,17 @@ class StackedRandomGenerator:
         assert size[0] == len(self.generators)
         return torch.stack([torch.randint(*args, size=size[1:], generator=gen, **kwargs) for gen in self.generators])
 
+#----------------------------------------------------------------------------
+# Per-seed random generator of the samplers: one torch.Generator per seed
+# (stacked, the reference streams) or the vectorized counter-based generator
+# (philox, see torch_utils/rng.py).
+
+def construct_generator(device, seeds, rng='stacked', compile=False):
+    assert rng in ['stacked', 'philox']
+    if rng == 'philox':
+        return PhiloxRandomGenerator(device, seeds, compile=compile)
+    return StackedRandomGenerator(device, seeds)
+
 #----------------------------------------------------------------------------
 # Parse a comma separated list of numbers or ranges and return a list of ints.
 # Example: '1,2,5-10' returns [1, 2, 5, 6, 7, 8, 9, 10]
@@ -220,8 +250,13 @@ def parse_int_list(s):
 @click.option('--subdirs',                 help='Create subdirectory for every 1000 seeds',                         is_flag=True)
 @click.option('--class', 'class_idx',      help='Class label  [default: random]', metavar='INT',                    type=click.IntRange(min=0), default=None)
 @click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=64, show_default=True)
+@click.option('--rng',                     help='Per-seed random streams', metavar='stacked|philox',                type=click.Choice(['stacked', 'philox']), default='stacked', show_default=True)
+@click.option('--output',                  help='One file per sample, or a shard per rank', metavar='files|shards', type=click.Choice(['files', 'shards']), default='files', show_default=True)
+@click.option('--no_preview',              help='Skip the PNG previews',                                            is_flag=True)
+@click.option('--precision',               help='Sampler state and network precision', metavar='float64|float32|bf16|fp16', type=click.Choice(precision_names), default='float64', show_default=True)
 
 @click.option('--steps', 'num_steps',      help='Number of sampling steps', metavar='INT',                          type=click.IntRange(min=1), default=18, show_default=True)
+@click.option('--schedule_file',           help='Optimized noise levels (replaces --steps)', metavar='JSON',        type=str, default=None)
 @click.option('--sigma_min',               help='Lowest noise level  [default: varies]', metavar='FLOAT',           type=click.FloatRange(min=0, min_open=True))
 @click.option('--sigma_max',               help='Highest noise level  [default: varies]', metavar='FLOAT',          type=click.FloatRange(min=0, min_open=True))
 @click.option('--rho',                     help='Time step exponent', metavar='FLOAT',                              type=click.FloatRange(min=0, min_open=True), default=7, show_default=True)
@@ -235,7 +270,7 @@ def parse_int_list(s):
 @click.option('--schedule',                help='Ablate noise schedule sigma(t)', metavar='vp|ve|linear',           type=click.Choice(['vp', 've', 'linear']))
 @click.option('--scaling',                 help='Ablate signal scaling s(t)', metavar='vp|none',                    type=click.Choice(['vp', 'none']))
 
-def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=torch.device('cuda'), **sampler_kwargs):
+def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, rng, output, no_preview, schedule_file, device=torch.device('cuda'), **sampler_kwargs):
     """Generate random images using the techniques described in the paper
     "Elucidating the Design Space of Diffusion-Based Generative Models".
 
@@ -246,6 +281,17 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
     python generate.py --outdir=out --seeds=0-63 --batch=64 \\
         --network=https://nvlabs-fi-cdn.nvidia.com/edm/pretrained/edm-cifar10-32x32-cond-vp.pkl
 
+    \b
+    # Stochastic sampling with the vectorized per-seed random streams
+    python generate.py --outdir=out --seeds=0-1023 --batch=256 --rng=philox \\
+        --S_churn=40 --S_min=0.05 --S_max=50 --S_noise=1.003 \\
+        --network=https://nvlabs-fi-cdn.nvidia.com/edm/pretrained/edm-cifar10-32x32-cond-vp.pkl
+
+    \b
+    # 50k samples into one shard per GPU, without previews
+    torchrun --standalone --nproc_per_node=2 generate.py --outdir=out --seeds=0-49999 --batch=64 \\
+        --output=shards --no_preview --network=network-snapshot.pkl
+
     \b
     # Generate 1024 images using 2 GPUs
     torchrun --standalone --nproc_per_node=2 generate.py --outdir=out --seeds=0-999 --batch=64 \\
@@ -271,6 +317,7 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
 
     # Loop over batches.
     dist.print0(f'Generating {len(seeds)} images to "{outdir}"...')
+    sink = OutputSink(outdir, layout=output, rank=dist.get_rank(), preview=not no_preview)
     for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(dist.get_rank() != 0)):
         torch.distributed.barrier()
         batch_size = len(batch_seeds)
@@ -278,7 +325,7 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
             continue
 
         # Pick latents and labels.
-        rnd = StackedRandomGenerator(device, batch_seeds)
+        rnd = construct_generator(device, batch_seeds, rng=rng)
         latents = rnd.randn([batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
         class_labels = None
         if net.label_dim:
@@ -289,25 +336,17 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
 
         # Generate images.
         sampler_kwargs = {key: value for key, value in sampler_kwargs.items() if value is not None}
+        if schedule_file is not None:
+            sampler_kwargs['sigma_steps'] = load_schedule(schedule_file).sigma_steps
         have_ablation_kwargs = any(x in sampler_kwargs for x in ['solver', 'discretization', 'schedule', 'scaling'])
         sampler_fn = ablation_sampler if have_ablation_kwargs else edm_sampler
         images = sampler_fn(net, latents, class_labels, randn_like=rnd.randn_like, **sampler_kwargs)
 
         # Save images.
-        images_np = (images * 127.5 + 128).clip(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
-        # numpy images without the 255 noramlize that is used for the png files
-        images_np_without_normalize = images.permute(0, 2, 3, 1).cpu().numpy()
-        print('shape of generated images:-  ',images_np_without_normalize.shape)
-        for seed, image_np in zip(batch_seeds, images_np):
-            image_dir = os.path.join(outdir, f'{seed-seed%1000:06d}') if subdirs else outdir
-            os.makedirs(image_dir, exist_ok=True)
-            image_path = os.path.join(image_dir, f'{seed:06d}.png')
-            if image_np.shape[2] == 1:
-                PIL.Image.fromarray(image_np[:, :, 0], 'L').save(image_path)
-            else:
-                # PIL.Image.fromarray(image_np, 'RGB').save(image_path)# we dont have 3 channel input, so next line for saving 2 channel to complex from real and then absolute value
-                PIL.Image.fromarray(np.abs(image_np[:, :, 0] + 1j*image_np[:, :, 1]), 'L').save(image_path)
-        np.save(os.path.join(image_dir, 'generated_samples.npy'), images_np_without_normalize)
+        for seed, sample in zip(batch_seeds.tolist(), network_samples(images)):
+            sink.write(f'{seed-seed%1000:06d}/{seed:06d}' if subdirs else f'{seed:06d}', sample)
+    sink.close()
+
     # Done.
     torch.distributed.barrier()
     dist.print0('Done.')
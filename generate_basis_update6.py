@@ -15,9 +15,15 @@ import tqdm
 import pickle
 import numpy as np
 import torch
-import PIL.Image
 import dnnlib
 from torch_utils import distributed as dist
+from posterior.sink import OutputSink, network_samples
+from posterior.operators import construct_operator, fft2c, ifft2c
+from posterior.checkpointing import enable_checkpointing
+from posterior.coils import compress_coils
+from posterior.espirit import estimate_sens_maps
+from posterior.guidance import ConjugateGradientDC, channels_to_complex, complex_to_channels, likelihood_grad, pair_layout
+from posterior.solvers import construct_solver, solver_names
 
 # next 3 lines only if you want to debug with only 1 gpu
 import os 
@@ -47,7 +53,7 @@ def edm_sampler(
     kspace_undersampled= ksp_data['ksp'].cuda()
     mask = ksp_data['mask'].cuda()
     GT = ksp_data['GT'].cuda()
-    ##x_next = _ifft(kspace_undersampled)
+    ##x_next = ifft2c(kspace_undersampled)
     x_stack=[]
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])): # 0, ..., N-1
         x_cur = x_next
@@ -58,9 +64,9 @@ def edm_sampler(
         x_hat = x_cur + (t_hat ** 2 - t_cur ** 2).sqrt() * S_noise * randn_like(x_cur)
 
         # measure grad function
-        Ax_hat = mask[None,None,...]*_fft(x_cur)
+        Ax_hat = mask[None,None,...]*fft2c(x_cur)
         DC_term = kspace_undersampled[None,None,...] - Ax_hat # Data consistency term
-        meas_grad = _ifft(DC_term)
+        meas_grad = ifft2c(DC_term)
         meas_grad = torch.abs(meas_grad / torch.linalg.norm(meas_grad, dim=(-1, -2), keepdims=True))
         
 
@@ -102,56 +108,6 @@ def unnormalize(x, x_min, x_max):
     out = (x + 1) / 2
     return out * (x_max - x_min) + x_min
 
-#----------------------------------------------------------------------------
-# Centered, orthogonal ifft in torch >= 1.7
-import torch.fft as torch_fft
-def _ifft(x):
-    x = torch_fft.ifftshift(x, dim=(-2, -1))
-    x = torch_fft.ifft2(x, dim=(-2, -1), norm='ortho')
-    x = torch_fft.fftshift(x, dim=(-2, -1))
-    return x
-
-
-def adjoint(x, sens, mask, basis, K =1):
-    x = x*mask
-    x = torch_fft.ifftshift(x, dim=(-2, -1))
-    x = torch_fft.ifft2(x, dim=(-2, -1), norm='ortho')
-    x = torch_fft.fftshift(x, dim=(-2, -1))
-    x = torch.sum(x*torch.conj(sens), axis=1)[:,None,...]
-    x = torch.sum(x*basis[:,:K,:,:] ,dim=0)
-    return x
-
-def adjoint_coils(x, sens, mask):
-    x = torch.sum(x, dim=0)
-    mask = torch.sum(mask, dim=0)
-    x = x*mask
-    x = torch_fft.ifftshift(x, dim=(-2, -1))
-    x = torch_fft.ifft2(x, dim=(-2, -1), norm='ortho')
-    x = torch_fft.fftshift(x, dim=(-2, -1))
-    x = torch.sum(x*torch.conj(sens.squeeze()), axis=0)
-    return x
-
-def forward(x, sens, mask, basis, K = 1):
-    # x.shape = [1,K,256,256]
-    # sens.shape = [1,7,256,256]
-    # mask.shape = [80,1,256,256]
-    # basis.shape = [80,80,1,1]
-    x = torch.sum(x[None,:,:,:]*basis[:,:K,:,:] ,dim=1)[:,None,...]
-    x = x*sens
-    x = torch_fft.ifftshift(x, dim=(-2, -1))
-    x = torch_fft.fft2(x, dim=(-2, -1), norm='ortho')
-    x = torch_fft.fftshift(x, dim=(-2, -1))
-    return x*mask
-
-
-# Centered, orthogonal fft in torch >= 1.7
-def _fft(x):
-    x = torch_fft.ifftshift(x, dim=(-2, -1))
-    x = torch_fft.fft2(x, dim=(-2, -1), norm='ortho')
-    x = torch_fft.fftshift(x, dim=(-2, -1))
-    return x
-#----------------------------------------------------------------------------
-
 #----------------------------------------------------------------------------
 # Generalized ablation sampler, representing the superset of all sampling
 # methods discussed in the paper.
@@ -161,9 +117,9 @@ def ablation_sampler(
     num_steps=18, sigma_min=None, sigma_max=None, rho=7,
     solver='heun', discretization='edm', schedule='linear', scaling='none',
     epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000, alpha=1,
-    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1,
+    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1, num_coils=None, coil_energy=None, espirit=False, likelihood='dps', cg_lambda=1, cg_iters=5, cg_tol=1e-6,
 ):
-    assert solver in ['euler', 'heun']
+    assert solver in solver_names
     assert discretization in ['vp', 've', 'iddpm', 'edm']
     assert schedule in ['vp', 've', 'linear']
     assert scaling in ['vp', 'none']
@@ -247,51 +203,64 @@ def ablation_sampler(
 
     # Main sampling loop.
     t_next = t_steps[0]
-    x_next = latents.to(torch.float64) * (sigma(t_next) * s(t_next))
+    x_next = pair_layout(latents.to(torch.float64)) * (sigma(t_next) * s(t_next))
     K = 3# number of basis coefficients to be reconstructed
     ksp_data = torch.load('ksp_basis_data_basis.pt')
-    kspace_undersampled= torch.permute(ksp_data['ksp'].cuda(), (3,2,0,1))
-    mask = torch.permute(ksp_data['mask'].cuda() , (2,0,1))[:,None,...]
+    kspace_undersampled= torch.permute(ksp_data['ksp'].cuda(), (3,2,0,1))[None,...]
+    mask = torch.permute(ksp_data['mask'].cuda() , (2,0,1))[None,...]
     sens = torch.permute(ksp_data['sens'].cuda(), (2,0,1))[None,...]
-    basis = ksp_data['basis'].cuda()[:,:,None,None]
+    basis = ksp_data['basis'].cuda()
     alpha = torch.permute(ksp_data['alpha'].cuda() , (2,0,1))
+    if espirit: # re-estimate the maps from the ACS region (cached)
+        sens = estimate_sens_maps(kspace_undersampled)
+    if num_coils is not None or coil_energy is not None:
+        kspace_undersampled, sens, _ = compress_coils(kspace_undersampled, sens, num_coils=num_coils, energy=coil_energy, mask=mask, basis=basis[:,:K])
+    op = construct_operator(sens, mask, basis[:,:K])
+    kspace_undersampled = op.compress(kspace_undersampled)
     print(kspace_undersampled.shape, mask.shape, sens.shape, basis.shape)
-    ##x_next = _ifft(kspace_undersampled)
+    ##x_next = ifft2c(kspace_undersampled)
     # for now inverse crime and will look into this later
-    tt = adjoint(kspace_undersampled, sens, mask, basis, K=K)
     # inverse crime for now
-    x_undersampled = alpha[0]# adjoint(kspace_undersampled, sens, mask, basis, K=K)
+    x_undersampled = alpha[0]# op.adjoint(kspace_undersampled)[0]
     scaling = torch.quantile(torch.abs(x_undersampled), 0.99)
     kspace_undersampled = kspace_undersampled/scaling
 
     x_undersampled_2channel = torch.view_as_real(alpha).squeeze()
     x_undersampled_2channel = torch.permute(x_undersampled_2channel, (0,3,1,2))
 
+    to_image, to_net = channels_to_complex, complex_to_channels # network layout <=> operator images
+    dc_solver = ConjugateGradientDC(op, kspace_undersampled, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol) if likelihood == 'cg' else None
     x_stack=[]
     # norm_mins = torch.amin(x_undersampled, dim=(1,2,3), keepdim=True) #[N, 1, 1, 1]
     # norm_maxes = torch.amax(x_undersampled, dim=(1,2,3), keepdim=True) #[N, 1, 1, 1]
     # latents_new = torch.randn([K, net.img_channels, net.img_resolution, net.img_resolution], device=latents.device)
     # x_next = latents_new.to(torch.float64) * (sigma(t_next) * s(t_next))
+    ode_solver = construct_solver(solver, dnnlib.EasyDict(sigma=sigma, sigma_deriv=sigma_deriv, s=s, s_deriv=s_deriv))
+    solver_state = ode_solver.init_state(x_next)
+    def denoise(x, t): # further network evaluations of the solver (Heun), without gradient
+        with torch.no_grad():
+            denoised = net(x.detach() / s(t), sigma(t), class_labels).to(torch.float64)
+        return to_net(dc_solver(to_image(denoised))).to(torch.float64) if dc_solver is not None else denoised
     for i, (t_cur, t_next) in enumerate(zip(t_steps[:-1], t_steps[1:])): # 0, ..., N-1
         # without noise addition
         x_cur = x_next
-        x_hat = x_cur.requires_grad_() #starting grad tracking with the noised img
+        x_hat = x_cur.requires_grad_(likelihood == 'dps') #starting grad tracking with the noised img
         gamma = min(S_churn / num_steps, np.sqrt(2) - 1) if S_min <= sigma(t_cur) <= S_max else 0
         t_hat = sigma_inv(net.round_sigma(sigma(t_cur) + gamma * sigma(t_cur)))
-        denoised = net(x_hat / s(t_hat), sigma(t_hat), class_labels).to(torch.float64)
-        d_i = (sigma_deriv(t_cur)/sigma(t_cur) + s_deriv(t_cur)/s(t_cur))*x_cur - (sigma_deriv(t_cur)/sigma(t_cur)*s(t_cur))*denoised
-        x_next = x_cur + (t_next-t_cur)*d_i
+        with torch.set_grad_enabled(likelihood == 'dps'): # closed_form never backprops through the network
+            denoised = net(x_hat / s(t_hat), sigma(t_hat), class_labels).to(torch.float64)
+        if dc_solver is not None: # replace D by the CG data-consistent estimate
+            denoised = to_net(dc_solver(to_image(denoised))).to(torch.float64)
+        x_next, solver_state = ode_solver.step(x_cur, t_cur, t_next, denoised, solver_state, denoise=denoise)
 
         # measure grad function and likelihood step from DPS paper method
-        denoised_complex = torch.stack((torch.complex(denoised[:,0,...], denoised[:,1,...]), torch.complex(denoised[:,2,...], denoised[:,3,...]), torch.complex(denoised[:,4,...], denoised[:,5,...]))).squeeze()
-        Ax = forward(denoised_complex, sens, mask, basis, K=K)
+        denoised_complex = channels_to_complex(denoised)
+        Ax = op.forward(denoised_complex)
         if i==0:print(i, torch.linalg.norm(kspace_undersampled))
         if i%10==0:
             print(i, torch.linalg.norm(Ax))
         DC_term = kspace_undersampled - Ax
-        sse = torch.norm(DC_term)**2
-        meas_grad = torch.autograd.grad(outputs=sse, inputs=x_cur)[0]
-        meas_grad = meas_grad / torch.sqrt(sse)
+        meas_grad = likelihood_grad(DC_term, x_cur, op=op, to_net=to_net, likelihood=likelihood) if dc_solver is None else 0
         likelihood_step_size = 15 # weighting to the likelihood grad
         x_next = x_next - (likelihood_step_size) * meas_grad    
  
@@ -303,8 +272,8 @@ def ablation_sampler(
             plt.figure(figsize=(12,10)); plt.imshow(np.abs(to_plot_data[0,...] + 1j*to_plot_data[1,...]),cmap='gray'); plt.tight_layout(); plt.savefig('Debug.png',dpi=100); plt.close()
 
 
-    x_next_complex = torch.stack((torch.complex(x_next[:,0,...], x_next[:,1,...]), torch.complex(x_next[:,2,...], x_next[:,3,...]), torch.complex(x_next[:,4,...], x_next[:,5,...]))).squeeze()
-    x_next = adjoint(forward(x_next_complex, sens, torch.ones_like(mask), basis, K=K), sens, torch.ones_like(mask), basis, K=K)
+    x_next_complex = channels_to_complex(x_next).squeeze()
+    x_next = op.sens_projection(x_next_complex[None,...])[0]
     x_next = torch.permute(torch.view_as_real(x_next.squeeze()), (0,3,1,2))
     return x_next / torch.linalg.norm(x_next, dim=(-1, -2), keepdims=True) * torch.linalg.norm(x_undersampled_2channel, dim=(-1, -2), keepdims=True)
 
@@ -354,6 +323,8 @@ def parse_int_list(s):
 @click.option('--subdirs',                 help='Create subdirectory for every 1000 seeds',                         is_flag=True)
 @click.option('--class', 'class_idx',      help='Class label  [default: random]', metavar='INT',                    type=click.IntRange(min=0), default=None)
 @click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=3, show_default=True)
+@click.option('--checkpoint',              help='Checkpoint denoiser activations', metavar='none|block|level', type=click.Choice(['none', 'block', 'level']), default='none', show_default=True)
+@click.option('--checkpoint_res',          help='Resolutions to checkpoint  [default: all]', metavar='LIST',        type=parse_int_list, default=None)
 
 @click.option('--steps', 'num_steps',      help='Number of sampling steps', metavar='INT',                          type=click.IntRange(min=1), default=300, show_default=True)
 @click.option('--sigma_min',               help='Lowest noise level  [default: varies]', metavar='FLOAT',           type=click.FloatRange(min=0, min_open=True), default=0.002)
@@ -363,13 +334,20 @@ def parse_int_list(s):
 @click.option('--S_min', 'S_min',          help='Stoch. min noise level', metavar='FLOAT',                          type=click.FloatRange(min=0), default=0, show_default=True)
 @click.option('--S_max', 'S_max',          help='Stoch. max noise level', metavar='FLOAT',                          type=click.FloatRange(min=0), default='inf', show_default=True)
 @click.option('--S_noise', 'S_noise',      help='Stoch. noise inflation', metavar='FLOAT',                          type=float, default=1, show_default=True)
+@click.option('--espirit',                 help='Estimate the maps with ESPIRiT (cached)',                          is_flag=True)
+@click.option('--coils', 'num_coils',      help='Compress to this many virtual coils', metavar='INT',               type=click.IntRange(min=1), default=None)
+@click.option('--coil_energy',             help='Compress to the coils retaining this energy', metavar='FLOAT',     type=click.FloatRange(min=0, max=1, min_open=True), default=None)
 
-@click.option('--solver',                  help='Ablate ODE solver', metavar='euler|heun',                          type=click.Choice(['euler', 'heun']), default = 'euler')
+@click.option('--solver',                  help='Ablate ODE solver', metavar='euler|heun|ddim|dpmpp_2m|dpmpp_3m|unipc', type=click.Choice(solver_names), default = 'euler')
 @click.option('--disc', 'discretization',  help='Ablate time step discretization {t_i}', metavar='vp|ve|iddpm|edm', type=click.Choice(['vp', 've', 'iddpm', 'edm']), default = 'vp')
 @click.option('--schedule',                help='Ablate noise schedule sigma(t)', metavar='vp|ve|linear',           type=click.Choice(['vp', 've', 'linear']), default = 'vp')
 @click.option('--scaling',                 help='Ablate signal scaling s(t)', metavar='vp|none',                    type=click.Choice(['vp', 'none']), default = 'vp')
+@click.option('--likelihood',              help='Data-consistency mode', metavar='dps|closed_form|cg',              type=click.Choice(['dps', 'closed_form', 'cg']), default='dps', show_default=True)
+@click.option('--cg_lambda',               help='CG data-consistency weight of D', metavar='FLOAT',                 type=click.FloatRange(min=0, min_open=True), default=1, show_default=True)
+@click.option('--cg_iters',                help='CG iterations per step', metavar='INT',                            type=click.IntRange(min=1), default=5, show_default=True)
+@click.option('--cg_tol',                  help='CG relative residual tolerance', metavar='FLOAT',                  type=click.FloatRange(min=0), default=1e-6, show_default=True)
 
-def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=torch.device('cuda'), **sampler_kwargs):
+def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, checkpoint, checkpoint_res, device=torch.device('cuda'), **sampler_kwargs):
     """Generate random images using the techniques described in the paper
     "Elucidating the Design Space of Diffusion-Based Generative Models".
 
@@ -399,12 +377,18 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
     with dnnlib.util.open_url(network_pkl, verbose=(dist.get_rank() == 0)) as f:
         net = pickle.load(f)['ema'].to(device)
 
+    # Activation checkpointing for the backward pass through the denoiser.
+    if checkpoint != 'none':
+        example = torch.randn([max_batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
+        net = enable_checkpointing(net, checkpoint, checkpoint_res, x=example)
+
     # Other ranks follow.
     if dist.get_rank() == 0:
         torch.distributed.barrier()
 
     # Loop over batches.
     dist.print0(f'Generating {len(seeds)} images to "{outdir}"...')
+    sink = OutputSink(outdir, rank=dist.get_rank())
     for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(dist.get_rank() != 0)):
         torch.distributed.barrier()
         batch_size = len(batch_seeds)
@@ -428,20 +412,9 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
         images = sampler_fn(net, latents, class_labels, randn_like=rnd.randn_like, **sampler_kwargs)
 
         # Save images.
-        images_np = (images * 127.5 + 128).clip(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
-        # numpy images without the 255 noramlize that is used for the png files
-        images_np_without_normalize = images.permute(0, 2, 3, 1).cpu().numpy()
-        for seed, image_np in zip(batch_seeds, images_np):
-            image_dir = os.path.join(outdir, f'{seed-seed%1000:06d}') if subdirs else outdir
-            os.makedirs(image_dir, exist_ok=True)
-            image_path = os.path.join(image_dir, f'{seed:06d}.png')
-            np.save(os.path.join(image_dir, f'{seed:06d}.npy'), images_np_without_normalize)
-            if image_np.shape[2] == 1:
-                PIL.Image.fromarray(image_np[:, :, 0], 'L').save(image_path)
-            else:
-                # PIL.Image.fromarray(image_np, 'RGB').save(image_path) #dont have 3 RGB channels for the T2sh data
-                PIL.Image.fromarray(np.abs(image_np[:, :, 0] + 1j*image_np[:, :, 1]), 'L').save(image_path)
-        np.save(os.path.join(image_dir, 'generated_samples.npy'), images_np_without_normalize)
+        for seed, sample in zip(batch_seeds.tolist(), network_samples(images)):
+            sink.write(f'{seed-seed%1000:06d}/{seed:06d}' if subdirs else f'{seed:06d}', sample)
+    sink.close()
     # Done.
     torch.distributed.barrier()
     dist.print0('Done.')
@@ -15,9 +15,10 @@ import tqdm
 import pickle
 import numpy as np
 import torch
-import PIL.Image
 import dnnlib
 from torch_utils import distributed as dist
+from posterior.guidance import channels_to_complex, pair_layout
+from posterior.sink import OutputSink, network_samples
 
 # next 3 lines only if you want to debug with only 1 gpu
 import os 
@@ -212,7 +213,7 @@ def ablation_sampler(
 
     # Main sampling loop.
     t_next = t_steps[0]
-    x_next = latents.to(torch.float64) * (sigma(t_next) * s(t_next))
+    x_next = pair_layout(latents.to(torch.float64)) * (sigma(t_next) * s(t_next))
 
     ksp_data = torch.load('ksp_undersampled.pt')
     kspace_undersampled= ksp_data['ksp'].cuda()
@@ -254,7 +255,7 @@ def ablation_sampler(
         # denoised_unscaled = x_next # unnormalize(denoised, norm_mins, norm_maxes) #we need to undo the scaling to [-1,1] first
         # denoised_unscaled = denoised / torch.linalg.norm(denoised, dim=(-1, -2), keepdims=True)
         # denoised_unscaled = denoised_unscaled * torch.linalg.norm(x_undersampled_2channel, dim=(-1, -2), keepdims=True)
-        Ax = mask[None,None,...]*(_fft(torch.complex(denoised[0,0,...], denoised[0,1,...])) [None,None,...])
+        Ax = mask[None,None,...]*(_fft(channels_to_complex(denoised)[0, 0]) [None,None,...])
         if i>90:
             print(i, torch.linalg.norm(Ax, dim=(-1, -2), keepdims=True))
         DC_term = kspace_undersampled[None,None,...] - Ax
@@ -401,6 +402,7 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
 
     # Loop over batches.
     dist.print0(f'Generating {len(seeds)} images to "{outdir}"...')
+    sink = OutputSink(outdir, rank=dist.get_rank())
     for batch_seeds in tqdm.tqdm(rank_batches, unit='batch', disable=(dist.get_rank() != 0)):
         torch.distributed.barrier()
         batch_size = len(batch_seeds)
@@ -424,20 +426,9 @@ def main(network_pkl, outdir, subdirs, seeds, class_idx, max_batch_size, device=
         images = sampler_fn(net, latents, class_labels, randn_like=rnd.randn_like, **sampler_kwargs)
 
         # Save images.
-        images_np = (images * 127.5 + 128).clip(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
-        # numpy images without the 255 noramlize that is used for the png files
-        images_np_without_normalize = images.permute(0, 2, 3, 1).cpu().numpy()
-        for seed, image_np in zip(batch_seeds, images_np):
-            image_dir = os.path.join(outdir, f'{seed-seed%1000:06d}') if subdirs else outdir
-            os.makedirs(image_dir, exist_ok=True)
-            image_path = os.path.join(image_dir, f'{seed:06d}.png')
-            np.save(os.path.join(image_dir, f'{seed:06d}.npy'), images_np_without_normalize)
-            if image_np.shape[2] == 1:
-                PIL.Image.fromarray(image_np[:, :, 0], 'L').save(image_path)
-            else:
-                # PIL.Image.fromarray(image_np, 'RGB').save(image_path) #dont have 3 RGB channels for the T2sh data
-                PIL.Image.fromarray(np.abs(image_np[:, :, 0] + 1j*image_np[:, :, 1]), 'L').save(image_path)
-        np.save(os.path.join(image_dir, 'generated_samples.npy'), images_np_without_normalize)
+        for seed, sample in zip(batch_seeds.tolist(), network_samples(images)):
+            sink.write(f'{seed-seed%1000:06d}/{seed:06d}' if subdirs else f'{seed:06d}', sample)
+    sink.close()
     # Done.
     torch.distributed.barrier()
     dist.print0('Done.')
@@ -0,0 +1,39 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Tool for converting k-space .pt bundles to a memory-mapped k-space
+store."""
+
+import click
+from posterior.data import list_kspace_files
+from posterior.store import write_store
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--source', help='Directory of k-space files, or manifest', metavar='DIR|TXT|JSON', type=str, required=True)
+@click.option('--dest',   help='Output store directory', metavar='DIR',                        type=str, required=True)
+
+def main(source, dest):
+    """Convert k-space .pt bundles (ksp, mask, sens, basis) to a store of
+    per-subject, slice-chunked .npy arrays in the operator layout with a
+    JSON index, for use with reconstruct.py --data.
+
+    Examples:
+
+    \b
+    python kspace_tool.py --source=data --dest=data-store
+    python kspace_tool.py --source=manifest.json --dest=data-store
+    """
+    write_store(list_kspace_files(source), dest)
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
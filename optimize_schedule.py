@@ -0,0 +1,129 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Offline optimization of the sampler noise levels for a network, a
+calibration set of k-space slices and a budget of network evaluations."""
+
+import os
+import click
+import pickle
+import numpy as np
+import torch
+import dnnlib
+from generate import StackedRandomGenerator, parse_int_list
+from posterior.checkpointing import enable_checkpointing
+from posterior.data import group_slices, stack_slices
+from posterior.store import open_slices
+from posterior.schedules import optimize_schedule, save_schedule
+from posterior.solvers import construct_solver, solver_names
+from reconstruct import prepare_batch
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--network', 'network_pkl',  help='Network pickle filename', metavar='PATH|URL',                      type=str, required=True)
+@click.option('--data', 'data_path',       help='k-space store, directory of k-space files, or manifest', metavar='DIR|TXT|JSON', type=str, required=True)
+@click.option('--dest',                    help='Output schedule file', metavar='JSON',                             type=str, required=True)
+@click.option('--nfe',                     help='Network evaluations per sample', metavar='INT',                    type=click.IntRange(min=2), default=30, show_default=True)
+@click.option('--objective',               help='Error to minimize', metavar='reference|nmse|truncation',           type=click.Choice(['reference', 'nmse', 'truncation']), default='reference', show_default=True)
+@click.option('--ref_steps',               help='Steps of the reference reconstructions', metavar='INT',            type=click.IntRange(min=2), default=300, show_default=True)
+@click.option('--slices', 'max_slices',    help='Calibration slices', metavar='INT',                                type=click.IntRange(min=1), default=8, show_default=True)
+@click.option('--knots', 'num_knots',      help='Knots of the schedule warp', metavar='INT',                        type=click.IntRange(min=1), default=8, show_default=True)
+@click.option('--delta',                   help='Initial knot move', metavar='FLOAT',                               type=click.FloatRange(min=0, min_open=True), default=0.05, show_default=True)
+@click.option('--rounds', 'max_rounds',    help='Maximum search rounds', metavar='INT',                             type=click.IntRange(min=0), default=50, show_default=True)
+@click.option('--seed',                    help='Random seed of the first latent', metavar='INT',                   type=int, default=0, show_default=True)
+@click.option('--class', 'class_idx',      help='Class label  [default: random]', metavar='INT',                    type=click.IntRange(min=0), default=None)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=8, show_default=True)
+@click.option('--checkpoint',              help='Checkpoint denoiser activations', metavar='none|block|level', type=click.Choice(['none', 'block', 'level']), default='none', show_default=True)
+@click.option('--checkpoint_res',          help='Resolutions to checkpoint  [default: all]', metavar='LIST',        type=parse_int_list, default=None)
+@click.option('--espirit',                 help='Estimate the maps with ESPIRiT (cached)',                          is_flag=True)
+@click.option('--coils', 'num_coils',      help='Compress to this many virtual coils', metavar='INT',               type=click.IntRange(min=1), default=None)
+@click.option('--coil_energy',             help='Compress to the coils retaining this energy', metavar='FLOAT',     type=click.FloatRange(min=0, max=1, min_open=True), default=None)
+
+@click.option('--sigma_min',               help='Lowest noise level  [default: varies]', metavar='FLOAT',           type=click.FloatRange(min=0, min_open=True), default=0.002)
+@click.option('--sigma_max',               help='Highest noise level  [default: varies]', metavar='FLOAT',          type=click.FloatRange(min=0, min_open=True), default=5)
+@click.option('--rho',                     help='Time step exponent', metavar='FLOAT',                              type=click.FloatRange(min=0, min_open=True), default=7, show_default=True)
+@click.option('--disc', 'discretization',  help='Initial time step discretization {t_i}', metavar='vp|ve|iddpm|edm', type=click.Choice(['vp', 've', 'iddpm', 'edm']), default='vp', show_default=True)
+@click.option('--schedule',                help='Ablate noise schedule sigma(t)', metavar='vp|ve|linear',           type=click.Choice(['vp', 've', 'linear']), default='vp', show_default=True)
+@click.option('--scaling',                 help='Ablate signal scaling s(t)', metavar='vp|none',                    type=click.Choice(['vp', 'none']), default='vp', show_default=True)
+@click.option('--solver',                  help='ODE solver', metavar='euler|heun|ddim|dpmpp_2m|dpmpp_3m|unipc', type=click.Choice(solver_names), default='euler', show_default=True)
+@click.option('--likelihood',              help='Data-consistency mode', metavar='dps|closed_form|cg',              type=click.Choice(['dps', 'closed_form', 'cg']), default='dps', show_default=True)
+@click.option('--likelihood_step_size',    help='Likelihood step size of the optimized schedule', metavar='FLOAT', type=float, default=1, show_default=True)
+@click.option('--cg_lambda',               help='CG data-consistency weight of D', metavar='FLOAT',                 type=click.FloatRange(min=0, min_open=True), default=1, show_default=True)
+@click.option('--cg_iters',                help='CG iterations per step', metavar='INT',                            type=click.IntRange(min=1), default=5, show_default=True)
+@click.option('--cg_tol',                  help='CG relative residual tolerance', metavar='FLOAT',                  type=click.FloatRange(min=0), default=1e-6, show_default=True)
+
+def main(network_pkl, data_path, dest, nfe, objective, max_slices, seed, class_idx, max_batch_size, checkpoint, checkpoint_res, espirit, num_coils, coil_energy, device=torch.device('cuda'), **opt_kwargs):
+    """Optimize the noise levels of the sampler steps for a budget of network
+    evaluations per sample, on a calibration set of k-space slices.
+
+    The schedule is searched among monotone warps of the --disc
+    discretization, minimizing the NMSE against reconstructions with
+    --ref_steps steps (reference), against the GT/alpha of the files (nmse),
+    or the local truncation error of the solver steps (truncation). The
+    result is a small JSON file that reconstruct.py, tune.py and generate.py
+    load with --schedule_file. --likelihood_step_size is the step size to
+    use with the optimized schedule; the reference runs scale it by
+    nfe / ref_steps.
+
+    Examples:
+
+    \b
+    # 30-step schedule to replace the 300-step default
+    python optimize_schedule.py --data=calib --dest=schedule-30.json \\
+        --nfe=30 --likelihood_step_size=150 --network=network-snapshot.pkl
+    python reconstruct.py --data=data --outdir=out --likelihood_step_size=150 \\
+        --schedule_file=schedule-30.json --network=network-snapshot.pkl
+    """
+    # Load network.
+    print(f'Loading network from "{network_pkl}"...')
+    with dnnlib.util.open_url(network_pkl) as f:
+        net = pickle.load(f)['ema'].to(device)
+    if checkpoint != 'none':
+        example = torch.randn([max_batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
+        net = enable_checkpointing(net, checkpoint, checkpoint_res, x=example)
+
+    # Calibration slices, evenly spread over the data, that share an operator.
+    slices, num_files = open_slices(data_path, num_coeffs=net.img_channels // 2)
+    groups = group_slices(slices, len(slices))
+    calib = max(groups, key=len)
+    if len(calib) < len(slices):
+        print(f'Skipping {len(slices) - len(calib)} slices with a different image size or basis')
+    calib = [calib[i] for i in np.unique(np.linspace(0, len(calib) - 1, min(max_slices, len(calib))).round().astype(int))]
+    if objective == 'nmse':
+        assert all(s.gt is not None for s in calib), 'No reference images for --objective=nmse'
+    op, y, scale = prepare_batch(stack_slices(calib, device=device), espirit=espirit, num_coils=num_coils, coil_energy=coil_energy, verbose=True)
+    gt = torch.stack([s.gt for s in calib]).to(device) / scale.reshape(-1, *[1] * (calib[0].gt.ndim)) if objective == 'nmse' else None
+
+    # Pick latents and labels.
+    rnd = StackedRandomGenerator(device, [seed + i for i in range(len(calib))])
+    latents = rnd.randn([len(calib), net.img_channels, *op.img_shape], device=device)
+    class_labels = None
+    if net.label_dim:
+        class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[len(calib)], device=device)]
+    if class_idx is not None:
+        class_labels[:, :] = 0
+        class_labels[:, class_idx] = 1
+
+    # Optimize and save.
+    num_steps = nfe // construct_solver(opt_kwargs['solver'], None).evals_per_step
+    print(f'Optimizing a {num_steps}-step schedule on {len(calib)} slices from {num_files} files...')
+    r = optimize_schedule(net, latents, op, y, gt=gt, class_labels=class_labels, objective=objective, num_steps=num_steps,
+        max_batch_size=max_batch_size, **opt_kwargs)
+    if os.path.dirname(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    save_schedule(dest, r.sigma_steps, network=network_pkl, nfe=nfe, objective=objective, score=r.score, base_score=r.base_score,
+        num_evals=r.num_evals, knots=r.knots, calibration=[s.name for s in calib], **opt_kwargs)
+    print(f'{objective}: {r.base_score:g} (--disc={opt_kwargs["discretization"]}) -> {r.score:g}')
+    print(f'Saved {num_steps} noise levels to "{dest}".')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,67 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Activation checkpointing of the denoiser for the DPS backward pass."""
+
+import time
+import torch
+import training.networks
+from torch_utils import misc
+
+#----------------------------------------------------------------------------
+# Pickled networks carry the source code they were trained with. Rebuild the
+# network from the current training.networks so that newer features (such
+# as set_checkpointing) are available, keeping all parameters and buffers.
+
+def rebuild_network(net):
+    device = next(iter(net.parameters())).device
+    new_net = getattr(training.networks, type(net).__name__)(*net.init_args, **net.init_kwargs)
+    misc.copy_params_and_buffers(src_module=net, dst_module=new_net, require_all=True)
+    for new_param, param in zip(new_net.parameters(), net.parameters()):
+        new_param.requires_grad_(param.requires_grad)
+    return new_net.train(net.training).to(device)
+
+#----------------------------------------------------------------------------
+# Peak memory (bytes, CUDA only) and time (seconds) of one denoiser
+# evaluation plus its backward pass w.r.t. the input, as in a DPS step.
+
+def profile_backward(net, x, sigma, class_labels=None):
+    x = x.detach().requires_grad_()
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+        torch.cuda.reset_peak_memory_stats(x.device)
+    start = time.perf_counter()
+    torch.autograd.grad(net(x, sigma, class_labels).square().sum(), x)
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    elapsed = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated(x.device) if x.is_cuda else None
+    return peak, elapsed
+
+#----------------------------------------------------------------------------
+# Enable checkpointing on a (preconditioned) network, rebuilding it from the
+# current source if needed. Given an example input, also print the
+# memory/time trade-off relative to no checkpointing.
+
+def enable_checkpointing(net, granularity='block', resolutions=None, x=None, sigma=1.0, class_labels=None):
+    assert granularity in training.networks.checkpoint_granularities
+    if not hasattr(net.model, 'set_checkpointing'):
+        net = rebuild_network(net)
+    if x is not None and granularity != 'none':
+        sigma = torch.as_tensor(sigma, dtype=torch.float64, device=x.device).expand(x.shape[0])
+        net.model.set_checkpointing('none')
+        profile_backward(net, x, sigma, class_labels) # warm up
+        base_mem, base_time = profile_backward(net, x, sigma, class_labels)
+        net.model.set_checkpointing(granularity, resolutions)
+        mem, elapsed = profile_backward(net, x, sigma, class_labels)
+        mem_str = f'{base_mem / 2**20:.0f} MiB -> {mem / 2**20:.0f} MiB' if mem is not None else 'n/a'
+        print(f'Checkpointing ({granularity}): peak memory {mem_str}, '
+            f'denoiser fwd+bwd {base_time * 1e3:.1f} ms -> {elapsed * 1e3:.1f} ms')
+    net.model.set_checkpointing(granularity, resolutions)
+    return net
+
+#----------------------------------------------------------------------------
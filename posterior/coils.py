@@ -0,0 +1,94 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""SVD-based coil compression of measured k-space and sensitivity maps."""
+
+import time
+import torch
+import dnnlib
+from posterior.operators import construct_operator
+
+#----------------------------------------------------------------------------
+# Per-slice PCA coil compression matrix from the measured k-space samples.
+# ksp has the coil axis at -3 and a leading batch dimension N, e.g.
+# [N, C, H, W] or [N, T, C, H, W]. Returns the compression matrix [N, C, V]
+# (orthonormal columns) and the retained energy fraction per slice [N].
+#
+# Either num_coils (V) or energy (fraction in (0, 1]) must be given; with an
+# energy threshold, V is the smallest coil count that reaches it on every
+# slice of the batch.
+
+def coil_compression_matrix(ksp, num_coils=None, energy=None):
+    assert (num_coils is None) != (energy is None)
+    data = ksp.movedim(-3, -1).reshape(ksp.shape[0], -1, ksp.shape[-3]) # [N, M, C]
+    data = data.to(torch.complex128)
+    cov = data.transpose(-1, -2) @ data.conj() # [N, C, C]
+    eigval, eigvec = torch.linalg.eigh(cov)
+    eigval = eigval.flip(-1).clamp(min=0)
+    eigvec = eigvec.flip(-1)
+    cum = eigval.cumsum(dim=-1) / eigval.sum(dim=-1, keepdim=True).clamp(min=1e-30)
+    if num_coils is None:
+        assert 0 < energy <= 1
+        num_coils = int((cum < energy - 1e-12).sum(dim=-1).max()) + 1
+    num_coils = min(int(num_coils), ksp.shape[-3])
+    assert num_coils >= 1
+    return eigvec[..., :num_coils], cum[:, num_coils - 1]
+
+#----------------------------------------------------------------------------
+# Apply a compression matrix [N, C, V] along the coil axis (-3) of x.
+# Virtual coil v is sum_c conj(U[c, v]) * x_c, so the SENSE model
+# y_c = M F S_c x carries over exactly to the virtual coils.
+
+def apply_coil_compression(x, matrix):
+    mat = matrix.conj().to(x.dtype if x.is_complex() else torch.complex64)
+    mat = mat.reshape(mat.shape[0], *([1] * (x.ndim - 4)), 1, 1, *mat.shape[-2:])
+    x = (x.movedim(-3, -1).unsqueeze(-2) @ mat).squeeze(-2)
+    return x.movedim(-1, -3)
+
+#----------------------------------------------------------------------------
+# Measured wall-clock speedup of the normal operator A^H A between the full
+# and the compressed maps.
+
+def measure_speedup(sens, sens_compressed, mask, basis=None, num_reps=5):
+    def run(maps):
+        op = construct_operator(maps, mask, basis)
+        shape = [max(maps.shape[0], mask.shape[0]), *([basis.shape[1]] if basis is not None else []), *maps.shape[-2:]]
+        x = torch.randn(shape, dtype=op.dtype, device=maps.device)
+        with torch.no_grad():
+            op.normal(x)
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            start = time.perf_counter()
+            for _ in range(num_reps):
+                op.normal(x)
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            return time.perf_counter() - start
+    return run(sens) / max(run(sens_compressed), 1e-12)
+
+#----------------------------------------------------------------------------
+# Compress measured k-space and sensitivity maps to virtual coils. Returns
+# the compressed k-space, the compressed maps and an EasyDict with the coil
+# counts, the retained energy and the operator speedup. The speedup is the
+# coil count ratio (the operator cost is linear in it), or the measured one
+# when the sampling mask is given.
+
+def compress_coils(ksp, sens, num_coils=None, energy=None, mask=None, basis=None, verbose=True):
+    matrix, retained = coil_compression_matrix(ksp, num_coils=num_coils, energy=energy)
+    ksp_cc = apply_coil_compression(ksp, matrix)
+    sens_cc = apply_coil_compression(sens.expand(matrix.shape[0], *sens.shape[1:]), matrix)
+    stats = dnnlib.EasyDict(num_coils=matrix.shape[-2], num_virtual_coils=matrix.shape[-1])
+    stats.energy = float(retained.min())
+    stats.speedup = stats.num_coils / stats.num_virtual_coils
+    if mask is not None:
+        stats.speedup = measure_speedup(sens, sens_cc, mask, basis)
+    if verbose:
+        print(f'Coil compression: {stats.num_coils} -> {stats.num_virtual_coils} virtual coils, '
+            f'{stats.energy * 100:.2f}% energy retained, {stats.speedup:.2f}x operator speedup')
+    return ksp_cc, sens_cc, stats
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,144 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Loading and batching of measured k-space slices for posterior
+sampling."""
+
+import os
+import json
+import torch
+import dnnlib
+
+#----------------------------------------------------------------------------
+# List the k-space files of a run. path is either a directory, searched
+# recursively for *.pt files, or a manifest:
+#
+#   *.pt:    a single k-space file.
+#   *.txt:   one file path per line.
+#   *.json:  a list of file paths, or of dicts {"path": ..., ...} whose
+#            remaining keys (e.g. "likelihood_step_size") override the
+#            sampler settings of that file.
+#
+# Relative paths in a manifest are relative to the manifest, and the files
+# of a directory are listed relative to the directory. Returns a list of
+# EasyDicts with the file path, a name (relative to the directory or
+# manifest, without extension) and the per-file overrides.
+
+def list_kspace_files(path):
+    root = path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path))
+    if os.path.isdir(path):
+        entries = sorted(os.path.relpath(os.path.join(dirpath, fname), root) for dirpath, _dirnames, fnames in os.walk(path) for fname in fnames if fname.endswith('.pt'))
+    elif path.endswith('.pt'):
+        entries = [os.path.basename(path)]
+    elif path.endswith('.json'):
+        with open(path, 'rt') as f:
+            entries = json.load(f)
+    else:
+        with open(path, 'rt') as f:
+            entries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    files = []
+    for entry in entries:
+        entry = dict(path=entry) if isinstance(entry, str) else dict(entry)
+        fname = entry.pop('path')
+        fname = fname if os.path.isabs(fname) else os.path.join(root, fname)
+        name = os.path.splitext(os.path.relpath(fname, root))[0].replace(os.sep, '_')
+        files.append(dnnlib.EasyDict(path=fname, name=name, overrides=entry))
+    return files
+
+#----------------------------------------------------------------------------
+# Split a k-space file into per-slice tensors in the operator layout. The
+# files use the layout of the posterior scripts, optionally with a leading
+# slice dimension S:
+#
+#   ksp:    [(S,) H, W, C]     or [(S,) H, W, C, T] with a basis.
+#   mask:   [(S,) H, W]        or [(S,) H, W, T] with a basis.
+#   sens:   [(S,) H, W, C]     optional, single-coil data if missing.
+#   basis:  [T, K']            optional, truncated to num_coeffs columns.
+#   GT:     [(S,) H, W]        optional reference image without a basis.
+#   alpha:  [(S,) H, W, K']    optional reference coefficients with a basis.
+#
+# Every slice is an EasyDict with dense k-space [C, H, W] (or [T, C, H, W]),
+# mask [H, W] (or [T, H, W]), sens [C, H, W], basis [T, K] or None, the
+# reference image gt [(K,) H, W] or None, its name, source path and the
+# per-file overrides.
+
+def load_slices(file, num_coeffs=None, device=torch.device('cpu')):
+    data = torch.load(file.path, map_location=device)
+    basis = data.get('basis', None)
+    ksp = data['ksp']
+    mask = data['mask']
+    sens = data.get('sens', None)
+    if sens is None:
+        sens = torch.ones_like(ksp if basis is None else ksp[..., 0]).unsqueeze(-1)
+        ksp = ksp.unsqueeze(-2 if basis is not None else -1)
+    gt = data.get('GT' if basis is None else 'alpha', None)
+    if basis is not None:
+        basis = basis[:, :num_coeffs] if num_coeffs is not None else basis
+        ksp = ksp.movedim(-1, -4) # [(S,) T, H, W, C]
+        mask = mask.movedim(-1, -3) # [(S,) T, H, W]
+        gt = gt[..., :basis.shape[1]].movedim(-1, -3) if gt is not None else None # [(S,) K, H, W]
+    ksp = ksp.movedim(-1, -3).to(torch.complex64) # [(S,) (T,) C, H, W]
+    sens = sens.movedim(-1, -3).to(torch.complex64) # [(S,) C, H, W]
+
+    # Leading slice dimension.
+    img_ndim = 4 if basis is not None else 3
+    assert ksp.ndim in [img_ndim, img_ndim + 1]
+    ksp = ksp[None] if ksp.ndim == img_ndim else ksp
+    num_slices = ksp.shape[0]
+    mask = mask.expand(num_slices, *mask.shape[-(img_ndim - 1):]) # mask and maps may be shared by all slices
+    sens = sens.expand(num_slices, *sens.shape[-3:])
+    gt = gt.to(torch.complex64).expand(num_slices, *gt.shape[-(img_ndim - 1):]) if gt is not None else None
+
+    slices = []
+    for idx in range(num_slices):
+        name = file.name if num_slices == 1 else f'{file.name}_slice{idx:03d}'
+        slices.append(dnnlib.EasyDict(name=name, ksp=ksp[idx], mask=mask[idx], sens=sens[idx], basis=basis,
+            gt=(gt[idx] if gt is not None else None), path=file.path, overrides=file.overrides))
+    return slices
+
+#----------------------------------------------------------------------------
+# Group slices into batches that can share one operator: same image size
+# and the same basis. Masks, maps and coil counts may differ per slice.
+
+def _compatible(a, b):
+    if a.ksp.shape[-2:] != b.ksp.shape[-2:] or (a.basis is None) != (b.basis is None):
+        return False
+    return a.basis is None or (a.basis.shape == b.basis.shape and bool(torch.equal(a.basis, b.basis.to(a.basis.device))))
+
+def group_slices(slices, max_batch_size):
+    groups = []
+    for s in slices:
+        group = next((g for g in groups if _compatible(g[0], s)), None)
+        if group is None:
+            groups.append([s])
+        else:
+            group.append(s)
+    return [g[i : i + max_batch_size] for g in groups for i in range(0, len(g), max_batch_size)]
+
+#----------------------------------------------------------------------------
+# Stack a batch of compatible slices. Slices with fewer coils are padded
+# with zero maps and zero k-space, which leaves their operators unchanged.
+# Returns dense k-space [N, (T,) C, H, W], mask [N, (T,) H, W], sens
+# [N, C, H, W] and the shared basis. With pin_memory, the batch is assembled
+# in pinned host memory and copied asynchronously to the device.
+
+def stack_slices(slices, device=torch.device('cpu'), pin_memory=False):
+    num_coils = max(s.sens.shape[0] for s in slices)
+    def pad(x):
+        pad_shape = [*x.shape[:-3], num_coils - x.shape[-3], *x.shape[-2:]]
+        return torch.cat([x, x.new_zeros(pad_shape)], dim=-3)
+    def to_device(x):
+        x = x.pin_memory() if pin_memory else x
+        return x.to(device, non_blocking=pin_memory)
+    ksp = to_device(torch.stack([pad(s.ksp) for s in slices]))
+    sens = to_device(torch.stack([pad(s.sens) for s in slices]))
+    mask = to_device(torch.stack([s.mask for s in slices]))
+    basis = to_device(slices[0].basis) if slices[0].basis is not None else None
+    return ksp, mask, sens, basis
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,105 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Streaming statistics of posterior ensembles: per-pixel mean, variance
+and percentiles of the samples of a slice, accumulated batch by batch
+without keeping the samples."""
+
+import numpy as np
+import torch
+import dnnlib
+
+#----------------------------------------------------------------------------
+# Per-pixel statistics of a stream of samples of one slice, on the device of
+# the samples. update() folds a batch of samples [B, ...] into the running
+# count, mean and sum of squared deviations M2 with the parallel form of
+# Welford's algorithm (Chan et al. 1979), so that the state stays the size
+# of one sample whatever the ensemble size. Complex samples have a complex
+# mean and the variance E|x - mean|^2.
+#
+# With num_sketch > 0, the magnitudes of up to num_sketch whole samples are
+# kept as a percentile sketch (reservoir sampling, Vitter's algorithm R):
+# the percentiles are exact up to num_sketch samples, and those of a uniform
+# random subset beyond. merge() combines the statistics of disjoint sets of
+# samples, e.g. from several ranks; the sketch of other must be at least as
+# large, and is subsampled to num_sketch.
+
+class EnsembleStats:
+    def __init__(self, num_sketch=0, seed=0):
+        self.num_sketch = num_sketch
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.sketch = None
+        self.rng = np.random.default_rng(seed)
+
+    def _combine(self, count, mean, m2):
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta.abs().square() * (self.count * count / total)
+        self.count = total
+
+    def update(self, samples):
+        samples = samples.detach()
+        if samples.shape[0] == 0:
+            return
+        seen = self.count
+        mean = samples.mean(dim=0)
+        self._combine(samples.shape[0], mean, (samples - mean).abs().square().sum(dim=0))
+        if self.num_sketch == 0:
+            return
+
+        # Reservoir: sample i replaces a random slot with probability num_sketch / (i + 1).
+        magnitude = samples.abs()
+        if self.sketch is None:
+            self.sketch = magnitude.new_zeros([self.num_sketch, *magnitude.shape[1:]])
+        for j in range(magnitude.shape[0]):
+            i = seen + j
+            slot = i if i < self.num_sketch else int(self.rng.integers(0, i + 1))
+            if slot < self.num_sketch:
+                self.sketch[slot] = magnitude[j]
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        assert other.num_sketch >= self.num_sketch, 'Cannot merge into a larger sketch'
+        count, seen = self.count, min(self.count, self.num_sketch)
+        self._combine(other.count, other.mean, other.m2)
+        if self.num_sketch == 0:
+            return
+        if self.sketch is None:
+            self.sketch = other.sketch.new_zeros([self.num_sketch, *other.sketch.shape[1:]])
+
+        # Subsample the union: the number of entries from self is hypergeometric.
+        size = min(self.count, self.num_sketch)
+        num_self = int(self.rng.hypergeometric(count, other.count, size)) if count > 0 else 0
+        mine = torch.as_tensor(self.rng.permutation(seen)[:num_self], device=self.sketch.device)
+        theirs = torch.as_tensor(self.rng.permutation(min(other.count, other.num_sketch))[:size - num_self], device=self.sketch.device)
+        self.sketch[:size] = torch.cat([self.sketch[mine], other.sketch[theirs].to(self.sketch.device)])
+
+    # Summary maps: mean, unbiased variance var, and the magnitude
+    # percentiles (0-100) from the sketch as a dict, interpolated linearly
+    # between the sorted entries as in torch.quantile().
+    def summary(self, percentiles=()):
+        assert self.count > 0
+        var = self.m2 / max(self.count - 1, 1)
+        result = dnnlib.EasyDict(count=self.count, mean=self.mean, var=var, percentiles=dict())
+        if len(percentiles) > 0:
+            assert self.num_sketch > 0, 'Percentiles require a sketch'
+            size = min(self.count, self.num_sketch)
+            sketch = self.sketch[:size].sort(dim=0).values
+            for p in percentiles:
+                pos = p / 100 * (size - 1)
+                lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+                result.percentiles[p] = torch.lerp(sketch[lo], sketch[hi], pos - lo)
+        return result
+
+#----------------------------------------------------------------------------
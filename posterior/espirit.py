@@ -0,0 +1,119 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""ESPIRiT coil sensitivity calibration, batched over slices and cached on
+disk under a hash of the ACS region and the calibration parameters."""
+
+import os
+import json
+import hashlib
+import uuid
+import numpy as np
+import torch
+import dnnlib
+from posterior.operators import ifft2c
+
+#----------------------------------------------------------------------------
+# Centered calibration (ACS) region [N, C, c, c] of dense k-space [N, C, H, W].
+# Multi-echo k-space [N, T, C, H, W] is first averaged over the echoes that
+# sampled each location, so that echoes with interleaved masks fill the
+# center jointly.
+
+def _center(size, width):
+    start = max(size // 2 - width // 2, 0)
+    return slice(start, start + min(width, size))
+
+def extract_acs(ksp, calib_width=24):
+    if ksp.ndim == 5:
+        count = (ksp != 0).sum(dim=1).clamp(min=1)
+        ksp = ksp.sum(dim=1) / count
+    return ksp[..., _center(ksp.shape[-2], calib_width), _center(ksp.shape[-1], calib_width)]
+
+#----------------------------------------------------------------------------
+# ESPIRiT (Uecker et al. 2014) for a batch of ACS regions [N, C, c, c]:
+# k-space kernels from the calibration matrix SVD, their per-pixel image
+# domain Gram matrices, and the dominant eigenvector per pixel. Pixels with
+# an eigenvalue at or below crop are zeroed. Returns maps [N, C, H, W],
+# phase-referenced to the first coil.
+
+def espirit(acs, img_shape, kernel_width=6, threshold=0.02, crop=0.95, chunk_size=16):
+    N, C = acs.shape[:2]
+    H, W = img_shape
+    k = kernel_width
+    blocks = acs.unfold(-2, k, 1).unfold(-2, k, 1) # [N, C, bh, bw, k, k]
+    mat = blocks.permute(0, 2, 3, 1, 4, 5).reshape(N, -1, C * k * k)
+    _, S, VH = torch.linalg.svd(mat, full_matrices=False)
+    keep = S > threshold * S[:, :1]
+    num_kernels = int(keep.sum(dim=-1).max())
+    kernels = (VH[:, :num_kernels] * keep[:, :num_kernels, None]).reshape(N, num_kernels, C, k, k)
+
+    # Gram matrices of the image-domain kernels, accumulated in chunks.
+    gram = torch.zeros([N, H, W, C, C], dtype=acs.dtype, device=acs.device)
+    for i in range(0, num_kernels, chunk_size):
+        ker = kernels[:, i : i + chunk_size]
+        padded = torch.zeros([*ker.shape[:3], H, W], dtype=acs.dtype, device=acs.device)
+        padded[..., _center(H, k), _center(W, k)] = ker
+        img = ifft2c(padded)
+        gram += torch.einsum('nrchw,nrdhw->nhwcd', img, img.conj())
+    gram *= H * W / k ** 2
+
+    eigval, eigvec = torch.linalg.eigh(gram)
+    maps = eigvec[..., -1] # [N, H, W, C]
+    ref = maps[..., :1]
+    maps = maps * (ref.conj() / ref.abs().clamp(min=1e-30))
+    maps = maps * (eigval[..., -1:] > crop)
+    return maps.permute(0, 3, 1, 2)
+
+#----------------------------------------------------------------------------
+# Sensitivity maps [N, C, H, W] for dense k-space [N, (T,) C, H, W]. Each
+# slice is looked up in the cache by a hash of its ACS samples (with
+# trailing all-zero padding coils removed) and the calibration parameters;
+# only the missing slices are calibrated, as one batch, and then cached.
+
+espirit_version = 1
+
+def _cache_key(acs, params):
+    nonzero = (acs != 0).flatten(1).any(dim=1).nonzero()
+    num_coils = int(nonzero[-1]) + 1 if len(nonzero) else 0
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    digest.update(acs[:num_coils].to(torch.complex64).cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest(), num_coils
+
+def estimate_sens_maps(ksp, calib_width=24, kernel_width=6, threshold=0.02, crop=0.95, cache_dir=None, verbose=True):
+    acs = extract_acs(ksp, calib_width).to(torch.complex64)
+    num_slices, num_coils = acs.shape[:2]
+    img_shape = tuple(ksp.shape[-2:])
+    params = dict(version=espirit_version, img_shape=list(img_shape), calib_width=calib_width, kernel_width=kernel_width, threshold=threshold, crop=crop)
+    if cache_dir is None:
+        cache_dir = dnnlib.util.make_cache_dir_path('espirit')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Look up cached maps.
+    keys = [_cache_key(a, params) for a in acs]
+    maps = torch.zeros([num_slices, num_coils, *img_shape], dtype=torch.complex64, device=ksp.device)
+    missing = []
+    for idx, (key, nc) in enumerate(keys):
+        fname = os.path.join(cache_dir, f'{key}.npy')
+        if os.path.isfile(fname):
+            maps[idx, :nc] = torch.from_numpy(np.load(fname)).to(ksp.device)
+        else:
+            missing.append(idx)
+
+    # Calibrate the rest.
+    if len(missing) > 0:
+        maps[missing] = espirit(acs[missing], img_shape, kernel_width=kernel_width, threshold=threshold, crop=crop)
+        for idx in missing:
+            key, nc = keys[idx]
+            tmp_fname = os.path.join(cache_dir, f'{key}.{uuid.uuid4().hex}.tmp.npy')
+            np.save(tmp_fname, maps[idx, :nc].cpu().numpy())
+            os.replace(tmp_fname, os.path.join(cache_dir, f'{key}.npy'))
+    if verbose:
+        print(f'ESPIRiT: {num_slices - len(missing)}/{num_slices} slices from cache, {len(missing)} calibrated')
+    return maps
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,121 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Data-consistency (likelihood) steps shared by the posterior sampling
+scripts."""
+
+import torch
+
+#----------------------------------------------------------------------------
+# Conversion between the real network layout [N, 2K, H, W], with (real,
+# imag) channel pairs, and complex images [N, K, H, W]. The network layout
+# is kept channels-last (torch.channels_last, see pair_layout()), so that
+# every (real, imag) pair is adjacent in memory: the complex image is then a
+# view_as_complex() view of it, and vice versa, without copies. The network
+# still sees an ordinary [N, 2K, H, W] tensor, only with other strides.
+# Tensors in another layout are copied once on the way. Complex images with
+# K > 1 are laid out as [N, H, W, K] by channels_to_complex(); the operators
+# return [N, K, H, W], which complex_to_channels() copies once.
+
+def pair_layout(x):
+    return x.contiguous(memory_format=torch.channels_last)
+
+def channels_to_complex(x):
+    x = pair_layout(x).permute(0, 2, 3, 1) # [N, H, W, 2K]
+    return torch.view_as_complex(x.unflatten(-1, (-1, 2))).permute(0, 3, 1, 2)
+
+def complex_to_channels(z):
+    x = torch.view_as_real(z.permute(0, 2, 3, 1).contiguous()) # [N, H, W, K, 2]
+    return x.flatten(-2).permute(0, 3, 1, 2)
+
+#----------------------------------------------------------------------------
+# Normalized likelihood gradient of the DPS step, i.e. the gradient of
+# 2 * sum_n ||y_n - A D_n||, which equals grad(sse) / sqrt(sse) separately
+# for every sample n of the operator batch.
+#
+#   likelihood='dps':          backprop through the denoiser to x_cur.
+#   likelihood='closed_form':  2 A^H (A D - y) on the denoiser output, i.e.
+#                              the denoiser Jacobian is taken as identity.
+#                              No backprop through the network.
+#   likelihood='cg':           no gradient step; D itself is replaced by
+#                              ConjugateGradientDC below.
+#
+# dc_term is y - A D in the operator layout. to_net maps an operator image
+# back to the layout of x_cur (closed_form only).
+
+likelihood_modes = ['dps', 'closed_form', 'cg']
+
+def residual_norm(dc_term):
+    return dc_term.abs().square().flatten(1).sum(dim=1).sqrt()
+
+def likelihood_grad(dc_term, x_cur, op=None, to_net=None, likelihood='dps'):
+    assert likelihood in ['dps', 'closed_form']
+    norm = residual_norm(dc_term)
+    if likelihood == 'dps':
+        return torch.autograd.grad(outputs=2 * norm.sum(), inputs=x_cur)[0]
+    grad = op.adjoint(dc_term.detach())
+    scale = -2 / norm.detach().clamp(min=1e-30)
+    grad = grad * scale.reshape(-1, *[1] * (grad.ndim - 1))
+    return to_net(grad).to(x_cur.dtype)
+
+#----------------------------------------------------------------------------
+# Batched conjugate gradient for a Hermitian positive definite operator.
+# Every sample of the leading batch dimension is solved independently and
+# stops updating once its residual drops below tol * ||rhs||.
+
+def _dot(a, b):
+    return (a.conj() * b).real.flatten(1).sum(dim=1).reshape(-1, *[1] * (a.ndim - 1))
+
+def conjugate_gradient(normal, rhs, x, num_iters=10, tol=1e-6):
+    r = rhs - normal(x)
+    p = r.clone()
+    rs = _dot(r, r)
+    threshold = (tol ** 2) * _dot(rhs, rhs)
+    for _ in range(num_iters):
+        active = rs > threshold
+        if not active.any():
+            break
+        Ap = normal(p)
+        pAp = _dot(p, Ap)
+        alpha = torch.where(active & (pAp > 0), rs / pAp.clamp(min=1e-30), torch.zeros_like(rs))
+        x = x + alpha * p
+        r = r - alpha * Ap
+        rs_new = _dot(r, r)
+        p = r + (rs_new / rs.clamp(min=1e-30)) * p
+        rs = rs_new
+    return x
+
+#----------------------------------------------------------------------------
+# Data-consistency stage that replaces the denoiser output D with the
+# solution of (A^H A + lam I) x = A^H y + lam D, computed with a few CG
+# iterations per sampler step. The solve is warm-started from the previous
+# step's solution, which is already close to the new one. Samples whose
+# previous solution is not finite (e.g. samples that joined a running
+# batch) start from D, like a cold solve.
+
+class ConjugateGradientDC:
+    def __init__(self, op, y, lam=1, num_iters=5, tol=1e-6, warm_start=True):
+        self.op = op
+        self.lam = lam
+        self.num_iters = num_iters
+        self.tol = tol
+        self.warm_start = warm_start
+        self.rhs = op.adjoint(y) # A^H y
+        self.x = None
+
+    def __call__(self, denoised):
+        with torch.no_grad():
+            rhs = self.rhs.to(denoised.dtype) + self.lam * denoised
+            x = denoised
+            if self.warm_start and self.x is not None and self.x.shape == denoised.shape:
+                x = self.x.to(denoised.dtype)
+                x = torch.where(x.isfinite(), x, denoised)
+            normal = lambda v: self.op.normal(v) + self.lam * v
+            self.x = conjugate_gradient(normal, rhs, x, num_iters=self.num_iters, tol=self.tol)
+        return self.x
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,408 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Batched MRI forward models (multi-coil SENSE and the T2-shuffling
+subspace model) shared by the posterior sampling scripts."""
+
+import numpy as np
+import torch
+import torch.fft as torch_fft
+
+#----------------------------------------------------------------------------
+# Centered, orthogonal fft/ifft in torch >= 1.7.
+
+def fft2c(x):
+    x = torch_fft.ifftshift(x, dim=(-2, -1))
+    x = torch_fft.fft2(x, dim=(-2, -1), norm='ortho')
+    x = torch_fft.fftshift(x, dim=(-2, -1))
+    return x
+
+def ifft2c(x):
+    x = torch_fft.ifftshift(x, dim=(-2, -1))
+    x = torch_fft.ifft2(x, dim=(-2, -1), norm='ortho')
+    x = torch_fft.fftshift(x, dim=(-2, -1))
+    return x
+
+_real_dtype = {torch.complex64: torch.float32, torch.complex128: torch.float64}
+
+#----------------------------------------------------------------------------
+# Phase ramps that replace the shifts around an orthogonal FFT of length n:
+# fftshift(fft(ifftshift(x))) == phase_out * fft(phase_in * x). For even n
+# both ramps reduce to exact +-1 checkerboards.
+
+def shift_phases(n, device=None):
+    a = n // 2
+    k = np.arange(n)
+    if n % 2 == 0:
+        phase_in = (-1.0) ** k
+        phase_out = (-1.0) ** (k - a)
+        return torch.as_tensor(phase_in, device=device), torch.as_tensor(phase_out, device=device)
+    phase_in = np.exp(2j * np.pi * a * k / n)
+    phase_out = np.exp(2j * np.pi * (k - a) * a / n)
+    return torch.as_tensor(phase_in, device=device), torch.as_tensor(phase_out, device=device)
+
+#----------------------------------------------------------------------------
+# Multi-coil Cartesian SENSE operator A = M F S, optionally preceded by a
+# temporal subspace expansion x_t = sum_k basis[t, k] * x_k (T2 shuffling).
+# All inputs carry a leading batch dimension N; a batch size of 1 in
+# sens/mask broadcasts across the batch.
+#
+#   sens:   [N, C, H, W]     coil sensitivity maps.
+#   mask:   [N, H, W]        sampling mask, or [N, T, H, W] with a basis.
+#   basis:  [T, K]           temporal basis (already truncated to K columns).
+#
+#   image:  [N, H, W]        or [N, K, H, W] with a basis.
+#   kspace: [N, C, H, W]     or [N, C, P] with a basis (see below).
+#
+# The centering shifts are folded into the maps and the mask once at
+# construction, so every forward/adjoint is a single unshifted FFT. Internal
+# temporaries are kept in work buffers that are reused across sampler steps
+# whenever autograd does not need to see them.
+#
+# With a basis, the FFTs run in coefficient space (C*K FFTs instead of C*T)
+# and the echoes are only formed in k-space, at the P sampled (echo, ky, kx)
+# locations of the mask; the [T, C, H, W] echo images are never built. Use
+# compress()/expand() to convert from/to dense zero-filled [N, T, C, H, W]
+# k-space. Masks with different sample counts in the same batch are padded
+# with zero-weight samples.
+
+class SenseOperator:
+    def __init__(self, sens, mask, basis=None):
+        assert sens.ndim == 4
+        assert mask.ndim == (4 if basis is not None else 3)
+        assert basis is None or basis.ndim == 2
+        self.sens = sens
+        self.mask = mask
+        self.basis = basis
+        self.img_shape = tuple(sens.shape[-2:])
+        self.num_coils = sens.shape[1]
+        self.num_coeffs = basis.shape[1] if basis is not None else None
+        self.dtype = sens.dtype if sens.is_complex() else torch.complex64
+        self._buffers = dict()
+        if basis is not None:
+            self.basis = basis.to(self.dtype)
+            self.gram = self.basis.conj().t() @ self.basis # [K, K]
+        self._init_sampling(mask)
+
+    def _init_sampling(self, mask):
+        # Fold fftshift/ifftshift into the maps and the mask.
+        in_h, out_h = shift_phases(self.img_shape[0], device=mask.device)
+        in_w, out_w = shift_phases(self.img_shape[1], device=mask.device)
+        self.sens_mod = (self.sens * (in_h[:, None] * in_w[None, :])).to(self.dtype)
+        real_dtype = _real_dtype[self.dtype]
+        mask = mask if mask.is_complex() else mask.to(real_dtype)
+        mask_mod = mask * (out_h[:, None] * out_w[None, :])
+        mask_mod = mask_mod.to(self.dtype if mask_mod.is_complex() else real_dtype)
+        if self.basis is None:
+            self.mask_mod = mask_mod
+            self.mask_sqr = mask.abs().square().to(real_dtype)
+            return
+
+        # Sampled (echo, pixel) locations, ordered first and padded with
+        # unsampled ones. Each sample carries its row of the basis, scaled by
+        # the (phase-folded) mask value.
+        num_pixels = self.img_shape[0] * self.img_shape[1]
+        flat = mask_mod.reshape(*mask_mod.shape[:-3], -1) # [N, T*H*W]
+        sampled = (flat != 0)
+        key = (~sampled).to(torch.int64) * flat.shape[-1] + torch.arange(flat.shape[-1], device=mask.device)
+        self.num_samples = int(sampled.sum(dim=-1).max())
+        self.samples = key.argsort(dim=-1)[..., :self.num_samples] # [N, P]
+        self.sample_valid = torch.gather(sampled, -1, self.samples)
+        self.sample_pixels = self.samples % num_pixels
+        weight = torch.gather(flat, -1, self.samples) * self.sample_valid
+        self.sample_basis = (self.basis[self.samples // num_pixels] * weight.unsqueeze(-1)).transpose(-1, -2) # [N, K, P]
+
+    def _buffer(self, name, shape, dtype, device):
+        key = (name, tuple(shape), dtype, device)
+        buf = self._buffers.get(key, None)
+        if buf is None:
+            buf = torch.empty(shape, dtype=dtype, device=device)
+            self._buffers[key] = buf
+        return buf
+
+    def _use_buffers(self, *tensors):
+        return not (torch.is_grad_enabled() and any(t.requires_grad for t in tensors))
+
+    def _expand(self, x, out=None):
+        # Image [N, (K,) H, W] => coil images [N, (K,) C, H, W].
+        if self.basis is not None:
+            return torch.mul(x.unsqueeze(2), self.sens_mod.unsqueeze(1), out=out)
+        return torch.mul(x.unsqueeze(1), self.sens_mod, out=out)
+
+    def _reduce(self, x):
+        # Coil images [N, (K,) C, H, W] => image [N, (K,) H, W].
+        if self.basis is not None:
+            return (x * self.sens_mod.conj().unsqueeze(1)).sum(dim=2)
+        return (x * self.sens_mod.conj()).sum(dim=1)
+
+    def _coil_buffer(self, name, x):
+        batch_size = max(x.shape[0], self.sens.shape[0])
+        coeffs = [self.num_coeffs] if self.basis is not None else []
+        shape = [batch_size, *coeffs, self.num_coils, *self.img_shape]
+        return self._buffer(name, shape, torch.promote_types(x.dtype, self.dtype), x.device)
+
+    def _sample_index(self, batch_size):
+        index = self.sample_pixels.unsqueeze(-2).unsqueeze(-2)
+        return index.expand(batch_size, self.num_coeffs, self.num_coils, self.num_samples)
+
+    # Coefficient k-space [N, K, C, H, W] => echo samples [N, C, P].
+    def _mix(self, z):
+        z = z.flatten(-2).expand(max(z.shape[0], self.samples.shape[0]), *z.shape[1:-2], -1)
+        z = torch.gather(z, -1, self._sample_index(z.shape[0]))
+        return (z * self.sample_basis.unsqueeze(-2).to(z.dtype)).sum(dim=1)
+
+    # Echo samples [N, C, P] => coefficient k-space [N, K, C, H, W].
+    def _unmix(self, y, out=None):
+        v = y.unsqueeze(1) * self.sample_basis.conj().unsqueeze(-2).to(y.dtype)
+        shape = [*v.shape[:-1], self.img_shape[0] * self.img_shape[1]]
+        z = torch.zeros(shape, dtype=v.dtype, device=v.device) if out is None else out.view(shape).zero_()
+        return z.scatter_add_(-1, self._sample_index(v.shape[0]), v).view(*shape[:-1], *self.img_shape)
+
+    def forward(self, x):
+        x = x.to(torch.promote_types(x.dtype, self.dtype))
+        if not self._use_buffers(x):
+            k = torch_fft.fft2(self._expand(x), dim=(-2, -1), norm='ortho')
+            return self._mix(k) if self.basis is not None else k * self.mask_mod.unsqueeze(1)
+        with torch.no_grad():
+            z = self._expand(x, out=self._coil_buffer('coils', x))
+            k = torch_fft.fft2(z, dim=(-2, -1), norm='ortho', out=self._coil_buffer('kspace', x))
+            return self._mix(k) if self.basis is not None else k * self.mask_mod.unsqueeze(1)
+
+    def adjoint(self, y):
+        y = y.to(torch.promote_types(y.dtype, self.dtype))
+        if self.basis is not None:
+            shape = [y.shape[0], self.num_coeffs, self.num_coils, *self.img_shape]
+        else:
+            shape = y.shape
+        if not self._use_buffers(y):
+            k = self._unmix(y) if self.basis is not None else y * self.mask_mod.conj().unsqueeze(1)
+            return self._reduce(torch_fft.ifft2(k, dim=(-2, -1), norm='ortho'))
+        with torch.no_grad():
+            k = self._buffer('kspace', shape, y.dtype, y.device)
+            if self.basis is not None:
+                k = self._unmix(y, out=k)
+            else:
+                k = torch.mul(y, self.mask_mod.conj().unsqueeze(1), out=k)
+            z = torch_fft.ifft2(k, dim=(-2, -1), norm='ortho', out=self._buffer('coils', shape, y.dtype, y.device))
+            return self._reduce(z)
+
+    # Fused A^H A. The shift phases cancel against their conjugates, so only
+    # |mask|^2 is applied between the two FFTs.
+    def normal(self, x):
+        if self.basis is not None:
+            return self.adjoint(self.forward(x))
+        x = x.to(torch.promote_types(x.dtype, self.dtype))
+        if not self._use_buffers(x):
+            z = torch_fft.fft2(self._expand(x), dim=(-2, -1), norm='ortho') * self.mask_sqr.unsqueeze(1)
+            return self._reduce(torch_fft.ifft2(z, dim=(-2, -1), norm='ortho'))
+        with torch.no_grad():
+            z = self._expand(x, out=self._coil_buffer('coils', x))
+            k = torch_fft.fft2(z, dim=(-2, -1), norm='ortho', out=self._coil_buffer('kspace', x))
+            k.mul_(self.mask_sqr.unsqueeze(1))
+            z = torch_fft.ifft2(k, dim=(-2, -1), norm='ortho', out=z)
+            return self._reduce(z)
+
+    # S^H S (and B^H B for the subspace model), i.e. A^H A with a fully
+    # sampled mask. Used to project the final estimate onto the coil support.
+    def sens_projection(self, x):
+        weight = self.sens.abs().square().sum(dim=1)
+        if self.basis is not None:
+            return torch.einsum('jk,nkhw->njhw', self.gram.to(x.dtype), x) * weight.unsqueeze(1)
+        return x * weight
+
+    # Conversion between the dense zero-filled k-space layout and the layout
+    # returned by forward(). Both are identities without a basis.
+    def compress(self, y):
+        if self.basis is None:
+            return y
+        y = y.transpose(1, 2).flatten(2) # [N, C, T*H*W]
+        index = self.samples.unsqueeze(-2).expand(y.shape[0], y.shape[1], self.num_samples)
+        return torch.gather(y, -1, index) * self.sample_valid.unsqueeze(-2)
+
+    def expand(self, y):
+        if self.basis is None:
+            return y
+        shape = [y.shape[0], y.shape[1], self.basis.shape[0] * self.img_shape[0] * self.img_shape[1]]
+        index = self.samples.unsqueeze(-2).expand(y.shape)
+        z = torch.zeros(shape, dtype=y.dtype, device=y.device).scatter_(-1, index, y)
+        return z.view(y.shape[0], y.shape[1], self.basis.shape[0], *self.img_shape).transpose(1, 2)
+
+#----------------------------------------------------------------------------
+# Phase-encode axis of a Cartesian line mask, i.e. the axis along which the
+# mask varies while staying constant along the readout. Returns -1 (sampled
+# lines are columns), -2 (sampled lines are rows) or None.
+
+def find_phase_encode_dim(mask):
+    if bool((mask == mask[..., :1, :]).all()):
+        return -1
+    if bool((mask == mask[..., :, :1]).all()):
+        return -2
+    return None
+
+#----------------------------------------------------------------------------
+# Centered, orthogonal DFT matrix of size n, i.e. fft2c along a single axis.
+
+def centered_dft_matrix(n, dtype=torch.complex64, device=None):
+    eye = torch.eye(n, dtype=torch.complex128)
+    mat = torch_fft.fftshift(torch_fft.fft(torch_fft.ifftshift(eye, dim=0), dim=0, norm='ortho'), dim=0)
+    return mat.to(dtype=dtype, device=device)
+
+#----------------------------------------------------------------------------
+# SENSE operator specialized for Cartesian line masks. Only the sampled
+# phase-encode lines are ever evaluated: the phase-encode transform is a
+# partial DFT (a matmul against the sampled rows of the DFT matrix) applied
+# first, after which the readout FFT runs on the compact [.., H, L] (or
+# [.., L, W]) tensor. k-space is stored in that compact layout, i.e.
+# [N, (T,) C, H, L] or [N, (T,) C, L, W]; use compress()/expand() to convert
+# from/to dense zero-filled k-space.
+#
+# With a basis, the readout FFT runs on the K coefficient images instead and
+# the echo mixing is fused with the partial DFT into a single matmul against
+# mixer[k, p, t, l] = basis[t, k] * dft[t, l, p].
+#
+# Masks with different numbers of lines in the same batch are padded to the
+# largest line count with zero-weight lines.
+
+class LineSenseOperator(SenseOperator):
+    def __init__(self, sens, mask, basis=None, pe_dim=None):
+        if pe_dim is None:
+            pe_dim = find_phase_encode_dim(mask)
+        assert pe_dim in [-1, -2]
+        self.pe_dim = pe_dim
+        self.ro_dim = -1 if pe_dim == -2 else -2
+        super().__init__(sens, mask, basis)
+
+    def _init_sampling(self, mask):
+        pe_len = self.img_shape[self.pe_dim]
+
+        # Sampled lines, ordered first and padded with unsampled ones.
+        profile = mask[..., 0, :] if self.pe_dim == -1 else mask[..., :, 0] # [*lead, P]
+        sampled = (profile != 0)
+        key = (~sampled).to(torch.int64) * pe_len + torch.arange(pe_len, device=mask.device)
+        self.num_lines = int(sampled.sum(dim=-1).max())
+        self.lines = key.argsort(dim=-1)[..., :self.num_lines] # [*lead, L]
+        self.line_valid = torch.gather(sampled, -1, self.lines)
+        line_weight = torch.gather(profile, -1, self.lines) * self.line_valid
+
+        # Partial DFT along phase encode; shift phases only along readout.
+        self.dft = centered_dft_matrix(pe_len, dtype=self.dtype, device=mask.device)[self.lines] # [*lead, L, P]
+        ro_in, ro_out = shift_phases(self.img_shape[self.ro_dim], device=mask.device)
+        if self.pe_dim == -1:
+            self.sens_mod = (self.sens * ro_in[:, None]).to(self.dtype)
+            self.weight = (ro_out[:, None] * line_weight.unsqueeze(-2)).to(self.dtype) # [*lead, H, L]
+        else:
+            self.sens_mod = (self.sens * ro_in[None, :]).to(self.dtype)
+            self.weight = (line_weight.unsqueeze(-1) * ro_out[None, :]).to(self.dtype) # [*lead, L, W]
+        if self.basis is None:
+            return
+
+        # Fused echo mixing + partial DFT, laid out for a single matmul.
+        self.ro_out = ro_out.to(self.dtype)
+        dft = self.dft * line_weight.unsqueeze(-1).to(self.dtype) # [N, T, L, P]
+        T, L = dft.shape[-3:-1]
+        if self.pe_dim == -1:
+            self.mixer = torch.einsum('tk,ntlp->nkptl', self.basis, dft).reshape(-1, self.num_coeffs * pe_len, T * L)
+        else:
+            self.mixer = torch.einsum('tk,ntlp->ntlkp', self.basis, dft).reshape(-1, T * L, self.num_coeffs * pe_len)
+
+    def forward(self, x):
+        z = self._expand(x.to(torch.promote_types(x.dtype, self.dtype)))
+        if self.basis is not None:
+            z = torch_fft.fft(z, dim=self.ro_dim, norm='ortho') # [N, K, C, H, W]
+            N, K, C, H, W = z.shape
+            mixer = self.mixer.unsqueeze(1).to(z.dtype)
+            if self.pe_dim == -1:
+                y = z.permute(0, 2, 3, 1, 4).reshape(N, C, H, K * W) @ mixer
+                y = y.view(N, C, H, -1, self.num_lines) * self.ro_out[:, None, None]
+                return y.permute(0, 3, 1, 2, 4)
+            y = mixer @ z.transpose(1, 2).reshape(N, C, K * H, W)
+            y = y.view(N, C, -1, self.num_lines, W) * self.ro_out
+            return y.transpose(1, 2)
+        dft = self.dft.unsqueeze(-3).to(z.dtype)
+        z = z @ dft.transpose(-1, -2) if self.pe_dim == -1 else dft @ z
+        z = torch_fft.fft(z, dim=self.ro_dim, norm='ortho')
+        return z * self.weight.unsqueeze(-3)
+
+    def adjoint(self, y):
+        y = y.to(torch.promote_types(y.dtype, self.dtype))
+        if self.basis is not None:
+            N, T, C = y.shape[:3]
+            mixer = self.mixer.conj().transpose(-1, -2).unsqueeze(1).to(y.dtype)
+            if self.pe_dim == -1:
+                y = y * self.ro_out.conj()[:, None]
+                H = y.shape[-2]
+                z = y.permute(0, 2, 3, 1, 4).reshape(N, C, H, T * self.num_lines) @ mixer
+                z = z.view(N, C, H, self.num_coeffs, -1).permute(0, 3, 1, 2, 4)
+            else:
+                y = y * self.ro_out.conj()
+                W = y.shape[-1]
+                z = mixer @ y.transpose(1, 2).reshape(N, C, T * self.num_lines, W)
+                z = z.view(N, C, self.num_coeffs, -1, W).transpose(1, 2)
+            return self._reduce(torch_fft.ifft(z, dim=self.ro_dim, norm='ortho'))
+        z = torch_fft.ifft(y * self.weight.conj().unsqueeze(-3), dim=self.ro_dim, norm='ortho')
+        dft = self.dft.conj().unsqueeze(-3).to(z.dtype)
+        z = z @ dft if self.pe_dim == -1 else dft.transpose(-1, -2) @ z
+        return self._reduce(z)
+
+    def normal(self, x):
+        return self.adjoint(self.forward(x))
+
+    def _line_index(self, shape):
+        index = self.lines.unsqueeze(-2) if self.pe_dim == -1 else self.lines.unsqueeze(-1)
+        return index.unsqueeze(-3).expand(shape)
+
+    def compress(self, y):
+        shape = list(y.shape)
+        shape[self.pe_dim] = self.num_lines
+        lines = torch.gather(y, self.pe_dim, self._line_index(shape))
+        valid = self.line_valid.unsqueeze(-2) if self.pe_dim == -1 else self.line_valid.unsqueeze(-1)
+        return lines * valid.unsqueeze(-3)
+
+    def expand(self, y):
+        shape = list(y.shape)
+        shape[self.pe_dim] = self.img_shape[self.pe_dim]
+        return torch.zeros(shape, dtype=y.dtype, device=y.device).scatter_(self.pe_dim, self._line_index(y.shape), y)
+
+#----------------------------------------------------------------------------
+# Construct the cheapest operator for the given mask. mode='auto' picks the
+# line operator whenever the mask is a Cartesian line mask.
+
+def construct_operator(sens, mask, basis=None, mode='auto'):
+    assert mode in ['auto', 'lines', 'dense']
+    pe_dim = find_phase_encode_dim(mask) if mode != 'dense' else None
+    if mode == 'lines' and pe_dim is None:
+        raise ValueError('Sampling mask is not a Cartesian line mask')
+    if pe_dim is not None:
+        return LineSenseOperator(sens, mask, basis, pe_dim=pe_dim)
+    return SenseOperator(sens, mask, basis)
+
+#----------------------------------------------------------------------------
+# Operator for a subset of the batch, e.g. to drop samples that have
+# finished. index selects along N (indices or a boolean mask); maps and masks
+# shared by the whole batch stay shared. Measurements in the compressed
+# layout are converted with sub.compress(op.expand(y)[index]).
+
+def select_samples(op, index):
+    sens = op.sens[index] if op.sens.shape[0] > 1 else op.sens
+    mask = op.mask[index] if op.mask.shape[0] > 1 else op.mask
+    if isinstance(op, LineSenseOperator):
+        return LineSenseOperator(sens, mask, op.basis, pe_dim=op.pe_dim)
+    return SenseOperator(sens, mask, op.basis)
+
+#----------------------------------------------------------------------------
+# Operator computing in another complex dtype (complex64 or complex128),
+# i.e. with its maps, masks and basis, and thus its FFTs, in that dtype.
+
+def convert_operator(op, dtype):
+    if op.dtype == dtype:
+        return op
+    sens = op.sens.to(dtype)
+    if isinstance(op, LineSenseOperator):
+        return LineSenseOperator(sens, op.mask, op.basis, pe_dim=op.pe_dim)
+    return SenseOperator(sens, op.mask, op.basis)
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,96 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Numeric precision policies of the samplers: the dtypes of the sampler
+state, of the network evaluation and of the operator FFTs."""
+
+import copy
+import functools
+import torch
+import dnnlib
+
+#----------------------------------------------------------------------------
+# Named policies as (state, net, fft) dtypes. 'float64' is the reference:
+# the sampler state and all schedule arithmetic in float64, the network in
+# float32 and the FFTs in complex128. The others keep the state in float32
+# and the FFTs in complex64, and run the network in float32, bfloat16 or
+# float16.
+
+_policies = {
+    'float64':  (torch.float64, torch.float32,  torch.complex128),
+    'float32':  (torch.float32, torch.float32,  torch.complex64),
+    'bf16':     (torch.float32, torch.bfloat16, torch.complex64),
+    'fp16':     (torch.float32, torch.float16,  torch.complex64),
+}
+
+precision_names = list(_policies.keys())
+
+#----------------------------------------------------------------------------
+# Precision policy by name, with optional overrides of the individual
+# dtypes. Returns an EasyDict(name, state, net, fft); a policy passes through
+# unchanged. FFTs must be at least as precise as the state, as the operators
+# promote their input to their own dtype.
+
+def precision_policy(precision='float64', state=None, net=None, fft=None):
+    if isinstance(precision, dict):
+        return dnnlib.EasyDict(precision)
+    assert precision in _policies, f'Unknown precision {precision}'
+    policy = dnnlib.EasyDict(zip(['state', 'net', 'fft'], _policies[precision]), name=precision)
+    policy.state = state if state is not None else policy.state
+    policy.net = net if net is not None else policy.net
+    policy.fft = fft if fft is not None else policy.fft
+    assert policy.state in [torch.float32, torch.float64]
+    assert policy.net in [torch.float32, torch.bfloat16, torch.float16]
+    assert policy.fft in [torch.complex64, torch.complex128]
+    assert not (policy.state == torch.float64 and policy.fft == torch.complex64), 'FFTs must be at least as precise as the sampler state'
+    return policy
+
+#----------------------------------------------------------------------------
+# Underlying model evaluated in a reduced precision. The preconditioning
+# wrappers (EDMPrecond etc.) only know float32 and CUDA float16, and pickled
+# networks carry their own copy of that code, so the cast goes around the
+# model instead: its input is cast to dtype and its output back, while the
+# layers cast their float32 weights to the input dtype, as in the float16
+# path of the wrappers.
+
+class _ReducedPrecisionModel(torch.nn.Module):
+    def __init__(self, model, dtype):
+        super().__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, x, noise_labels, class_labels=None, **model_kwargs):
+        return self.model(x.to(self.dtype), noise_labels, class_labels=class_labels, **model_kwargs).to(x.dtype)
+
+#----------------------------------------------------------------------------
+# Network evaluated at the precision of the policy. Returns net itself for
+# float32, else a shallow copy sharing all parameters, memoized so that
+# compiled sampler steps see the same module on every call.
+
+def precision_net(net, precision):
+    dtype = precision_policy(precision).net
+    return net if dtype == torch.float32 else _reduced_precision_net(net, dtype)
+
+@functools.lru_cache(maxsize=None)
+def _reduced_precision_net(net, dtype):
+    assert isinstance(getattr(net, 'model', None), torch.nn.Module), 'Reduced network precision requires a preconditioned network'
+    wrapped = copy.copy(net)
+    wrapped._modules = dict(net._modules)
+    wrapped.model = _ReducedPrecisionModel(net.model, dtype)
+    wrapped.use_fp16 = False
+    return wrapped
+
+#----------------------------------------------------------------------------
+# Largest deviation of a batch of samples [N, ...] from the reference, per
+# sample [N], relative to the largest magnitude of the reference sample.
+
+def max_deviation(x, reference):
+    x = x.to(reference.dtype).flatten(1)
+    reference = reference.flatten(1)
+    return ((x - reference).abs().max(dim=1).values / reference.abs().max(dim=1).values.clamp(min=1e-30)).to(torch.float64)
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,636 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Batched diffusion posterior sampling (DPS) over many slices, each with
+its own operator, measurements and likelihood step size."""
+
+import functools
+import numpy as np
+import torch
+import dnnlib
+from posterior.guidance import ConjugateGradientDC, channels_to_complex, complex_to_channels, likelihood_grad, pair_layout, residual_norm
+from posterior.operators import construct_operator, convert_operator, select_samples
+from posterior.precision import precision_policy, precision_net
+from posterior.solvers import EulerSolver, construct_solver, _per_sample
+
+#----------------------------------------------------------------------------
+# Noise levels u_j, j = 0, ..., M, of the iddpm discretization. The
+# recursion is inherently sequential, so the table is computed once per
+# (M, C_1, C_2) on the CPU and memoized.
+
+@functools.lru_cache(maxsize=None)
+def iddpm_sigmas(M=1000, C_1=0.001, C_2=0.008):
+    u = torch.zeros(M + 1, dtype=torch.float64)
+    alpha_bar = lambda j: (0.5 * np.pi * j / M / (C_2 + 1)).sin() ** 2
+    for j in torch.arange(M, 0, -1): # M, ..., 1
+        u[j - 1] = ((u[j] ** 2 + 1) / (alpha_bar(j - 1) / alpha_bar(j)).clip(min=C_1) - 1).sqrt()
+    return u
+
+#----------------------------------------------------------------------------
+# Time steps and noise level/scaling schedules of the generalized ablation
+# sampler. Returns an EasyDict with t_steps [num_steps + 1] (t_N = 0) and the
+# functions sigma, sigma_deriv, sigma_inv, s and s_deriv. sigma_steps, if
+# given, replaces the discretization with precomputed noise levels (e.g. an
+# optimized schedule, see posterior/schedules.py); num_steps, sigma_min and
+# sigma_max then follow from it.
+
+def noise_schedule(
+    net, num_steps=18, sigma_min=None, sigma_max=None, rho=7,
+    discretization='edm', schedule='linear', scaling='none',
+    epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000, sigma_steps=None, device=torch.device('cpu'),
+):
+    assert discretization in ['vp', 've', 'iddpm', 'edm']
+    assert schedule in ['vp', 've', 'linear']
+    assert scaling in ['vp', 'none']
+    if sigma_steps is not None:
+        sigma_steps = torch.as_tensor(sigma_steps, dtype=torch.float64, device=device)
+        num_steps, sigma_min, sigma_max = len(sigma_steps), float(sigma_steps[-1]), float(sigma_steps[0])
+
+    # Helper functions for VP & VE noise level schedules.
+    vp_sigma = lambda beta_d, beta_min: lambda t: (np.e ** (0.5 * beta_d * (t ** 2) + beta_min * t) - 1) ** 0.5
+    vp_sigma_deriv = lambda beta_d, beta_min: lambda t: 0.5 * (beta_min + beta_d * t) * (sigma(t) + 1 / sigma(t))
+    vp_sigma_inv = lambda beta_d, beta_min: lambda sigma: ((beta_min ** 2 + 2 * beta_d * (sigma ** 2 + 1).log()).sqrt() - beta_min) / beta_d
+    ve_sigma = lambda t: t.sqrt()
+    ve_sigma_deriv = lambda t: 0.5 / t.sqrt()
+    ve_sigma_inv = lambda sigma: sigma ** 2
+
+    # Select default noise level range based on the specified time step discretization.
+    if sigma_min is None:
+        vp_def = vp_sigma(beta_d=19.9, beta_min=0.1)(t=epsilon_s)
+        sigma_min = {'vp': vp_def, 've': 0.02, 'iddpm': 0.002, 'edm': 0.002}[discretization]
+    if sigma_max is None:
+        vp_def = vp_sigma(beta_d=19.9, beta_min=0.1)(t=1)
+        sigma_max = {'vp': vp_def, 've': 100, 'iddpm': 81, 'edm': 80}[discretization]
+
+    # Adjust noise levels based on what's supported by the network.
+    sigma_min = max(sigma_min, net.sigma_min)
+    sigma_max = min(sigma_max, net.sigma_max)
+
+    # Compute corresponding betas for VP.
+    vp_beta_d = 2 * (np.log(sigma_min ** 2 + 1) / epsilon_s - np.log(sigma_max ** 2 + 1)) / (epsilon_s - 1)
+    vp_beta_min = np.log(sigma_max ** 2 + 1) - 0.5 * vp_beta_d
+
+    # Define time steps in terms of noise level.
+    step_indices = torch.arange(num_steps, dtype=torch.float64, device=device)
+    if sigma_steps is not None:
+        pass
+    elif discretization == 'vp':
+        orig_t_steps = 1 + step_indices / (num_steps - 1) * (epsilon_s - 1)
+        sigma_steps = vp_sigma(vp_beta_d, vp_beta_min)(orig_t_steps)
+    elif discretization == 've':
+        orig_t_steps = (sigma_max ** 2) * ((sigma_min ** 2 / sigma_max ** 2) ** (step_indices / (num_steps - 1)))
+        sigma_steps = ve_sigma(orig_t_steps)
+    elif discretization == 'iddpm':
+        u = iddpm_sigmas(M, C_1, C_2).to(device)
+        u_filtered = u[torch.logical_and(u >= sigma_min, u <= sigma_max)]
+        sigma_steps = u_filtered[((len(u_filtered) - 1) / (num_steps - 1) * step_indices).round().to(torch.int64)]
+    else:
+        assert discretization == 'edm'
+        sigma_steps = (sigma_max ** (1 / rho) + step_indices / (num_steps - 1) * (sigma_min ** (1 / rho) - sigma_max ** (1 / rho))) ** rho
+
+    # Define noise level schedule.
+    if schedule == 'vp':
+        sigma = vp_sigma(vp_beta_d, vp_beta_min)
+        sigma_deriv = vp_sigma_deriv(vp_beta_d, vp_beta_min)
+        sigma_inv = vp_sigma_inv(vp_beta_d, vp_beta_min)
+    elif schedule == 've':
+        sigma = ve_sigma
+        sigma_deriv = ve_sigma_deriv
+        sigma_inv = ve_sigma_inv
+    else:
+        assert schedule == 'linear'
+        sigma = lambda t: t
+        sigma_deriv = lambda t: 1
+        sigma_inv = lambda sigma: sigma
+
+    # Define scaling schedule.
+    if scaling == 'vp':
+        s = lambda t: 1 / (1 + sigma(t) ** 2).sqrt()
+        s_deriv = lambda t: -sigma(t) * sigma_deriv(t) * (s(t) ** 3)
+    else:
+        assert scaling == 'none'
+        s = lambda t: 1
+        s_deriv = lambda t: 0
+
+    # Compute final time steps based on the corresponding noise levels.
+    t_steps = sigma_inv(net.round_sigma(sigma_steps))
+    t_steps = torch.cat([t_steps, torch.zeros_like(t_steps[:1])]) # t_N = 0
+    return dnnlib.EasyDict(t_steps=t_steps, sigma=sigma, sigma_deriv=sigma_deriv, sigma_inv=sigma_inv, s=s, s_deriv=s_deriv)
+
+#----------------------------------------------------------------------------
+# Network layout [N, 2K, H, W] of (real, imag) channel pairs <=> operator
+# images [N, (K,) H, W].
+
+def image_layout(op):
+    if op.basis is None:
+        return (lambda x: channels_to_complex(x)[:, 0]), (lambda z: complex_to_channels(z[:, None]))
+    return channels_to_complex, complex_to_channels
+
+#----------------------------------------------------------------------------
+# Start of the trajectory. init='noise' starts from pure noise at t_steps[0].
+# init='adjoint' starts from the zero-filled reconstruction A^H y, forward
+# diffused to a lower noise level, and skips the steps above it
+# (Come-Closer-Diffuse-Faster, Chung et al. 2022). y must be normalized like
+# the network data (see prepare_batch() in reconstruct.py). The start is the
+# first step with sigma <= start_sigma, or the step after skipping a
+# fraction start_frac of the steps. Returns the start index and x at that
+# step, in the given dtype (the state dtype of the precision policy) and in
+# the channels-last pair layout (see pair_layout()).
+
+def initial_state(sched, latents, op, y, init='noise', start_sigma=None, start_frac=None, dtype=torch.float64):
+    assert init in ['noise', 'adjoint']
+    assert start_sigma is None or start_frac is None
+    assert init == 'adjoint' or (start_sigma is None and start_frac is None), 'start_sigma and start_frac require init=adjoint'
+    t_steps = sched.t_steps
+    num_steps = len(t_steps) - 1
+    start = 0
+    if start_sigma is not None:
+        start = int((torch.as_tensor(sched.sigma(t_steps[:-1])) > start_sigma).sum())
+    elif start_frac is not None:
+        start = int(round(start_frac * num_steps))
+    start = min(start, num_steps - 1)
+    t_start = t_steps[start]
+    x = pair_layout(latents.to(dtype)) * sched.sigma(t_start)
+    if init == 'adjoint':
+        _, to_net = image_layout(op)
+        x = x + to_net(op.adjoint(y)).to(dtype)
+    return start, x * sched.s(t_start)
+
+#----------------------------------------------------------------------------
+# One DPS step from t_cur to t_next: ODE step of the given solver (Euler by
+# default) followed by the normalized likelihood step (or the CG
+# data-consistency stage). t_cur and t_next are scalars or per-sample
+# tensors [N], so that the samples of a batch may be at different points of
+# the trajectory. step_size must broadcast against x_cur. The likelihood
+# gradient always comes from the first network evaluation of the step;
+# further evaluations (Heun) run without gradient but with the CG stage.
+# All arithmetic stays in the dtype of x_cur. Returns x_next, the denoiser
+# output D(x_hat), both detached, and the new solver state.
+
+def dps_step(
+    net, x_cur, t_cur, t_next, sched, op, y, class_labels=None, randn_like=torch.randn_like, num_steps=18,
+    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1, likelihood='dps', step_size=1, dc_solver=None, solver=None, state=None,
+):
+    sigma, sigma_inv, s = sched.sigma, sched.sigma_inv, sched.s
+    to_image, to_net = image_layout(op)
+    solver = solver if solver is not None else EulerSolver(sched)
+    state = state if state is not None else solver.init_state(x_cur)
+    x_cur = x_cur.detach().requires_grad_(likelihood == 'dps')
+
+    # Increase noise temporarily.
+    gamma = min(S_churn / num_steps, np.sqrt(2) - 1) * ((S_min <= sigma(t_cur)) & (sigma(t_cur) <= S_max)).to(torch.float64)
+    t_hat = sigma_inv(net.round_sigma(sigma(t_cur) + gamma * sigma(t_cur)))
+    x_hat = x_cur
+    if bool((gamma > 0).any()):
+        x_hat = _per_sample(s(t_hat) / s(t_cur), x_cur) * x_cur + _per_sample((sigma(t_hat) ** 2 - sigma(t_cur) ** 2).clip(min=0).sqrt() * s(t_hat), x_cur) * S_noise * randn_like(x_cur)
+
+    # Denoise, with data consistency.
+    def denoise(x, t):
+        denoised = net(x / _per_sample(s(t), x), sigma(t), class_labels).to(x.dtype)
+        if dc_solver is not None:
+            denoised = to_net(dc_solver(to_image(denoised))).to(x.dtype)
+        return denoised
+    with torch.set_grad_enabled(likelihood == 'dps'):
+        denoised = denoise(x_hat, t_hat)
+
+    # ODE step.
+    def denoise_no_grad(x, t):
+        with torch.no_grad():
+            return denoise(x.detach(), t)
+    x_next, state = solver.step(x_hat, t_hat, t_next, denoised, state, denoise=denoise_no_grad)
+
+    # Likelihood step, normalized per sample.
+    if dc_solver is None:
+        dc_term = y - op.forward(to_image(denoised))
+        x_next = x_next - step_size * likelihood_grad(dc_term, x_cur, op=op, to_net=to_net, likelihood=likelihood)
+    return x_next.detach(), denoised.detach(), state
+
+#----------------------------------------------------------------------------
+# Schedule coefficients at every step i of the fixed time steps, evaluated
+# once as device tensors [num_steps]: the noise level sigma_i and scaling s_i
+# of the network input, and the Euler update x_{i+1} = a_i x_i + b_i D_i
+# (see EulerSolver).
+
+def step_coefficients(sched):
+    t_cur, t_next = sched.t_steps[:-1], sched.t_steps[1:]
+    sigma, sigma_deriv, s, s_deriv = [torch.as_tensor(f(t_cur), dtype=torch.float64, device=t_cur.device).expand(t_cur.shape)
+        for f in [sched.sigma, sched.sigma_deriv, sched.s, sched.s_deriv]]
+    h = t_next - t_cur
+    return dnnlib.EasyDict(sigma=sigma, s=s, a=1 + h * (sigma_deriv / sigma + s_deriv / s), b=-h * sigma_deriv * s / sigma)
+
+#----------------------------------------------------------------------------
+# Euler DPS step from precomputed coefficients (0-dim tensors, see
+# step_coefficients()), equivalent to dps_step() without churn. x_cur must
+# be a leaf that requires grad for likelihood='dps'. The function takes only
+# tensors and no schedule functions, so that torch.compile() traces the
+# network call, the data consistency and the update once per shape instead
+# of once per step. The DPS gradient splits it into the forward graph
+# (network and residual, with its compiled backward) and the update.
+
+def euler_dps_step(net, x_cur, sigma, s, a, b, op, y, class_labels=None, likelihood='dps', step_size=1, dc_solver=None):
+    to_image, to_net = image_layout(op)
+    with torch.set_grad_enabled(likelihood == 'dps'):
+        denoised = net(x_cur / s, sigma, class_labels).to(x_cur.dtype)
+    if dc_solver is not None:
+        denoised = to_net(dc_solver(to_image(denoised))).to(x_cur.dtype)
+        return (a * x_cur + b * denoised).detach()
+    x_next = a * x_cur + b * denoised
+    x_next = x_next - step_size * likelihood_grad(y - op.forward(to_image(denoised)), x_cur, op=op, to_net=to_net, likelihood=likelihood)
+    return x_next.detach()
+
+@functools.lru_cache(maxsize=None)
+def _compiled_euler_dps_step():
+    return torch.compile(euler_dps_step, dynamic=False)
+
+#----------------------------------------------------------------------------
+# Branch point of a batch of trajectory variants: the first step with sigma
+# <= branch_sigma, or step branch_step. The steps before it run once per
+# trunk (see dps_sampler()).
+
+def branch_index(sched, branch_step=None, branch_sigma=None):
+    assert branch_step is None or branch_sigma is None
+    num_steps = len(sched.t_steps) - 1
+    if branch_sigma is not None:
+        return int((torch.as_tensor(sched.sigma(sched.t_steps[:-1])) > branch_sigma).sum())
+    return min(branch_step, num_steps) if branch_step is not None else 0
+
+#----------------------------------------------------------------------------
+# DPS sampler of the posterior scripts, batched over N independent slices.
+# op is a batched operator (per-sample maps and masks) and y [N, ...] the
+# measurements in its layout. The network sees [N, 2K, H, W] (real, imag)
+# channel pairs of the operator image [N, (K,) H, W]. likelihood_step_size
+# is a scalar or a per-sample tensor [N]. solver is one of solver_names.
+# sigma_steps optionally gives the noise levels of the steps (see
+# noise_schedule()). init, start_sigma and start_frac select the start of
+# the trajectory (see initial_state()). Euler steps without churn run from
+# precomputed coefficients, compiled with compile_step. precision is a
+# precision policy or its name (see posterior/precision.py). Returns the
+# complex images, and with return_nfe also the number of network
+# evaluations per sample [N].
+#
+# Branching: trunk [N] maps every sample to the sample whose trajectory it
+# shares up to the branch point (see branch_index()); trunk samples map to
+# themselves. Only the trunks run the steps before the branch point, with
+# their own step size, labels and churn noise; then every variant forks
+# from the state of its trunk and continues with its own settings. Variants
+# with branch_noise [N] set are re-noised at the fork from their own
+# latents around the trunk's denoiser output, x = s (D + sigma latents), so
+# that they become independent posterior samples (one extra network
+# evaluation per trunk).
+
+def dps_sampler(
+    net, latents, op, y, class_labels=None, randn_like=torch.randn_like,
+    num_steps=18, sigma_min=None, sigma_max=None, rho=7,
+    discretization='edm', schedule='linear', scaling='none',
+    epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000,
+    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1,
+    likelihood='dps', likelihood_step_size=1, cg_lambda=1, cg_iters=5, cg_tol=1e-6, solver='euler', sigma_steps=None, compile_step=False,
+    init='noise', start_sigma=None, start_frac=None, return_nfe=False,
+    trunk=None, branch_step=None, branch_sigma=None, branch_noise=None, precision='float64',
+):
+    sched = noise_schedule(net, num_steps=num_steps, sigma_min=sigma_min, sigma_max=sigma_max, rho=rho,
+        discretization=discretization, schedule=schedule, scaling=scaling, epsilon_s=epsilon_s, C_1=C_1, C_2=C_2, M=M,
+        sigma_steps=sigma_steps, device=latents.device)
+    t_steps = sched.t_steps
+    num_steps = len(t_steps) - 1
+    precision = precision_policy(precision)
+    net = precision_net(net, precision)
+    op, y = convert_operator(op, precision.fft), y.to(precision.fft)
+    to_image, to_net = image_layout(op)
+    start, x_next = initial_state(sched, latents, op, y, init=init, start_sigma=start_sigma, start_frac=start_frac, dtype=precision.state)
+    step_size = _per_sample(likelihood_step_size, x_next)
+    fast_path = (solver == 'euler' and S_churn == 0)
+    solver = construct_solver(solver, sched)
+    num_evals = (num_steps - start) * solver.evals_per_step - (solver.evals_per_step - 1) # no correction at t = 0
+    nfe = torch.full([latents.shape[0]], num_evals, dtype=torch.int64, device=latents.device)
+    coef = step_coefficients(sched) if fast_path else None
+    step_fn = _compiled_euler_dps_step() if compile_step else euler_dps_step
+
+    # Steps begin, ..., end - 1 of a batch.
+    def run(x, state, begin, end, op, y, labels, step_size, randn_like, dc_solver):
+        for i in range(begin, end):
+            if fast_path:
+                x = step_fn(net, x.requires_grad_(likelihood == 'dps'), coef.sigma[i], coef.s[i], coef.a[i], coef.b[i], op, y, labels,
+                    likelihood=likelihood, step_size=step_size, dc_solver=dc_solver)
+                continue
+            x, _, state = dps_step(net, x, t_steps[i], t_steps[i + 1], sched, op, y, labels, randn_like=randn_like, num_steps=num_steps,
+                S_churn=S_churn, S_min=S_min, S_max=S_max, S_noise=S_noise, likelihood=likelihood, step_size=step_size, dc_solver=dc_solver,
+                solver=solver, state=state)
+        return x, state
+
+    # Shared trunks up to the branch point.
+    state = solver.init_state(x_next)
+    dc_x = None
+    branch = max(branch_index(sched, branch_step, branch_sigma), start) if trunk is not None else start
+    if branch > start:
+        trunk = torch.as_tensor(trunk, device=latents.device)
+        roots, pos = trunk.unique(return_inverse=True)
+        assert bool((trunk[roots] == roots).all()), 'Trunk samples must map to themselves'
+        sub = select_samples(op, roots)
+        y_sub = sub.compress(op.expand(y)[roots])
+        labels = class_labels[roots] if class_labels is not None else None
+        dc_solver = ConjugateGradientDC(sub, y_sub, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol) if likelihood == 'cg' else None
+        trunk_randn_like = lambda x: randn_like(x[pos])[roots] # advance the generators of all variants
+        x_trunk, state = run(x_next[roots], dnnlib.EasyDict({k: v[roots] for k, v in state.items()}), start, branch,
+            sub, y_sub, labels, step_size[roots] if step_size.shape[0] > 1 else step_size, trunk_randn_like, dc_solver)
+
+        # Fork.
+        x_next = x_trunk[pos]
+        state = dnnlib.EasyDict({k: v[pos] for k, v in state.items()})
+        dc_x = dc_solver.x[pos] if dc_solver is not None and dc_solver.x is not None else None
+        if branch_noise is not None and bool(torch.as_tensor(branch_noise).any()) and branch < num_steps:
+            t = t_steps[branch]
+            with torch.no_grad():
+                denoised = net(x_trunk / sched.s(t), sched.sigma(t), labels).to(x_trunk.dtype)
+                if dc_solver is not None:
+                    denoised = to_net(dc_solver(to_image(denoised))).to(x_trunk.dtype)
+            renoise = torch.as_tensor(branch_noise, device=latents.device).reshape(-1, *[1] * (x_next.ndim - 1))
+            x_next = torch.where(renoise, (denoised[pos] + latents.to(x_next.dtype) * sched.sigma(t)) * sched.s(t), x_next)
+            nfe += renoise.flatten().to(nfe.dtype)
+
+    # All samples from the branch point on.
+    dc_solver = ConjugateGradientDC(op, y, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol) if likelihood == 'cg' else None
+    if dc_solver is not None:
+        dc_solver.x = dc_x
+    x_next, _ = run(x_next, state, branch, num_steps, op, y, class_labels, step_size, randn_like, dc_solver)
+    return (to_image(x_next), nfe) if return_nfe else to_image(x_next)
+
+#----------------------------------------------------------------------------
+# Fractional step index of t on the time steps of a fixed schedule (0 at
+# t_steps[0], num_steps at t = 0).
+
+def _step_index(t, t_steps):
+    t_ref = t_steps.flip(0) # increasing
+    t = t.clamp(t_ref[0], t_ref[-1])
+    j = torch.searchsorted(t_ref, t).clamp(1, len(t_ref) - 1)
+    frac = (t - t_ref[j - 1]) / (t_ref[j] - t_ref[j - 1])
+    return (len(t_ref) - 1) - (j - 1 + frac)
+
+#----------------------------------------------------------------------------
+# Variant of dps_sampler() with error-controlled step sizes. Every sample
+# integrates the ODE from sigma_max to sigma_min with its own step size,
+# using the embedded Euler/Heun pair: both share the first network
+# evaluation, and their difference estimates the local error of the step.
+# Steps with a scaled RMS error above 1 (atol + rtol * |x|) are rejected and
+# retried with a smaller step. A final Euler step then goes to sigma = 0.
+# Samples that finish drop out of the batch. The start of the trajectory is
+# selected as in dps_sampler().
+#
+# num_steps no longer sets the number of steps. It only fixes the strength
+# of the likelihood guidance: a step spanning n steps of the fixed num_steps
+# schedule takes n times the likelihood step of dps_sampler(), so that step
+# sizes tuned for fixed schedules carry over. precision is as in
+# dps_sampler(). Returns the complex images and the number of network
+# evaluations per sample [N].
+
+def adaptive_dps_sampler(
+    net, latents, op, y, class_labels=None,
+    num_steps=18, sigma_min=None, sigma_max=None, rho=7,
+    discretization='edm', schedule='linear', scaling='none',
+    epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000,
+    likelihood='dps', likelihood_step_size=1, cg_lambda=1, cg_iters=5, cg_tol=1e-6,
+    rtol=0.05, atol=0.0078, safety=0.9, h_min=1e-5, sigma_steps=None,
+    init='noise', start_sigma=None, start_frac=None, precision='float64',
+):
+    sched = noise_schedule(net, num_steps=num_steps, sigma_min=sigma_min, sigma_max=sigma_max, rho=rho,
+        discretization=discretization, schedule=schedule, scaling=scaling, epsilon_s=epsilon_s, C_1=C_1, C_2=C_2, M=M,
+        sigma_steps=sigma_steps, device=latents.device)
+    t_steps = sched.t_steps
+    assert len(t_steps) >= 3
+    t_end = t_steps[-2]
+    h_min = h_min * (t_steps[0] - t_end)
+    precision = precision_policy(precision)
+    net = precision_net(net, precision)
+    op, y = convert_operator(op, precision.fft), y.to(precision.fft)
+    to_image, to_net = image_layout(op)
+    ode = EulerSolver(sched)
+
+    # Per-sample state of the active samples.
+    batch_size = latents.shape[0]
+    index = torch.arange(batch_size, device=latents.device)
+    start, x = initial_state(sched, latents, op, y, init=init, start_sigma=start_sigma, start_frac=start_frac, dtype=precision.state)
+    t = t_steps[start].expand(batch_size).clone()
+    h = (t_steps[start] - t_steps[start + 1]).expand(batch_size).clone()
+    step_size = torch.as_tensor(likelihood_step_size, dtype=torch.float64, device=latents.device).reshape(-1).expand(batch_size)
+    labels = class_labels
+    dc_solver = ConjugateGradientDC(op, y, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol) if likelihood == 'cg' else None
+    nfe = torch.zeros(batch_size, dtype=torch.int64, device=latents.device)
+    x_out = torch.zeros_like(x)
+
+    def denoise(x, t):
+        denoised = net(x / _per_sample(sched.s(t), x), sched.sigma(t), labels).to(x.dtype)
+        if dc_solver is not None:
+            denoised = to_net(dc_solver(to_image(denoised))).to(x.dtype)
+        return denoised
+
+    while len(index) > 0:
+        final = (t <= t_end)
+        t_next = torch.where(final, torch.zeros_like(t), torch.maximum(t - h, t_end))
+        x = x.detach().requires_grad_(likelihood == 'dps')
+
+        # Euler step, with the likelihood gradient from the same evaluation.
+        with torch.set_grad_enabled(likelihood == 'dps'):
+            denoised = denoise(x, t)
+        d_cur = ode._deriv(x, t, denoised)
+        x_euler = x + _per_sample(t_next - t, x) * d_cur
+        grad = 0
+        if dc_solver is None:
+            grad = likelihood_grad(y - op.forward(to_image(denoised)), x, op=op, to_net=to_net, likelihood=likelihood)
+
+        # Heun step and local error estimate.
+        x_heun = x_euler
+        err = torch.zeros_like(t)
+        if not bool(final.all()):
+            t_prime = torch.where(final, t, t_next)
+            with torch.no_grad():
+                d_prime = ode._deriv(x_euler, t_prime, denoise(x_euler.detach(), t_prime))
+            x_heun = torch.where(final.reshape(-1, *[1] * (x.ndim - 1)), x_euler, x + _per_sample(t_next - t, x) * (0.5 * d_cur + 0.5 * d_prime))
+            scale = atol + rtol * torch.maximum(x.abs(), x_heun.abs())
+            err = ((x_heun - x_euler) / scale).square().flatten(1).mean(dim=1).sqrt().detach()
+        nfe[index] += torch.where(final, 1, 2)
+
+        # Accept or reject, and adapt the step size.
+        accept = final | (err <= 1) | (h <= h_min)
+        weight = _step_index(t_next, t_steps) - _step_index(t, t_steps)
+        x_next = x_heun - _per_sample(weight * step_size, x) * grad
+        x = torch.where(accept.reshape(-1, *[1] * (x.ndim - 1)), x_next, x).detach()
+        t = torch.where(accept, t_next, t)
+        h = torch.maximum(h * (safety * err.clamp(min=1e-10) ** -0.5).clamp(0.2, 5), torch.as_tensor(h_min, dtype=h.dtype))
+
+        # Drop finished samples from the batch.
+        done = accept & final
+        if bool(done.any()):
+            x_out[index[done]] = x[done]
+            keep = ~done
+            index, x, t, h, step_size = index[keep], x[keep], t[keep], h[keep], step_size[keep]
+            labels = labels[keep] if labels is not None else None
+            if len(index) > 0:
+                sub = select_samples(op, keep)
+                y = sub.compress(op.expand(y)[keep])
+                op = sub
+                if dc_solver is not None:
+                    x_dc = dc_solver.x
+                    dc_solver = ConjugateGradientDC(op, y, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol)
+                    dc_solver.x = x_dc[keep] if x_dc is not None else None
+
+    return to_image(x_out), nfe
+
+#----------------------------------------------------------------------------
+# Per-sample convergence test of the sampler iterations. The tracked value
+# is the relative data-consistency residual ||y - A D|| / ||y||
+# (criterion='residual'), the iterate x ('iterate') or the denoiser output D
+# ('denoised'). A sample has converged once its value changed by less than
+# tol (relative) in each of the last window steps, after at least min_steps
+# steps (default: half the steps of the schedule, as the denoiser output
+# barely moves at high noise levels). The state is an EasyDict of per-sample tensors, like the solver
+# state.
+
+convergence_criteria = ['residual', 'iterate', 'denoised']
+
+class ConvergenceMonitor:
+    def __init__(self, criterion='residual', tol=1e-3, window=5, min_steps=None):
+        assert criterion in convergence_criteria
+        self.criterion = criterion
+        self.tol = tol
+        self.window = window
+        self.min_steps = min_steps
+
+    def init_state(self, x):
+        value = x.new_zeros([x.shape[0]]) if self.criterion == 'residual' else torch.zeros_like(x)
+        zeros = torch.zeros([x.shape[0]], dtype=torch.int64, device=x.device)
+        return dnnlib.EasyDict(value=value, steps=zeros, count=zeros)
+
+    def value(self, x, denoised, op, y):
+        if self.criterion == 'iterate':
+            return x
+        if self.criterion == 'denoised':
+            return denoised
+        to_image, _ = image_layout(op)
+        return residual_norm(y - op.forward(to_image(denoised))) / residual_norm(y).clamp(min=1e-30)
+
+    # Returns the new state and the converged samples [N].
+    def update(self, state, value):
+        value = value.detach()
+        diff = (value - state.value).abs().reshape(value.shape[0], -1).norm(dim=1)
+        rel = diff / value.abs().reshape(value.shape[0], -1).norm(dim=1).clamp(min=1e-30)
+        count = torch.where((state.steps > 0) & (rel < self.tol), state.count + 1, torch.zeros_like(state.count))
+        state = dnnlib.EasyDict(value=value, steps=state.steps + 1, count=count)
+        return state, (state.steps >= self.min_steps) & (count >= self.window)
+
+#----------------------------------------------------------------------------
+# DPS sampling of a stream of slices with continuous batching. Every sample
+# sits at its own time step, so that samples that finish leave the batch and
+# their slots are refilled right away. refill(n, like) returns up to n new
+# items compatible with the item like (or any, if None), possibly none for
+# now; sampling ends once the batch is empty and refill() returns nothing.
+# An item is an EasyDict with
+#
+#   latents [2K, H, W], class_labels [label_dim] or None,
+#   ksp [(T,) C, H, W] dense normalized k-space, mask, sens [C, H, W], basis,
+#   step_size, randn_like (per-sample generator, for churn)
+#
+# and any further fields. With a ConvergenceMonitor, converged samples take
+# a final denoising step, i.e. return their last denoiser output D, and
+# leave early. precision is as in dps_sampler(). Yields an EasyDict(item,
+# image [(K,) H, W], steps, nfe, converged) per sample as it finishes, with
+# the steps and network evaluations it took.
+
+def stream_dps_sampler(
+    net, refill, max_batch_size=8, monitor=None,
+    num_steps=18, sigma_min=None, sigma_max=None, rho=7,
+    discretization='edm', schedule='linear', scaling='none',
+    epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000,
+    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1,
+    likelihood='dps', cg_lambda=1, cg_iters=5, cg_tol=1e-6, solver='euler', sigma_steps=None,
+    init='noise', start_sigma=None, start_frac=None, precision='float64', device=torch.device('cpu'),
+):
+    sched = noise_schedule(net, num_steps=num_steps, sigma_min=sigma_min, sigma_max=sigma_max, rho=rho,
+        discretization=discretization, schedule=schedule, scaling=scaling, epsilon_s=epsilon_s, C_1=C_1, C_2=C_2, M=M,
+        sigma_steps=sigma_steps, device=device)
+    t_steps = sched.t_steps
+    num_steps = len(t_steps) - 1
+    solver = construct_solver(solver, sched)
+    precision = precision_policy(precision)
+    net = precision_net(net, precision)
+    if monitor is not None and monitor.min_steps is None:
+        monitor = ConvergenceMonitor(monitor.criterion, tol=monitor.tol, window=monitor.window, min_steps=num_steps // 2)
+
+    def pad_coils(x, num_coils):
+        return torch.cat([x, x.new_zeros([*x.shape[:-3], num_coils - x.shape[-3], *x.shape[-2:]])], dim=-3)
+
+    # Batched operator, measurements and per-sample settings of the active
+    # samples, rebuilt whenever they change. The CG warm start carries over
+    # for the samples that stay, and new samples start from D (see
+    # ConjugateGradientDC).
+    def rebuild(items, dc_x=None):
+        num_coils = max(item.sens.shape[0] for item in items)
+        op = construct_operator(torch.stack([pad_coils(item.sens, num_coils) for item in items]).to(precision.fft),
+            torch.stack([item.mask for item in items]), items[0].basis)
+        y = op.compress(torch.stack([pad_coils(item.ksp, num_coils) for item in items]).to(precision.fft))
+        b = dnnlib.EasyDict(op=op, y=y, dc_solver=None)
+        if likelihood == 'cg':
+            b.dc_solver = ConjugateGradientDC(op, y, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol)
+            b.dc_solver.x = dc_x
+        b.labels = torch.stack([item.class_labels for item in items]) if items[0].class_labels is not None else None
+        b.step_size = torch.as_tensor([float(item.step_size) for item in items], dtype=precision.state, device=device).reshape(-1, 1, 1, 1)
+        b.randn_like = lambda x: torch.cat([item.randn_like(x[j : j + 1]) for j, item in enumerate(items)])
+        return b
+
+    def cat_state(items, key):
+        return dnnlib.EasyDict({k: torch.cat([item[key][k] for item in items]) for k in items[0][key]})
+
+    active, b = [], None
+    while True:
+        # Fill the free slots.
+        new = refill(max_batch_size - len(active), active[0] if len(active) > 0 else None) if len(active) < max_batch_size else []
+        if len(active) == 0 and len(new) == 0:
+            return
+        for item in new:
+            one = rebuild([item])
+            item.i, item.x = initial_state(sched, item.latents[None].to(device), one.op, one.y, init=init, start_sigma=start_sigma, start_frac=start_frac, dtype=precision.state)
+            item.state = solver.init_state(item.x)
+            item.monitor = monitor.init_state(item.x) if monitor is not None else None
+            item.steps = 0
+        if len(new) > 0:
+            dc_x = None
+            if b is not None and b.dc_solver is not None and b.dc_solver.x is not None:
+                dc_x = torch.cat([b.dc_solver.x, b.dc_solver.x.new_full([len(new), *b.dc_solver.x.shape[1:]], float('nan'))])
+            active += new
+            b = rebuild(active, dc_x)
+
+        # One step of every sample, each at its own time step.
+        index = torch.as_tensor([item.i for item in active], device=device)
+        x, denoised, state = dps_step(net, torch.cat([item.x for item in active]), t_steps[index], t_steps[index + 1], sched, b.op, b.y, b.labels,
+            randn_like=b.randn_like, num_steps=num_steps, S_churn=S_churn, S_min=S_min, S_max=S_max, S_noise=S_noise, likelihood=likelihood,
+            step_size=b.step_size, dc_solver=b.dc_solver, solver=solver, state=cat_state(active, 'state'))
+        finished = (index + 1 == num_steps)
+        converged = torch.zeros_like(finished)
+        if monitor is not None:
+            mon, converged = monitor.update(cat_state(active, 'monitor'), monitor.value(x, denoised, b.op, b.y))
+            converged = converged & ~finished
+        for j, item in enumerate(active):
+            item.x = x[j : j + 1]
+            item.state = dnnlib.EasyDict({k: v[j : j + 1] for k, v in state.items()})
+            item.monitor = dnnlib.EasyDict({k: v[j : j + 1] for k, v in mon.items()}) if monitor is not None else None
+            item.i += 1
+            item.steps += 1
+
+        # Hand out the finished samples and free their slots.
+        done = (finished | converged).tolist()
+        if any(done):
+            to_image, _ = image_layout(b.op)
+            images = to_image(torch.where(converged.reshape(-1, *[1] * (x.ndim - 1)), denoised, x))
+            for j, item in enumerate(active):
+                if done[j]:
+                    nfe = item.steps * solver.evals_per_step - (0 if converged[j] else solver.evals_per_step - 1) # no correction at t = 0
+                    yield dnnlib.EasyDict(item=item, image=images[j], steps=item.steps, nfe=nfe, converged=bool(converged[j]))
+            keep = [j for j in range(len(active)) if not done[j]]
+            dc_x = b.dc_solver.x[keep] if b.dc_solver is not None and b.dc_solver.x is not None else None
+            active = [active[j] for j in keep]
+            b = rebuild(active, dc_x) if len(active) > 0 else None
+
+#----------------------------------------------------------------------------
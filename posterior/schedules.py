@@ -0,0 +1,193 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Noise level schedules optimized offline on a calibration set, and the
+schedule files that the samplers load with --schedule_file."""
+
+import json
+import torch
+import dnnlib
+from posterior.guidance import ConjugateGradientDC, pair_layout
+from posterior.operators import select_samples
+from posterior.sampler import noise_schedule, image_layout, dps_step, dps_sampler
+from posterior.solvers import EulerSolver, construct_solver, _per_sample
+
+#----------------------------------------------------------------------------
+# Schedule files are JSON with the noise levels of the steps, sigma_steps
+# [num_steps] (decreasing; the samplers append sigma = 0), and the settings
+# they were optimized for.
+
+def save_schedule(path, sigma_steps, **meta):
+    with open(path, 'wt') as f:
+        json.dump(dict(sigma_steps=[float(sigma) for sigma in sigma_steps], num_steps=len(sigma_steps), **meta), f, indent=2)
+
+def load_schedule(path):
+    with open(path, 'rt') as f:
+        data = dnnlib.EasyDict(json.load(f))
+    sigma = data.sigma_steps
+    assert len(sigma) >= 2 and sigma[-1] > 0 and all(a > b for a, b in zip(sigma[:-1], sigma[1:])), f'{path}: noise levels must be positive and decreasing'
+    return data
+
+#----------------------------------------------------------------------------
+# Monotone warps of a base schedule base_sigma [N]. knots [C, K - 1] holds the
+# interior values of C piecewise linear maps w: [0, 1] -> [0, 1] with w(0) = 0
+# and w(1) = 1 on K uniform intervals. Step i of a warped schedule takes the
+# noise level of the base schedule (interpolated in log sigma) at fractional
+# step w(i / (N - 1)) * (N - 1), so the identity warp reproduces the base
+# schedule and the end points are kept. Returns the schedules [C, N].
+
+def warp_schedule(base_sigma, knots):
+    num_steps = len(base_sigma)
+    knots = torch.cat([knots.new_zeros([knots.shape[0], 1]), knots, knots.new_ones([knots.shape[0], 1])], dim=1)
+    u = torch.linspace(0, 1, num_steps, dtype=torch.float64, device=knots.device) * (knots.shape[1] - 1)
+    j = u.floor().to(torch.int64).clamp(max=knots.shape[1] - 2)
+    pos = (knots[:, j] + (u - j) * (knots[:, j + 1] - knots[:, j])) * (num_steps - 1)
+    k = pos.floor().to(torch.int64).clamp(0, num_steps - 2)
+    log_sigma = base_sigma.to(torch.float64).log()
+    return (log_sigma[k] + (pos - k) * (log_sigma[k + 1] - log_sigma[k])).exp()
+
+#----------------------------------------------------------------------------
+# Sample every calibration slice under every candidate schedule sigma [C, N],
+# batched up to max_batch_size. All schedules share their end points, and
+# every slice starts from its own latent under all of them (common random
+# numbers). Returns the final images [C, S, (K,) H, W] and the summed local
+# truncation error estimates [C, S]: the RMS difference between the Heun and
+# the Euler step, from the denoiser outputs at both ends of every step.
+
+def _sample_schedules(net, latents, op, y, sigma, class_labels, sched_kwargs, max_batch_size=8,
+    likelihood='dps', likelihood_step_size=1, cg_lambda=1, cg_iters=5, cg_tol=1e-6, solver='euler'):
+    sched = noise_schedule(net, sigma_steps=sigma[0], device=latents.device, **sched_kwargs)
+    to_image, _ = image_layout(op)
+    euler = EulerSolver(sched)
+    solver = construct_solver(solver, sched)
+    num_schedules, num_steps = sigma.shape
+    num_slices = latents.shape[0]
+    t_steps = sched.sigma_inv(net.round_sigma(sigma))
+    t_steps = torch.cat([t_steps, torch.zeros_like(t_steps[:, :1])], dim=1)
+
+    images, errors = [], []
+    items = torch.arange(num_schedules * num_slices, device=latents.device)
+    for chunk in items.split(max_batch_size):
+        idx_c, idx_s = chunk // num_slices, chunk % num_slices
+        sub = select_samples(op, idx_s)
+        y_sub = sub.compress(op.expand(y)[idx_s])
+        labels = class_labels[idx_s] if class_labels is not None else None
+        dc_solver = ConjugateGradientDC(sub, y_sub, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol) if likelihood == 'cg' else None
+        t = t_steps[idx_c]
+        x = pair_layout(latents[idx_s].to(torch.float64))
+        x = x * _per_sample(sched.sigma(t[:, 0]) * sched.s(t[:, 0]), x)
+        state = solver.init_state(x)
+        err = torch.zeros_like(t[:, 0])
+        prev = None
+        for i in range(num_steps):
+            x_cur = x
+            x, denoised, state = dps_step(net, x, t[:, i], t[:, i + 1], sched, sub, y_sub, labels, num_steps=num_steps,
+                likelihood=likelihood, step_size=likelihood_step_size, dc_solver=dc_solver, solver=solver, state=state)
+            d_cur = euler._deriv(x_cur, t[:, i], denoised)
+            if prev is not None:
+                h = _per_sample(t[:, i] - prev[0], x)
+                err += (0.5 * h * (d_cur - prev[1])).square().flatten(1).mean(dim=1).sqrt()
+            prev = (t[:, i], d_cur)
+        images.append(sub.sens_projection(to_image(x).to(sub.dtype)))
+        errors.append(err)
+    images = torch.cat(images)
+    return images.reshape(num_schedules, num_slices, *images.shape[1:]), torch.cat(errors).reshape(num_schedules, num_slices)
+
+#----------------------------------------------------------------------------
+# Search for the noise levels of a num_steps schedule that minimize, on
+# average over a calibration batch (op, y, latents [S, 2K, H, W]), one of
+#
+#   reference:   the NMSE against reconstructions with the base schedule
+#                at ref_steps steps, from the same latents.
+#   nmse:        the NMSE against reference images gt [S, (K,) H, W].
+#   truncation:  the summed local truncation error estimates.
+#
+# The candidates are monotone warps of the base schedule (see
+# warp_schedule()). Pattern search: each round moves one knot by +-delta,
+# keeps the best candidate if it improves, and otherwise halves delta, until
+# delta < min_delta. All candidates of a round run batched.
+#
+# likelihood_step_size applies to the num_steps schedules; the reference
+# runs use likelihood_step_size * num_steps / ref_steps, so both apply the
+# same total guidance. Returns an EasyDict with the optimized sigma_steps,
+# its score, the score of the base schedule, the score per round and the
+# number of network evaluations used.
+
+def optimize_schedule(
+    net, latents, op, y, gt=None, class_labels=None, objective='reference',
+    num_steps=30, ref_steps=300, num_knots=8, delta=0.05, min_delta=0.005, max_rounds=50,
+    max_batch_size=8, verbose=True,
+    sigma_min=None, sigma_max=None, rho=7,
+    discretization='edm', schedule='linear', scaling='none',
+    epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000,
+    likelihood='dps', likelihood_step_size=1, cg_lambda=1, cg_iters=5, cg_tol=1e-6, solver='euler',
+):
+    assert objective in ['reference', 'nmse', 'truncation']
+    assert objective != 'nmse' or gt is not None
+    assert num_steps >= 2 and num_knots >= 1
+    sched_kwargs = dict(schedule=schedule, scaling=scaling, epsilon_s=epsilon_s)
+    base_kwargs = dict(sigma_min=sigma_min, sigma_max=sigma_max, rho=rho, discretization=discretization, C_1=C_1, C_2=C_2, M=M, **sched_kwargs)
+    base = noise_schedule(net, num_steps=num_steps, device=latents.device, **base_kwargs)
+    base_sigma = torch.as_tensor(base.sigma(base.t_steps[:-1]), dtype=torch.float64, device=latents.device)
+    sampler_kwargs = dict(likelihood=likelihood, cg_lambda=cg_lambda, cg_iters=cg_iters, cg_tol=cg_tol, solver=solver)
+    evals_per_step = construct_solver(solver, None).evals_per_step
+    num_evals = 0
+
+    # Reference reconstructions.
+    if objective == 'reference':
+        gt = []
+        for idx in torch.arange(latents.shape[0], device=latents.device).split(max_batch_size):
+            sub = select_samples(op, idx)
+            labels = class_labels[idx] if class_labels is not None else None
+            images = dps_sampler(net, latents[idx], sub, sub.compress(op.expand(y)[idx]), labels, num_steps=ref_steps,
+                likelihood_step_size=likelihood_step_size * num_steps / ref_steps, **base_kwargs, **sampler_kwargs)
+            gt.append(images.to(sub.dtype))
+        gt = torch.cat(gt)
+        num_evals += latents.shape[0] * ref_steps * evals_per_step
+
+    def evaluate(knots):
+        nonlocal num_evals
+        images, errors = _sample_schedules(net, latents, op, y, warp_schedule(base_sigma, knots), class_labels, sched_kwargs,
+            max_batch_size=max_batch_size, likelihood_step_size=likelihood_step_size, **sampler_kwargs)
+        num_evals += knots.shape[0] * latents.shape[0] * num_steps * evals_per_step
+        if objective == 'truncation':
+            return errors.mean(dim=1)
+        ref = op.sens_projection(gt.to(op.dtype))
+        err = (images - ref).abs().square().flatten(2).sum(dim=2) / ref.abs().square().flatten(1).sum(dim=1).clamp(min=1e-30)
+        return err.mean(dim=1)
+
+    # Pattern search over the knots of the warp.
+    knots = torch.linspace(0, 1, num_knots + 1, dtype=torch.float64, device=latents.device)[1:-1]
+    base_score = best = float(evaluate(knots[None])[0])
+    history = [best]
+    if verbose:
+        print(f'Base schedule: {objective} {best:g}')
+    for round_idx in range(max_rounds):
+        if delta < min_delta or len(knots) == 0:
+            break
+        candidates = []
+        for k in range(len(knots)):
+            for sign in [1, -1]:
+                c = knots.clone()
+                c[k] += sign * delta
+                if bool((torch.cat([c.new_zeros([1]), c, c.new_ones([1])]).diff() > 1e-3).all()):
+                    candidates.append(c)
+        scores = evaluate(torch.stack(candidates))
+        j = int(scores.argmin())
+        if float(scores[j]) < best:
+            knots, best = candidates[j], float(scores[j])
+        else:
+            delta /= 2
+        history.append(best)
+        if verbose:
+            print(f'Round {round_idx}: {objective} {best:g}, delta {delta:g}')
+
+    sigma_steps = net.round_sigma(warp_schedule(base_sigma, knots[None])[0])
+    return dnnlib.EasyDict(sigma_steps=[float(sigma) for sigma in sigma_steps], score=best, base_score=base_score,
+        history=history, num_evals=num_evals, knots=knots.tolist())
+
+#----------------------------------------------------------------------------
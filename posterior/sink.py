@@ -0,0 +1,165 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Asynchronous output writer of the generation and reconstruction
+scripts: every sample is written once, as its own files or into a shard
+per rank, with PNG previews encoded in the background."""
+
+import os
+import json
+import queue
+import atexit
+import threading
+import concurrent.futures
+import numpy as np
+import torch
+import PIL.Image
+
+#----------------------------------------------------------------------------
+# Magnitude preview of a sample: complex [(K,) H, W] (first coefficient,
+# normalized to its maximum), or real [C, H, W] in [-1, 1] with 1 or 3
+# channels. With normalize, real maps [(K,) H, W] are shown like complex
+# ones, e.g. variance maps. Returns a PIL image.
+
+def image_preview(image, normalize=False):
+    if np.iscomplexobj(image) or normalize:
+        preview = np.abs(image if image.ndim == 2 else image[0])
+        preview = (preview / max(preview.max(), 1e-12) * 255).clip(0, 255).astype(np.uint8)
+        return PIL.Image.fromarray(preview, 'L')
+    preview = (image * 127.5 + 128).clip(0, 255).astype(np.uint8)
+    return PIL.Image.fromarray(preview[0], 'L') if preview.shape[0] == 1 else PIL.Image.fromarray(preview.transpose(1, 2, 0), 'RGB')
+
+#----------------------------------------------------------------------------
+# Network output [N, C, H, W] of the generate scripts as stored samples:
+# complex64 [N, (K,) H, W] for (real, imag) channel pairs, else float32.
+
+def network_samples(images):
+    if images.shape[1] % 2 != 0:
+        return images.to(torch.float32)
+    samples = torch.complex(images[:, 0::2].to(torch.float32), images[:, 1::2].to(torch.float32))
+    return samples[:, 0] if samples.shape[1] == 1 else samples
+
+#----------------------------------------------------------------------------
+# Shards: <outdir>/<prefix>-rank<r>.bin holds the raw samples back to back,
+# and <prefix>-rank<r>.json their keys, dtypes, shapes and byte offsets.
+# Written by one rank each; load_shards() maps all of them.
+
+def load_shards(outdir, prefix='samples'):
+    samples = dict()
+    for fname in sorted(os.listdir(outdir)):
+        if not (fname.startswith(f'{prefix}-rank') and fname.endswith('.json')):
+            continue
+        with open(os.path.join(outdir, fname), 'rt') as f:
+            index = json.load(f)
+        data = np.memmap(os.path.join(outdir, fname[:-len('.json')] + '.bin'), dtype=np.uint8, mode='r')
+        for entry in index['samples']:
+            dtype = np.dtype(entry['dtype'])
+            count = int(np.prod(entry['shape']))
+            samples[entry['key']] = data[entry['offset'] : entry['offset'] + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+    return samples
+
+#----------------------------------------------------------------------------
+# Output sink. write(key, sample) takes a tensor or array and returns right
+# away: device tensors are copied to pinned host memory without blocking,
+# and a background thread waits for the copy and writes the sample, while a
+# thread pool encodes the previews. With layout='files', the sample goes to
+# <outdir>/<key>.npy and its preview to <key>.png; with layout='shards', the
+# samples are appended to the shard of the rank and the previews still go
+# to <key>.png. Errors of the background writes are raised by the next
+# write() or by close(), which waits for all writes. Sinks that are not
+# closed are flushed at exit. normalize is passed on to image_preview().
+
+class OutputSink:
+    def __init__(self, outdir, layout='files', rank=0, preview=True, prefix='samples', num_workers=4):
+        assert layout in ['files', 'shards']
+        self.outdir = outdir
+        self.layout = layout
+        self.preview = preview
+        self._queue = queue.Queue()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) if preview else None
+        self._previews = []
+        self._error = None
+        self._closed = False
+        os.makedirs(outdir, exist_ok=True)
+        if layout == 'shards':
+            self._shard_name = os.path.join(outdir, f'{prefix}-rank{rank:03d}')
+            self._shard = open(self._shard_name + '.bin', 'wb')
+            self._index = []
+            self._offset = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, key, sample, normalize=False):
+        self._check()
+        event = None
+        if isinstance(sample, torch.Tensor):
+            sample = sample.detach()
+            if sample.is_cuda:
+                host = torch.empty(sample.shape, dtype=sample.dtype, pin_memory=True)
+                host.copy_(sample, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                sample = host
+        self._queue.put((key, sample, event, normalize))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            for future in self._previews:
+                if future.exception() is not None and self._error is None:
+                    self._error = future.exception()
+        if self.layout == 'shards':
+            self._shard.close()
+            with open(self._shard_name + '.json', 'wt') as f:
+                json.dump(dict(samples=self._index), f, indent=2)
+        atexit.unregister(self.close)
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, sample, event, normalize = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                sample = sample.numpy() if isinstance(sample, torch.Tensor) else np.asarray(sample)
+                path = os.path.join(self.outdir, key)
+                if self.layout == 'files' or self.preview:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.layout == 'files':
+                    np.save(path + '.npy', sample)
+                else:
+                    data = np.ascontiguousarray(sample)
+                    self._shard.write(data.tobytes())
+                    self._index.append(dict(key=key, dtype=data.dtype.str, shape=list(data.shape), offset=self._offset))
+                    self._offset += data.nbytes
+                if self.preview:
+                    self._previews.append(self._pool.submit(lambda sample=sample, path=path, normalize=normalize: image_preview(sample, normalize).save(path + '.png')))
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,192 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""ODE solvers for the likelihood-guided sampling loop. Multistep solvers
+cache past denoiser outputs, so higher orders cost no extra network
+evaluations."""
+
+import torch
+import dnnlib
+
+#----------------------------------------------------------------------------
+# Broadcast a scalar or per-sample tensor [N] of times or coefficients
+# against a batch x [N, ...], in the dtype of x (see posterior/precision.py).
+
+def _per_sample(t, x):
+    t = torch.as_tensor(t, dtype=(x.dtype if x.is_floating_point() else torch.float64), device=x.device)
+    return t.reshape(-1, *[1] * (x.ndim - 1)) if t.ndim > 0 else t
+
+def _coef(t, x):
+    return _per_sample(t, x).expand(x.shape[0], *[1] * (x.ndim - 1))
+
+#----------------------------------------------------------------------------
+# All solvers integrate the probability flow ODE of the generalized
+# parameterization x = s(t) (x_0 + sigma(t) n),
+#
+#   dx/dt = (sigma'/sigma + s'/s) x - sigma' s / sigma D(x / s; sigma),
+#
+# one step from t_cur to t_next, given the denoiser output D at x_cur. sched
+# is the EasyDict of noise_schedule() (sigma, sigma_deriv, s, s_deriv), t_cur
+# and t_next are scalars or per-sample tensors [N]. The solver state is an
+# EasyDict of tensors with the batch as the leading dimension, so samples
+# can be split and regrouped between steps. step() returns x_next and the
+# new state. The likelihood step is applied to x_next by the caller.
+
+class EulerSolver:
+    evals_per_step = 1
+
+    def __init__(self, sched):
+        self.sched = sched
+
+    def init_state(self, x):
+        return dnnlib.EasyDict()
+
+    def _deriv(self, x, t, denoised):
+        sigma, sigma_deriv, s, s_deriv = [_per_sample(f(t), x) for f in [self.sched.sigma, self.sched.sigma_deriv, self.sched.s, self.sched.s_deriv]]
+        return (sigma_deriv / sigma + s_deriv / s) * x - sigma_deriv * s / sigma * denoised
+
+    def step(self, x_cur, t_cur, t_next, denoised, state, denoise=None):
+        return x_cur + _per_sample(t_next - t_cur, x_cur) * self._deriv(x_cur, t_cur, denoised), state
+
+#----------------------------------------------------------------------------
+# Heun's method (EDM, Algorithm 1). The trapezoidal correction needs D at
+# x_next, obtained from denoise(x, t) (a second network evaluation, with
+# data consistency but without gradient). Steps to t = 0 stay Euler steps.
+
+class HeunSolver(EulerSolver):
+    evals_per_step = 2
+
+    def step(self, x_cur, t_cur, t_next, denoised, state, denoise=None):
+        assert denoise is not None
+        h = _per_sample(t_next - t_cur, x_cur)
+        d_cur = self._deriv(x_cur, t_cur, denoised)
+        x_next = x_cur + h * d_cur
+        t_next = torch.as_tensor(t_next, dtype=torch.float64, device=x_cur.device)
+        last = (t_next == 0)
+        if bool(last.all()):
+            return x_next, state
+        t_prime = torch.where(last, torch.as_tensor(t_cur, dtype=torch.float64, device=x_cur.device), t_next)
+        d_prime = self._deriv(x_next, t_prime, denoise(x_next, t_prime))
+        return torch.where(_per_sample(t_next, x_cur) == 0, x_next, x_cur + h * (0.5 * d_cur + 0.5 * d_prime)), state
+
+#----------------------------------------------------------------------------
+# Multistep DPM-Solver++ (Lu et al. 2022) in data prediction form. With
+# lambda = -log(sigma) and h = lambda_next - lambda_cur, the first-order
+# step is the exponential integrator (DDIM)
+#
+#   x_next = (s_next sigma_next) / (s_cur sigma_cur) x_cur + s_next (1 - e^-h) D,
+#
+# which is exact for the linear part of the ODE under any sigma(t)/s(t), in
+# particular the EDM and VP parameterizations. Orders 2 and 3 extrapolate D
+# from the last one or two outputs kept in the state. The order drops per
+# sample while the history fills up and for the final step to sigma = 0.
+
+class DPMSolverPP(EulerSolver):
+    def __init__(self, sched, order=2):
+        super().__init__(sched)
+        assert order in [1, 2, 3]
+        self.order = order
+
+    def init_state(self, x):
+        return dnnlib.EasyDict(num=torch.zeros([x.shape[0]], dtype=torch.int64, device=x.device),
+            lam=x.new_zeros([x.shape[0], 2]), denoised=x.new_zeros([x.shape[0], 2, *x.shape[1:]]))
+
+    def _order(self, state, sigma_next, x):
+        order = (state.num + 1).clamp(max=self.order).reshape(-1, *[1] * (x.ndim - 1))
+        return torch.where(sigma_next == 0, torch.ones_like(order), order)
+
+    def _push(self, state, lam, denoised):
+        return dnnlib.EasyDict(num=(state.num + 1).clamp(max=2), lam=torch.cat([lam.reshape(-1, 1), state.lam[:, :1]], dim=1),
+            denoised=torch.cat([denoised.detach()[:, None], state.denoised[:, :1]], dim=1))
+
+    def step(self, x_cur, t_cur, t_next, denoised, state, denoise=None):
+        sigma_cur, s_cur = _coef(self.sched.sigma(t_cur), x_cur), _coef(self.sched.s(t_cur), x_cur)
+        sigma_next, s_next = _coef(self.sched.sigma(t_next), x_cur), _coef(self.sched.s(t_next), x_cur)
+        ratio = sigma_next / sigma_cur # e^-h
+        x_1 = (s_next / s_cur) * ratio * x_cur + s_next * (1 - ratio) * denoised
+        x_next = x_1
+        lam = -sigma_cur.log()
+        order = self._order(state, sigma_next, x_cur)
+
+        # Divided differences of D over lambda, as multiples of h.
+        if self.order >= 2 and bool((order >= 2).any()):
+            h = torch.where(ratio > 0, -ratio.log(), torch.ones_like(ratio))
+            num = state.num.reshape(order.shape)
+            lam_1, lam_2 = state.lam[:, 0].reshape(lam.shape), state.lam[:, 1].reshape(lam.shape)
+            r_0 = torch.where(num >= 1, lam - lam_1, h) / h
+            d1_0 = (denoised - state.denoised[:, 0]) / r_0
+            x_next = torch.where(order >= 2, x_1 + 0.5 * s_next * (1 - ratio) * d1_0, x_next)
+            if self.order >= 3 and bool((order >= 3).any()):
+                r_1 = torch.where(num >= 2, lam_1 - lam_2, h) / h
+                d1_1 = (state.denoised[:, 0] - state.denoised[:, 1]) / r_1
+                d1 = d1_0 + r_0 / (r_0 + r_1) * (d1_0 - d1_1)
+                d2 = (d1_0 - d1_1) / (r_0 + r_1)
+                phi_2 = torch.expm1(-h) / h + 1
+                phi_3 = phi_2 / h - 0.5
+                x_next = torch.where(order >= 3, x_1 + s_next * phi_2 * d1 - s_next * phi_3 * d2, x_next)
+        return x_next, self._push(state, lam, denoised)
+
+#----------------------------------------------------------------------------
+# UniPC (Zhao et al. 2023) with B(h) = e^h - 1 (bh2). The order-2 predictor
+# UniP coincides with DPM-Solver++(2M). The corrector UniC refines x_cur
+# with the denoiser output at x_cur itself, which is evaluated anyway, so it
+# adds no network evaluation. D stays the output at the uncorrected point,
+# as in the reference implementation. The correction is applied as a delta
+# so that the likelihood step already taken at x_cur is kept. Samples whose
+# noise level was raised by churn are not corrected.
+
+class UniPCSolver(DPMSolverPP):
+    def __init__(self, sched):
+        super().__init__(sched, order=2)
+
+    def init_state(self, x):
+        return dnnlib.EasyDict(super().init_state(x), target=x.new_zeros([x.shape[0]]))
+
+    def step(self, x_cur, t_cur, t_next, denoised, state, denoise=None):
+        lam = -_coef(self.sched.sigma(t_cur), x_cur).log()
+        lam_1, lam_2 = state.lam[:, 0].reshape(lam.shape), state.lam[:, 1].reshape(lam.shape)
+        num = state.num.reshape(lam.shape)
+        correct = (num >= 1) & ((lam - state.target.reshape(lam.shape)).abs() < 1e-6)
+        if bool(correct.any()):
+            # Coefficients of the previous step lambda_1 -> lambda.
+            h = torch.where(correct, lam - lam_1, torch.ones_like(lam))
+            B_h = torch.expm1(-h)
+            phi_k = B_h / -h - 1
+            b_1 = phi_k / B_h
+            b_2 = (phi_k / -h - 0.5) * 2 / B_h
+            r = torch.where(num >= 2, lam_2 - lam_1, -h) / h
+            d1 = (state.denoised[:, 1] - state.denoised[:, 0]) / r
+            d1_t = denoised - state.denoised[:, 0]
+            rho_a = (b_1 - b_2) / (1 - r)
+            corr_2 = rho_a * d1 + (b_1 - rho_a) * d1_t - 0.5 * d1 # order 2, minus the predictor term
+            corr_1 = 0.5 * d1_t # order 1
+            s_cur = _coef(self.sched.s(t_cur), x_cur)
+            delta = -s_cur * B_h * torch.where(num >= 2, corr_2, corr_1)
+            x_cur = x_cur + torch.where(correct, delta, torch.zeros_like(delta))
+        x_next, new_state = super().step(x_cur, t_cur, t_next, denoised, state)
+        target = -_coef(self.sched.sigma(t_next), x_cur).log().reshape(-1)
+        return x_next, dnnlib.EasyDict(new_state, target=target)
+
+#----------------------------------------------------------------------------
+# Registry of the solvers selectable with --solver.
+
+solvers = {
+    'euler':    EulerSolver,
+    'heun':     HeunSolver,
+    'ddim':     lambda sched: DPMSolverPP(sched, order=1),
+    'dpmpp_2m': lambda sched: DPMSolverPP(sched, order=2),
+    'dpmpp_3m': lambda sched: DPMSolverPP(sched, order=3),
+    'unipc':    UniPCSolver,
+}
+
+solver_names = list(solvers.keys())
+
+def construct_solver(name, sched):
+    assert name in solvers, f'Unknown solver {name}'
+    return solvers[name](sched)
+
+#----------------------------------------------------------------------------
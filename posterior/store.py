@@ -0,0 +1,144 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Memory-mapped k-space store and a background prefetching batch
+reader."""
+
+import os
+import json
+import queue
+import contextlib
+import threading
+import numpy as np
+import torch
+import dnnlib
+from posterior.data import list_kspace_files, load_slices, stack_slices
+
+#----------------------------------------------------------------------------
+# Store layout. Every subject (source file) is a directory of .npy arrays in
+# the operator layout, chunked along the leading slice axis so that a slice
+# is one contiguous block of the memory map:
+#
+#   <name>/ksp.npy    [S, (T,) C, H, W]   complex64, dense zero-filled.
+#   <name>/mask.npy   [S, (T,) H, W]
+#   <name>/sens.npy   [S, C, H, W]        complex64.
+#   <name>/basis.npy  [T, K']             optional, full basis.
+#
+# index.json lists the subjects with their slice counts and the per-file
+# overrides of the manifest they were converted from. A copy of the index
+# elsewhere, with "root" pointing to the store, opens the same store with
+# its own overrides (e.g. the tuned.json of tune.py).
+
+store_version = 1
+
+def is_store(path):
+    if os.path.isdir(path):
+        return os.path.isfile(os.path.join(path, 'index.json'))
+    if not path.endswith('.json'):
+        return False
+    with open(path, 'rt') as f:
+        index = json.load(f)
+    return isinstance(index, dict) and 'root' in index
+
+def write_store(files, dest, verbose=True):
+    os.makedirs(dest, exist_ok=True)
+    subjects = []
+    for file in files:
+        slices = load_slices(file)
+        subject_dir = os.path.join(dest, file.name)
+        os.makedirs(subject_dir, exist_ok=True)
+        np.save(os.path.join(subject_dir, 'ksp.npy'), torch.stack([s.ksp for s in slices]).numpy())
+        np.save(os.path.join(subject_dir, 'mask.npy'), torch.stack([s.mask for s in slices]).numpy())
+        np.save(os.path.join(subject_dir, 'sens.npy'), torch.stack([s.sens for s in slices]).numpy())
+        if slices[0].basis is not None:
+            np.save(os.path.join(subject_dir, 'basis.npy'), slices[0].basis.numpy())
+        subjects.append(dict(name=file.name, num_slices=len(slices), overrides=file.overrides))
+        if verbose:
+            print(f'{file.path} -> {subject_dir} ({len(slices)} slices)')
+    with open(os.path.join(dest, 'index.json'), 'wt') as f:
+        json.dump(dict(version=store_version, subjects=subjects), f, indent=2)
+
+#----------------------------------------------------------------------------
+# Reader. Slices are views into copy-on-write memory maps, so nothing is
+# read from disk until a batch is stacked.
+
+class KspaceStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json') if os.path.isdir(path) else path, 'rt') as f:
+            index = json.load(f)
+        assert index['version'] == store_version
+        if 'root' in index:
+            self.path = os.path.join(os.path.dirname(os.path.abspath(path)), index['root'])
+        self.subjects = [dnnlib.EasyDict(s) for s in index['subjects']]
+
+    def __len__(self):
+        return sum(s.num_slices for s in self.subjects)
+
+    def _open(self, subject, array):
+        fname = os.path.join(self.path, subject.name, f'{array}.npy')
+        return torch.from_numpy(np.load(fname, mmap_mode='c')) if os.path.isfile(fname) else None
+
+    def slices(self, num_coeffs=None):
+        slices = []
+        for subject in self.subjects:
+            ksp, mask, sens, basis = [self._open(subject, array) for array in ['ksp', 'mask', 'sens', 'basis']]
+            if basis is not None and num_coeffs is not None:
+                basis = basis[:, :num_coeffs]
+            for idx in range(subject.num_slices):
+                name = subject.name if subject.num_slices == 1 else f'{subject.name}_slice{idx:03d}'
+                slices.append(dnnlib.EasyDict(name=name, ksp=ksp[idx], mask=mask[idx], sens=sens[idx], basis=basis, gt=None, path=None, subject=subject.name, overrides=subject.overrides))
+        return slices
+
+#----------------------------------------------------------------------------
+# All slices of a store, a directory of .pt files or a manifest. Returns the
+# slices and the number of subjects.
+
+def open_slices(path, num_coeffs=None):
+    if is_store(path):
+        store = KspaceStore(path)
+        return store.slices(num_coeffs=num_coeffs), len(store.subjects)
+    files = list_kspace_files(path)
+    return [s for file in files for s in load_slices(file, num_coeffs=num_coeffs)], len(files)
+
+#----------------------------------------------------------------------------
+# Iterate over (batch, (ksp, mask, sens, basis)) with the next batches read
+# and copied to the device on a background thread while the current one is
+# being sampled. On CUDA the copies run from pinned memory on a side stream.
+# Empty batches yield None.
+
+def prefetch_batches(batches, device=torch.device('cpu'), depth=1):
+    device = torch.device(device)
+    items = queue.Queue(maxsize=depth)
+
+    def worker():
+        try:
+            stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+            for batch in batches:
+                tensors = None
+                if len(batch) > 0:
+                    with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                        tensors = stack_slices(batch, device=device, pin_memory=(stream is not None))
+                    if stream is not None:
+                        stream.synchronize()
+                items.put((batch, tensors))
+            items.put(None)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is None:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+    thread.join()
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,149 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Successive-halving search over DPS likelihood step sizes."""
+
+import collections
+import numpy as np
+import torch
+import dnnlib
+from posterior.guidance import ConjugateGradientDC, pair_layout, residual_norm
+from posterior.sampler import noise_schedule, image_layout, dps_step
+from posterior.solvers import construct_solver
+
+#----------------------------------------------------------------------------
+# Successive-halving rungs for num_configs candidates: the step counts at
+# which the candidates are scored, growing by a factor eta up to num_steps,
+# and the number of candidates alive at each rung. Every rung keeps the best
+# ceil(n / eta) candidates of the previous one.
+
+def halving_rungs(num_configs, num_steps, eta=3):
+    assert eta > 1
+    num_rungs = int(np.floor(np.log(num_configs) / np.log(eta) + 1e-9)) if num_configs > 1 else 0
+    milestones = [max(int(round(num_steps * eta ** (k - num_rungs))), 1) for k in range(num_rungs + 1)]
+    milestones = sorted(set(milestones))
+    milestones[-1] = num_steps
+    counts = [num_configs]
+    for _ in milestones[1:]:
+        counts.append(int(np.ceil(counts[-1] / eta)))
+    return milestones, counts
+
+#----------------------------------------------------------------------------
+# Score of denoiser outputs (operator images [B, (K,) H, W]) against one
+# slice: relative data-consistency residual ||y - A D|| / ||y||, or, given a
+# reference image gt in the units of y, the NMSE of the coil-support
+# projected estimate. Lower is better.
+
+def score_estimates(op, y, images, gt=None):
+    if gt is None:
+        return residual_norm(y - op.forward(images)) / residual_norm(y).clamp(min=1e-30)
+    err = (op.sens_projection(images) - gt).abs().square().flatten(1).sum(dim=1)
+    return err / gt.abs().square().sum().clamp(min=1e-30)
+
+#----------------------------------------------------------------------------
+# Churn noise [N, ...] like x for samples at the given time steps [N]: the
+# noise of step i comes from its own generator seeded by (seed, i), so that
+# every candidate sees the same noise at the same step (common random
+# numbers), whichever batch it runs in.
+
+def churn_noise(x, seed, steps):
+    generators = [torch.Generator(x.device).manual_seed(int(np.random.SeedSequence([seed, i]).generate_state(1)[0])) for i in steps]
+    return torch.stack([torch.randn(x.shape[1:], dtype=x.dtype, device=x.device, generator=gen) for gen in generators])
+
+#----------------------------------------------------------------------------
+# Successive-halving search over likelihood step sizes for one slice. All
+# candidates start from the same latent (common random numbers) and run
+# batched, up to max_batch_size at a time. At each rung the candidates are
+# scored on the current denoiser output, and only the best 1/eta continue.
+# Candidates that reach a rung release their batch slot for candidates that
+# have not, so the batch stays full. Samples in a batch may sit at different
+# time steps; every candidate carries its own solver state.
+#
+# op/y describe a single slice (batch 1), latents is [1, 2K, H, W]. With
+# S_churn > 0, the churn noise of every step derives from seed (see
+# churn_noise()). Returns an EasyDict with the best step size, per-candidate
+# scores per rung, the final images of the last rung and the number of
+# network evaluations used (versus len(candidates) * num_steps for full
+# runs).
+
+def tune_step_size(
+    net, latents, op, y, candidates, gt=None, class_labels=None, seed=0,
+    max_batch_size=8, eta=3, verbose=True,
+    num_steps=18, sigma_min=None, sigma_max=None, rho=7,
+    discretization='edm', schedule='linear', scaling='none',
+    epsilon_s=1e-3, C_1=0.001, C_2=0.008, M=1000,
+    S_churn=0, S_min=0, S_max=float('inf'), S_noise=1,
+    likelihood='dps', cg_lambda=1, cg_iters=5, cg_tol=1e-6, solver='euler', sigma_steps=None,
+):
+    assert latents.shape[0] == 1 and y.shape[0] == 1
+    sched = noise_schedule(net, num_steps=num_steps, sigma_min=sigma_min, sigma_max=sigma_max, rho=rho,
+        discretization=discretization, schedule=schedule, scaling=scaling, epsilon_s=epsilon_s, C_1=C_1, C_2=C_2, M=M,
+        sigma_steps=sigma_steps, device=latents.device)
+    t_steps = sched.t_steps
+    num_steps = len(t_steps) - 1
+    to_image, _ = image_layout(op)
+    dc_solver = ConjugateGradientDC(op, y, lam=cg_lambda, num_iters=cg_iters, tol=cg_tol, warm_start=False) if likelihood == 'cg' else None
+    solver = construct_solver(solver, sched)
+    milestones, counts = halving_rungs(len(candidates), num_steps, eta=eta)
+
+    # Candidate states.
+    x_init = pair_layout(latents.to(torch.float64)) * (sched.sigma(t_steps[0]) * sched.s(t_steps[0]))
+    configs = [dnnlib.EasyDict(idx=idx, step_size=float(step_size), x=x_init, state=solver.init_state(x_init), i=0, rung=0, scores=[]) for idx, step_size in enumerate(candidates)]
+    ready = collections.deque(configs)
+    waiting = [[] for _ in milestones]
+    active = []
+    num_evals = 0
+
+    while len(ready) > 0 or len(active) > 0:
+        while len(ready) > 0 and len(active) < max_batch_size:
+            active.append(ready.popleft())
+
+        # One step for every active candidate, each at its own time step.
+        index = torch.as_tensor([c.i for c in active], device=latents.device)
+        x = torch.cat([c.x for c in active])
+        state = dnnlib.EasyDict({key: torch.cat([c.state[key] for c in active]) for key in active[0].state})
+        step_size = torch.as_tensor([c.step_size for c in active], dtype=torch.float64, device=latents.device).reshape(-1, 1, 1, 1)
+        labels = class_labels.expand(len(active), -1) if class_labels is not None else None
+        x, denoised, state = dps_step(net, x, t_steps[index], t_steps[index + 1], sched, op, y, labels, randn_like=lambda x: churn_noise(x, seed, index.tolist()), num_steps=num_steps,
+            S_churn=S_churn, S_min=S_min, S_max=S_max, S_noise=S_noise, likelihood=likelihood, step_size=step_size, dc_solver=dc_solver,
+            solver=solver, state=state)
+        num_evals += len(active) * solver.evals_per_step
+        for j, c in enumerate(active):
+            c.x = x[j : j + 1]
+            c.state = dnnlib.EasyDict({key: value[j : j + 1] for key, value in state.items()})
+            c.i += 1
+
+        # Score the candidates that reached their rung and free their slots.
+        reached = [j for j, c in enumerate(active) if c.i == milestones[c.rung]]
+        if len(reached) > 0:
+            scores = score_estimates(op, y, to_image(denoised[reached]), gt)
+            for j, score in zip(reached, scores.tolist()):
+                active[j].scores.append(score)
+                waiting[active[j].rung].append(active[j])
+            active = [c for j, c in enumerate(active) if j not in reached]
+
+        # Promote the best candidates of every complete rung.
+        for k in range(len(milestones) - 1):
+            if len(waiting[k]) == counts[k]:
+                survivors = sorted(waiting[k], key=lambda c: c.scores[-1])[:counts[k + 1]]
+                if verbose:
+                    print(f'Rung {k} ({milestones[k]} steps): keeping step sizes {[c.step_size for c in survivors]}')
+                for c in survivors:
+                    c.rung += 1
+                ready.extend(survivors)
+                waiting[k] = []
+
+    final = sorted(waiting[-1], key=lambda c: c.scores[-1])
+    results = dnnlib.EasyDict(best=final[0].step_size, milestones=milestones, num_evals=num_evals, full_evals=len(candidates) * num_steps * solver.evals_per_step)
+    results.scores = {c.step_size: c.scores for c in configs}
+    results.images = {c.step_size: to_image(c.x)[0] for c in final}
+    if verbose:
+        print(f'Best step size {results.best} (score {final[0].scores[-1]:.4g}), '
+            f'{num_evals} network evaluations instead of {results.full_evals}')
+    return results
+
+#----------------------------------------------------------------------------
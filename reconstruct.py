@@ -0,0 +1,473 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Batched posterior sampling over all slices of a k-space store, or of a
+directory or manifest of k-space files."""
+
+import os
+import json
+import zlib
+import click
+import tqdm
+import pickle
+import numpy as np
+import torch
+import dnnlib
+from torch_utils import distributed as dist
+from generate import construct_generator, parse_int_list
+from posterior.operators import construct_operator, select_samples
+from posterior.checkpointing import enable_checkpointing
+from posterior.coils import compress_coils
+from posterior.espirit import estimate_sens_maps
+from posterior.data import group_slices, _compatible
+from posterior.ensemble import EnsembleStats
+from posterior.precision import precision_names, max_deviation
+from posterior.sampler import dps_sampler, adaptive_dps_sampler, stream_dps_sampler, ConvergenceMonitor, convergence_criteria
+from posterior.schedules import load_schedule
+from posterior.sink import OutputSink
+from posterior.solvers import solver_names
+from posterior.store import open_slices, prefetch_batches
+
+#----------------------------------------------------------------------------
+# Parse a comma separated list of floats.
+# Example: '0,0.5,5' returns [0.0, 0.5, 5.0]
+
+def parse_float_list(s):
+    if isinstance(s, (list, tuple)): return [float(x) for x in s]
+    if isinstance(s, (int, float)): return [float(s)]
+    return [float(p) for p in s.split(',')]
+
+#----------------------------------------------------------------------------
+# Operator and measurements of a batch of slices from their stacked (ksp,
+# mask, sens, basis), optionally with ESPIRiT maps and coil compression.
+# Measurements are scaled by the 0.99 quantile of the adjoint image per
+# slice. With verbose, the coil compression is reported. Returns op, y and
+# the scales [N].
+
+def prepare_batch(tensors, espirit=False, num_coils=None, coil_energy=None, verbose=False):
+    ksp, mask, sens, basis = tensors
+    if espirit:
+        sens = estimate_sens_maps(ksp, verbose=False)
+    if num_coils is not None or coil_energy is not None:
+        ksp, sens, _ = compress_coils(ksp, sens, num_coils=num_coils, energy=coil_energy, verbose=verbose)
+    op = construct_operator(sens, mask, basis)
+    y = op.compress(ksp)
+    scale = torch.quantile(op.adjoint(y).abs().flatten(1), 0.99, dim=1)
+    return op, y / scale.reshape(-1, *[1] * (y.ndim - 1)), scale
+
+#----------------------------------------------------------------------------
+# Trunks of a batch for branching (see dps_sampler()): every sample shares
+# the trajectory of the first sample of its slice in the batch, and is
+# re-noised at the branch point if its seed differs. Returns trunk [N] and
+# branch_noise [N].
+
+def batch_trunks(batch):
+    first = dict()
+    trunk = [first.setdefault(s.name, i) for i, s in enumerate(batch)]
+    return trunk, [s.seed != batch[j].seed for s, j in zip(batch, trunk)]
+
+#----------------------------------------------------------------------------
+# Posterior samples for one batch of slices (with seed and step_size set)
+# and their stacked tensors (see prepare_batch()). The returned images
+# [N, (K,) H, W] are projected onto the coil support and rescaled. rng
+# selects the per-seed random streams (see construct_generator()). With
+# adaptive, the step sizes are error-controlled (rtol, atol). With
+# branch_step or branch_sigma, the samples of a slice share their trajectory
+# up to the branch point (see batch_trunks()). verbose is passed on to
+# prepare_batch(). Also returns the number of network evaluations per slice
+# [N].
+
+def reconstruct_batch(net, batch, tensors, class_idx=None, espirit=False, num_coils=None, coil_energy=None, rng='stacked', adaptive=False, rtol=0.05, atol=0.0078, verbose=False, **sampler_kwargs):
+    device = tensors[0].device
+    batch_size = len(batch)
+    op, y, scale = prepare_batch(tensors, espirit=espirit, num_coils=num_coils, coil_energy=coil_energy, verbose=verbose)
+    step_size = [s.step_size for s in batch]
+
+    # Pick latents and labels.
+    rnd = construct_generator(device, [s.seed for s in batch], rng=rng, compile=sampler_kwargs.get('compile_step', False))
+    latents = rnd.randn([batch_size, net.img_channels, *op.img_shape], device=device)
+    class_labels = None
+    if net.label_dim:
+        class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[batch_size], device=device)]
+    if class_idx is not None:
+        class_labels[:, :] = 0
+        class_labels[:, class_idx] = 1
+
+    # Sample and undo the scaling.
+    if adaptive:
+        assert sampler_kwargs.get('S_churn', 0) == 0, 'Adaptive step sizes require S_churn=0'
+        assert sampler_kwargs.get('branch_step', None) is None and sampler_kwargs.get('branch_sigma', None) is None, 'Adaptive step sizes do not branch'
+        sampler_kwargs = {key: value for key, value in sampler_kwargs.items() if key not in ['solver', 'S_churn', 'S_min', 'S_max', 'S_noise', 'compile_step']}
+        images, nfe = adaptive_dps_sampler(net, latents, op, y, class_labels, likelihood_step_size=step_size, rtol=rtol, atol=atol, **sampler_kwargs)
+    else:
+        if sampler_kwargs.get('branch_step', None) is not None or sampler_kwargs.get('branch_sigma', None) is not None:
+            sampler_kwargs['trunk'], sampler_kwargs['branch_noise'] = batch_trunks(batch)
+        images, nfe = dps_sampler(net, latents, op, y, class_labels, randn_like=rnd.randn_like, likelihood_step_size=step_size, return_nfe=True, **sampler_kwargs)
+    return op.sens_projection(images.to(op.dtype)) * scale.reshape(-1, *[1] * (images.ndim - 1)), nfe
+
+#----------------------------------------------------------------------------
+# Split a batch of slices and their stacked tensors into the items of
+# stream_dps_sampler(), with the same latents, labels and churn noise per
+# seed as reconstruct_batch(). Each item keeps its slice (source), its
+# operator and scale for the output.
+
+def stream_items(net, batch, tensors, class_idx=None, espirit=False, num_coils=None, coil_energy=None, rng='stacked', verbose=False):
+    device = tensors[0].device
+    op, y, scale = prepare_batch(tensors, espirit=espirit, num_coils=num_coils, coil_energy=coil_energy, verbose=verbose)
+    ksp = op.expand(y)
+    items = []
+    for i, s in enumerate(batch):
+        rnd = construct_generator(device, [s.seed], rng=rng)
+        latents = rnd.randn([1, net.img_channels, *op.img_shape], device=device)[0]
+        class_labels = None
+        if net.label_dim:
+            class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[1], device=device)][0]
+        if class_idx is not None:
+            class_labels[:] = 0
+            class_labels[class_idx] = 1
+        sub = select_samples(op, [i])
+        items.append(dnnlib.EasyDict(source=s, op=sub, scale=scale[i], latents=latents, class_labels=class_labels, ksp=ksp[i],
+            mask=sub.mask[0], sens=sub.sens[0], basis=op.basis, step_size=s.step_size, randn_like=rnd.randn_like))
+    return items
+
+#----------------------------------------------------------------------------
+# Batches of one rank with all samples of a slice on the same rank, so that
+# ensemble statistics complete there. Slices go to the ranks round-robin,
+# and every rank gets the same number of batches, padded with empty ones.
+
+def ensemble_batches(items, max_batch_size, rank, world_size):
+    names = list(dict.fromkeys(s.name for s in items))
+    slice_rank = {name: i % world_size for i, name in enumerate(names)}
+    per_rank = [group_slices([s for s in items if slice_rank[s.name] == r], max_batch_size) for r in range(world_size)]
+    num_batches = max(len(batches) for batches in per_rank)
+    return per_rank[rank] + [[]] * (num_batches - len(per_rank[rank]))
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--network', 'network_pkl',  help='Network pickle filename', metavar='PATH|URL',                      type=str, required=True)
+@click.option('--data', 'data_path',       help='k-space store, directory of k-space files, or manifest', metavar='DIR|TXT|JSON', type=str, required=True)
+@click.option('--outdir',                  help='Where to save the reconstructions', metavar='DIR',                 type=str, required=True)
+@click.option('--seeds',                   help='Posterior samples per slice (e.g. 1,2,5-10)', metavar='LIST',      type=parse_int_list, default='0', show_default=True)
+@click.option('--class', 'class_idx',      help='Class label  [default: random]', metavar='INT',                    type=click.IntRange(min=0), default=None)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=8, show_default=True)
+@click.option('--checkpoint',              help='Checkpoint denoiser activations', metavar='none|block|level', type=click.Choice(['none', 'block', 'level']), default='none', show_default=True)
+@click.option('--compile', 'compile_step', help='Compile the Euler sampler step and RNG with torch.compile',        is_flag=True)
+@click.option('--rng',                     help='Per-seed random streams', metavar='stacked|philox',                type=click.Choice(['stacked', 'philox']), default='stacked', show_default=True)
+@click.option('--output',                  help='One file per sample, or a shard per rank', metavar='files|shards', type=click.Choice(['files', 'shards']), default='files', show_default=True)
+@click.option('--no_preview',              help='Skip the PNG previews',                                            is_flag=True)
+@click.option('--precision',               help='Sampler state, network and FFT precision', metavar='float64|float32|bf16|fp16', type=click.Choice(precision_names), default='float64', show_default=True)
+@click.option('--validate_precision',      help='Report the deviation from float64 sampling',                       is_flag=True)
+@click.option('--ensemble',                help='Write per-slice mean and variance instead of the samples',         is_flag=True)
+@click.option('--exemplars',               help='Samples per slice still written (--ensemble)', metavar='INT',      type=click.IntRange(min=0), default=0, show_default=True)
+@click.option('--percentiles',             help='Magnitude percentiles per slice (--ensemble)', metavar='LIST',     type=parse_float_list, default=None)
+@click.option('--sketch', 'num_sketch',    help='Samples kept for the percentiles (--ensemble)', metavar='INT',     type=click.IntRange(min=1), default=32, show_default=True)
+@click.option('--checkpoint_res',          help='Resolutions to checkpoint  [default: all]', metavar='LIST',        type=parse_int_list, default=None)
+@click.option('--espirit',                 help='Estimate the maps with ESPIRiT (cached)',                          is_flag=True)
+@click.option('--coils', 'num_coils',      help='Compress to this many virtual coils', metavar='INT',               type=click.IntRange(min=1), default=None)
+@click.option('--coil_energy',             help='Compress to the coils retaining this energy', metavar='FLOAT',     type=click.FloatRange(min=0, max=1, min_open=True), default=None)
+
+@click.option('--steps', 'num_steps',      help='Number of sampling steps', metavar='INT',                          type=click.IntRange(min=1), default=300, show_default=True)
+@click.option('--schedule_file',           help='Optimized noise levels (replaces --steps)', metavar='JSON',        type=str, default=None)
+@click.option('--init',                    help='Start from noise, or the diffused adjoint', metavar='noise|adjoint', type=click.Choice(['noise', 'adjoint']), default='noise', show_default=True)
+@click.option('--start_sigma',             help='Noise level to start from (--init=adjoint)', metavar='FLOAT',      type=click.FloatRange(min=0, min_open=True), default=None)
+@click.option('--start_frac',              help='Fraction of steps to skip (--init=adjoint)', metavar='FLOAT',      type=click.FloatRange(min=0, max=1, max_open=True), default=None)
+@click.option('--adaptive',                help='Error-controlled step sizes (replaces --steps)',                   is_flag=True)
+@click.option('--rtol',                    help='Relative tolerance of --adaptive', metavar='FLOAT',                type=click.FloatRange(min=0, min_open=True), default=0.05, show_default=True)
+@click.option('--atol',                    help='Absolute tolerance of --adaptive', metavar='FLOAT',                type=click.FloatRange(min=0), default=0.0078, show_default=True)
+@click.option('--branch_step',             help='Share the steps before this one per slice', metavar='INT',         type=click.IntRange(min=0), default=None)
+@click.option('--branch_sigma',            help='Share the steps above this noise level per slice', metavar='FLOAT', type=click.FloatRange(min=0, min_open=True), default=None)
+@click.option('--early_stop',              help='Stop converged samples early', metavar='residual|iterate|denoised', type=click.Choice(convergence_criteria), default=None)
+@click.option('--stop_tol',                help='Relative change that counts as converged', metavar='FLOAT',        type=click.FloatRange(min=0, min_open=True), default=1e-3, show_default=True)
+@click.option('--stop_window',             help='Consecutive converged steps to stop', metavar='INT',               type=click.IntRange(min=1), default=5, show_default=True)
+@click.option('--stop_min_steps',          help='Steps before stopping  [default: half]', metavar='INT',            type=click.IntRange(min=0), default=None)
+@click.option('--sigma_min',               help='Lowest noise level  [default: varies]', metavar='FLOAT',           type=click.FloatRange(min=0, min_open=True), default=0.002)
+@click.option('--sigma_max',               help='Highest noise level  [default: varies]', metavar='FLOAT',          type=click.FloatRange(min=0, min_open=True), default=5)
+@click.option('--rho',                     help='Time step exponent', metavar='FLOAT',                              type=click.FloatRange(min=0, min_open=True), default=7, show_default=True)
+@click.option('--S_churn', 'S_churn',      help='Stochasticity strength', metavar='FLOAT',                          type=click.FloatRange(min=0), default=0, show_default=True)
+@click.option('--S_min', 'S_min',          help='Stoch. min noise level', metavar='FLOAT',                          type=click.FloatRange(min=0), default=0, show_default=True)
+@click.option('--S_max', 'S_max',          help='Stoch. max noise level', metavar='FLOAT',                          type=click.FloatRange(min=0), default='inf', show_default=True)
+@click.option('--S_noise', 'S_noise',      help='Stoch. noise inflation', metavar='FLOAT',                          type=float, default=1, show_default=True)
+
+@click.option('--disc', 'discretization',  help='Ablate time step discretization {t_i}', metavar='vp|ve|iddpm|edm', type=click.Choice(['vp', 've', 'iddpm', 'edm']), default='vp', show_default=True)
+@click.option('--schedule',                help='Ablate noise schedule sigma(t)', metavar='vp|ve|linear',           type=click.Choice(['vp', 've', 'linear']), default='vp', show_default=True)
+@click.option('--scaling',                 help='Ablate signal scaling s(t)', metavar='vp|none',                    type=click.Choice(['vp', 'none']), default='vp', show_default=True)
+@click.option('--solver',                  help='ODE solver', metavar='euler|heun|ddim|dpmpp_2m|dpmpp_3m|unipc', type=click.Choice(solver_names), default='euler', show_default=True)
+@click.option('--likelihood',              help='Data-consistency mode', metavar='dps|closed_form|cg',              type=click.Choice(['dps', 'closed_form', 'cg']), default='dps', show_default=True)
+@click.option('--likelihood_step_size',    help='Likelihood step size(s), swept  [default: per file, else 1]', metavar='LIST', type=parse_float_list, default='1')
+@click.option('--cg_lambda',               help='CG data-consistency weight of D', metavar='FLOAT',                 type=click.FloatRange(min=0, min_open=True), default=1, show_default=True)
+@click.option('--cg_iters',                help='CG iterations per step', metavar='INT',                            type=click.IntRange(min=1), default=5, show_default=True)
+@click.option('--cg_tol',                  help='CG relative residual tolerance', metavar='FLOAT',                  type=click.FloatRange(min=0), default=1e-6, show_default=True)
+
+def main(network_pkl, data_path, outdir, seeds, class_idx, max_batch_size, checkpoint, checkpoint_res, espirit, num_coils, coil_energy, rng, output, no_preview, validate_precision, ensemble, exemplars, percentiles, num_sketch, likelihood_step_size, schedule_file,
+    early_stop, stop_tol, stop_window, stop_min_steps, device=torch.device('cuda'), **sampler_kwargs):
+    """Posterior sampling for every slice of a set of k-space files, with
+    slices of different masks, maps and step sizes packed into one batch.
+
+    The network is loaded once and evaluated on a whole batch of slices per
+    sampler step. A list of likelihood step sizes is swept, with every step
+    size of every slice as its own batch entry. A JSON manifest may override
+    the step size(s) per file, e.g. [{"path": "subj01.pt",
+    "likelihood_step_size": 15}].
+
+    Examples:
+
+    \b
+    # Reconstruct all slices under data/ in batches of 16
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --network=network-snapshot.pkl
+
+    \b
+    # Sweep the likelihood step size in a single run
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --likelihood_step_size=1,2,5,10,20 --network=network-snapshot.pkl
+
+    \b
+    # Multistep solver with far fewer steps
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --solver=dpmpp_2m --steps=50 --network=network-snapshot.pkl
+
+    \b
+    # 30-step schedule optimized offline (see optimize_schedule.py)
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --schedule_file=schedule-30.json --network=network-snapshot.pkl
+
+    \b
+    # Start from the adjoint, diffused to sigma=1, skipping the steps above
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --init=adjoint --start_sigma=1 --network=network-snapshot.pkl
+
+    \b
+    # Error-controlled step sizes, per slice (writes nfe.json)
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --adaptive --rtol=0.05 --network=network-snapshot.pkl
+
+    \b
+    # Five posterior samples and a step size sweep per slice, sharing the
+    # trajectory above sigma=1 (writes branches.json)
+    python reconstruct.py --data=data --outdir=out --batch=16 --seeds=0-4 \\
+        --likelihood_step_size=5,10,20 --branch_sigma=1 --network=network-snapshot.pkl
+
+    \b
+    # Stop samples once their data residual settles, refilling the batch
+    # with the next slices (writes steps.json)
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --early_stop=residual --stop_tol=1e-3 --network=network-snapshot.pkl
+
+    \b
+    # Float32 sampler state and FFTs with a bfloat16 network, checked
+    # against float64 sampling (writes precision.json)
+    python reconstruct.py --data=data --outdir=out --batch=16 \\
+        --precision=bf16 --validate_precision --network=network-snapshot.pkl
+
+    \b
+    # 64 posterior samples per slice, writing only their mean, variance
+    # and 5/50/95th magnitude percentiles, and two of the samples
+    python reconstruct.py --data=data --outdir=out --batch=16 --seeds=0-63 \\
+        --ensemble --exemplars=2 --percentiles=5,50,95 --network=network-snapshot.pkl
+
+    \b
+    # Convert to a memory-mapped k-space store once, then reconstruct from it
+    python kspace_tool.py --source=data --dest=data-store
+    python reconstruct.py --data=data-store --outdir=out --batch=16 \\
+        --network=network-snapshot.pkl
+
+    \b
+    # Two posterior samples per slice on 2 GPUs
+    torchrun --standalone --nproc_per_node=2 reconstruct.py --data=manifest.json \\
+        --outdir=out --seeds=0-1 --batch=16 --network=network-snapshot.pkl
+    """
+    dist.init()
+
+    # Rank 0 goes first.
+    if dist.get_rank() != 0:
+        torch.distributed.barrier()
+
+    # Load network.
+    dist.print0(f'Loading network from "{network_pkl}"...')
+    with dnnlib.util.open_url(network_pkl, verbose=(dist.get_rank() == 0)) as f:
+        net = pickle.load(f)['ema'].to(device)
+    num_coeffs = net.img_channels // 2
+
+    # Activation checkpointing for the backward pass through the denoiser.
+    if checkpoint != 'none':
+        example = torch.randn([max_batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
+        net = enable_checkpointing(net, checkpoint, checkpoint_res, x=example)
+
+    # Other ranks follow.
+    if dist.get_rank() == 0:
+        torch.distributed.barrier()
+
+    # Split slices x seeds into batches that share an operator.
+    slices, num_files = open_slices(data_path, num_coeffs=num_coeffs)
+    for s in slices:
+        assert 2 * (s.basis.shape[1] if s.basis is not None else 1) == net.img_channels, f'{s.name}: network channels do not match the data'
+    items = []
+    for s in slices:
+        step_sizes = parse_float_list(s.overrides.get('likelihood_step_size', likelihood_step_size))
+        for step_size in step_sizes:
+            suffix = f'_step{step_size:g}' if len(step_sizes) > 1 else ''
+            items += [dnnlib.EasyDict(s, seed=seed, step_size=step_size, fname=f'{seed:06d}{suffix}', suffix=suffix) for seed in seeds]
+    if ensemble:
+        rank_batches = ensemble_batches(items, max_batch_size, dist.get_rank(), dist.get_world_size())
+    else:
+        all_batches = group_slices(items, max_batch_size)
+        num_batches = (len(all_batches) - 1) // dist.get_world_size() * dist.get_world_size() + dist.get_world_size()
+        all_batches += [[]] * (num_batches - len(all_batches))
+        rank_batches = all_batches[dist.get_rank() :: dist.get_world_size()]
+
+    # Loop over batches.
+    dist.print0(f'Reconstructing {len(slices)} slices from {num_files} files to "{outdir}"...')
+    sampler_kwargs = {key: value for key, value in sampler_kwargs.items() if value is not None}
+    if schedule_file is not None:
+        sampler_kwargs['sigma_steps'] = load_schedule(schedule_file).sigma_steps
+    batches = prefetch_batches(rank_batches, device=device) # read the next batch while sampling
+    sink = OutputSink(outdir, layout=output, rank=dist.get_rank(), preview=not no_preview)
+    nfe, steps, branches, deviations = dict(), dict(), dict(), dict()
+    branching = (sampler_kwargs.get('branch_step', None) is not None or sampler_kwargs.get('branch_sigma', None) is not None)
+
+    # Write the samples, or with ensemble, fold them into the statistics of
+    # their slice and step size and write its summary maps once all seeds
+    # are in: <name>/mean, var and p<q> for each percentile q, plus the
+    # first exemplars samples.
+    assert ensemble or (exemplars == 0 and percentiles is None), '--exemplars and --percentiles require --ensemble'
+    percentiles = percentiles or []
+    assert all(0 <= q <= 100 for q in percentiles), 'Percentiles must be in [0, 100]'
+    stats = dict()
+    def write_samples(batch, images):
+        if not ensemble:
+            for s, image in zip(batch, images):
+                sink.write(f'{s.name}/{s.fname}', image)
+            return
+        groups = dict()
+        for i, s in enumerate(batch):
+            groups.setdefault((s.name, s.suffix), []).append(i)
+            if s.seed in seeds[:exemplars]:
+                sink.write(f'{s.name}/{s.fname}', images[i])
+        for (name, suffix), idx in groups.items():
+            key = (name, suffix)
+            if key not in stats:
+                stats[key] = EnsembleStats(num_sketch=(num_sketch if len(percentiles) > 0 else 0), seed=zlib.crc32(f'{name}{suffix}'.encode()))
+            stats[key].update(images[idx])
+            if stats[key].count == len(seeds):
+                write_summary(name, suffix, stats.pop(key))
+    def write_summary(name, suffix, ensemble_stats):
+        summary = ensemble_stats.summary(percentiles)
+        sink.write(f'{name}/mean{suffix}', summary.mean)
+        sink.write(f'{name}/var{suffix}', summary.var, normalize=True)
+        for q, value in summary.percentiles.items():
+            sink.write(f'{name}/p{q:g}{suffix}', value, normalize=True)
+    if early_stop is None:
+        for batch, tensors in tqdm.tqdm(batches, total=len(rank_batches), unit='batch', disable=(dist.get_rank() != 0)):
+            torch.distributed.barrier()
+            batch_size = len(batch)
+            if batch_size == 0:
+                continue
+
+            # Sample.
+            images, batch_nfe = reconstruct_batch(net, batch, tensors, class_idx=class_idx, espirit=espirit, num_coils=num_coils, coil_energy=coil_energy, rng=rng,
+                verbose=(dist.get_rank() == 0), **sampler_kwargs)
+
+            # Same samples at the float64 reference precision.
+            if validate_precision:
+                reference, _ = reconstruct_batch(net, batch, tensors, class_idx=class_idx, espirit=espirit, num_coils=num_coils, coil_energy=coil_energy, rng=rng,
+                    **dict(sampler_kwargs, precision='float64'))
+                for s, d in zip(batch, max_deviation(images, reference).tolist()):
+                    deviations[f'{s.name}/{s.fname}'] = d
+
+            for s, n in zip(batch, batch_nfe.tolist()):
+                nfe[f'{s.name}/{s.fname}'] = n
+            if branching:
+                for s, j, renoised in zip(batch, *batch_trunks(batch)):
+                    branches[f'{s.name}/{s.fname}'] = dict(trunk=f'{batch[j].name}/{batch[j].fname}', renoised=renoised)
+
+            # Save complex reconstructions and magnitude previews.
+            write_samples(batch, images)
+
+    # Early stopping: samples leave the batch as they converge, and their
+    # slots are refilled with the next slices that share the operator layout.
+    else:
+        assert not sampler_kwargs.get('adaptive', False), '--early_stop does not apply to --adaptive'
+        assert not branching, '--early_stop does not branch'
+        assert not validate_precision, '--validate_precision does not apply to --early_stop'
+        sampler_kwargs = {key: value for key, value in sampler_kwargs.items() if key not in ['adaptive', 'rtol', 'atol', 'compile_step']}
+        monitor = ConvergenceMonitor(early_stop, tol=stop_tol, window=stop_window, min_steps=stop_min_steps)
+        pending = []
+        def refill(n, like):
+            while len(pending) < n:
+                batch, tensors = next(batches, (None, None))
+                if batch is None:
+                    break
+                if len(batch) > 0:
+                    pending.extend(stream_items(net, batch, tensors, class_idx=class_idx, espirit=espirit, num_coils=num_coils, coil_energy=coil_energy, rng=rng,
+                        verbose=(dist.get_rank() == 0)))
+            new = [item for item in pending if like is None or _compatible(like, item)][:n]
+            pending[:] = [item for item in pending if not any(item is other for other in new)]
+            return new
+        num_items = sum(len(batch) for batch in rank_batches)
+        results = stream_dps_sampler(net, refill, max_batch_size=max_batch_size, monitor=monitor, device=device, **sampler_kwargs)
+        for r in tqdm.tqdm(results, total=num_items, unit='slice', disable=(dist.get_rank() != 0)):
+            s = r.item.source
+            nfe[f'{s.name}/{s.fname}'] = r.nfe
+            steps[f'{s.name}/{s.fname}'] = dict(steps=r.steps, nfe=r.nfe, converged=r.converged)
+            image = r.item.op.sens_projection(r.image[None].to(r.item.op.dtype)) * r.item.scale
+            write_samples([s], image)
+
+    assert len(stats) == 0
+    sink.close()
+
+    # Report the network evaluations per sample.
+    if sampler_kwargs.get('adaptive', False) or early_stop is not None:
+        all_nfe = [None] * dist.get_world_size()
+        torch.distributed.all_gather_object(all_nfe, nfe)
+        nfe = {k: v for rank_nfe in all_nfe for k, v in rank_nfe.items()}
+        if dist.get_rank() == 0 and len(nfe) > 0:
+            with open(os.path.join(outdir, 'nfe.json'), 'wt') as f:
+                json.dump(dict(sorted(nfe.items())), f, indent=2)
+            values = np.array(list(nfe.values()))
+            dist.print0(f'Network evaluations per sample: mean {values.mean():.1f}, min {values.min()}, max {values.max()}')
+
+    # Record the branch point and the trunk of every sample.
+    if branching:
+        all_branches = [None] * dist.get_world_size()
+        torch.distributed.all_gather_object(all_branches, branches)
+        branches = {k: v for rank_branches in all_branches for k, v in rank_branches.items()}
+        if dist.get_rank() == 0 and len(branches) > 0:
+            with open(os.path.join(outdir, 'branches.json'), 'wt') as f:
+                json.dump(dict(branch_step=sampler_kwargs.get('branch_step', None), branch_sigma=sampler_kwargs.get('branch_sigma', None),
+                    samples=dict(sorted(branches.items()))), f, indent=2)
+
+    # Report the deviation of every sample from the float64 reference.
+    if validate_precision:
+        all_deviations = [None] * dist.get_world_size()
+        torch.distributed.all_gather_object(all_deviations, deviations)
+        deviations = {k: v for rank_deviations in all_deviations for k, v in rank_deviations.items()}
+        if dist.get_rank() == 0 and len(deviations) > 0:
+            with open(os.path.join(outdir, 'precision.json'), 'wt') as f:
+                json.dump(dict(precision=sampler_kwargs['precision'], max_deviation=dict(sorted(deviations.items()))), f, indent=2)
+            dist.print0(f'Max deviation from float64 ({sampler_kwargs["precision"]}): {max(deviations.values()):.3g} relative to the peak magnitude')
+
+    # Report the steps per sample of early stopping.
+    if early_stop is not None:
+        all_steps = [None] * dist.get_world_size()
+        torch.distributed.all_gather_object(all_steps, steps)
+        steps = {k: v for rank_steps in all_steps for k, v in rank_steps.items()}
+        if dist.get_rank() == 0 and len(steps) > 0:
+            with open(os.path.join(outdir, 'steps.json'), 'wt') as f:
+                json.dump(dict(sorted(steps.items())), f, indent=2)
+            dist.print0(f'Converged early: {sum(v["converged"] for v in steps.values())} of {len(steps)} samples')
+
+    # Done.
+    torch.distributed.barrier()
+    dist.print0('Done.')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
@@ -0,0 +1,339 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Long-lived posterior sampling server. Keeps networks resident and
+coalesces compatible reconstruction jobs into batches."""
+
+import io
+import json
+import time
+import uuid
+import pickle
+import threading
+import http.server
+import urllib.request
+import concurrent.futures
+import click
+import numpy as np
+import torch
+import dnnlib
+from posterior.data import group_slices, stack_slices, _compatible
+from posterior.sampler import stream_dps_sampler, ConvergenceMonitor
+from posterior.store import open_slices
+from reconstruct import reconstruct_batch, stream_items, parse_float_list
+
+#----------------------------------------------------------------------------
+# Job specification, as submitted over HTTP (JSON) or in-process (dict).
+# data is a .pt file, a directory or manifest of them, or a k-space store;
+# sampler holds dps_sampler() keyword arguments, or adaptive=True, or
+# early_stop (see reconstruct.py) for samples that leave the batch as they
+# converge, with their slots refilled from the queue. Jobs with the same
+# network, class, calibration and sampler settings are batched together;
+# seeds and step sizes may differ per job.
+
+default_job = dict(
+    network         = None,     # Network pickle (required).
+    data            = None,     # k-space data (required).
+    class_idx       = None,     # Class label, random if None.
+    seeds           = [0],      # Posterior samples per slice.
+    likelihood_step_size = 1,   # Step size, or list of step sizes to sweep.
+    espirit         = False,    # Estimate the maps with ESPIRiT.
+    num_coils       = None,     # Virtual coils of the coil compression.
+    coil_energy     = None,     # Retained energy of the coil compression.
+    rng             = 'stacked', # Per-seed random streams, stacked or philox.
+    sampler         = dict(),   # Keyword arguments of dps_sampler(), or adaptive/early_stop settings.
+)
+
+#----------------------------------------------------------------------------
+# Server core: resident networks, a queue of per-slice work items and a
+# worker thread that runs one batch at a time. Usable in-process without
+# the HTTP front end.
+
+class ReconstructionServer:
+    def __init__(self, device=torch.device('cuda'), max_batch_size=8, batch_timeout=0.05, verbose=True):
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.verbose = verbose
+        self.networks = dict()      # network_pkl => network
+        self.jobs = dict()          # job id => EasyDict
+        self.pending = []           # work items not yet sampled
+        self._cond = threading.Condition()
+        self._net_lock = threading.Lock()
+        self._stopping = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def load_network(self, network_pkl):
+        with self._net_lock:
+            if network_pkl not in self.networks:
+                if self.verbose:
+                    print(f'Loading network from "{network_pkl}"...')
+                with dnnlib.util.open_url(network_pkl, verbose=self.verbose) as f:
+                    self.networks[network_pkl] = pickle.load(f)['ema'].to(self.device)
+            return self.networks[network_pkl]
+
+    def submit(self, spec):
+        spec = dnnlib.EasyDict(default_job, **spec)
+        assert spec.network is not None and spec.data is not None
+        net = self.load_network(spec.network)
+        slices, _ = open_slices(spec.data, num_coeffs=net.img_channels // 2)
+        key = json.dumps([spec.network, spec.class_idx, spec.espirit, spec.num_coils, spec.coil_energy, spec.rng, spec.sampler], sort_keys=True)
+        job = dnnlib.EasyDict(id=uuid.uuid4().hex, status='queued', error=None, results=dict(), nfe=dict(), steps=dict(), future=concurrent.futures.Future())
+
+        # One work item per slice, seed and step size.
+        items = []
+        step_sizes = parse_float_list(spec.likelihood_step_size)
+        for s in slices:
+            assert 2 * (s.basis.shape[1] if s.basis is not None else 1) == net.img_channels, f'{s.name}: network channels do not match the data'
+            for step_size in step_sizes:
+                suffix = f'_step{step_size:g}' if len(step_sizes) > 1 else ''
+                items += [dnnlib.EasyDict(s, seed=seed, step_size=step_size, fname=f'{seed:06d}{suffix}', job=job, spec=spec, key=key) for seed in spec.seeds]
+        job.num_items = len(items)
+        with self._cond:
+            self.jobs[job.id] = job
+            self.pending += items
+            self._cond.notify_all()
+        return job.id
+
+    def status(self, job_id):
+        job = self.jobs[job_id]
+        return dict(id=job.id, status=job.status, error=job.error, done=len(job.results), total=job.num_items, nfe=dict(job.nfe), steps=dict(job.steps))
+
+    # Dict of '<slice name>/<seed>[_step<size>]' => image, once the job is done.
+    def result(self, job_id, timeout=None):
+        return self.jobs[job_id].future.result(timeout=timeout)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._worker.join()
+
+    # Oldest pending item plus compatible ones, waiting up to batch_timeout
+    # for concurrent submissions to fill the batch.
+    def _next_batch(self):
+        with self._cond:
+            while len(self.pending) == 0 and not self._stopping:
+                self._cond.wait()
+            deadline = time.time() + self.batch_timeout
+            while not self._stopping and sum(item.key == self.pending[0].key for item in self.pending) < self.max_batch_size and time.time() < deadline:
+                self._cond.wait(timeout=max(deadline - time.time(), 0))
+            if self._stopping:
+                return None
+            batch = group_slices([item for item in self.pending if item.key == self.pending[0].key], self.max_batch_size)[0]
+            in_batch = set(id(item) for item in batch)
+            self.pending = [item for item in self.pending if id(item) not in in_batch]
+            return batch
+
+    # Pending items with the given key that fit a batch with like (any, if
+    # None), without waiting.
+    def _take(self, key, n, like=None):
+        with self._cond:
+            candidates = [item for item in self.pending if item.key == key and (like is None or _compatible(like, item))]
+            if len(candidates) == 0 or n == 0:
+                return []
+            taken = group_slices(candidates, n)[0]
+            in_batch = set(id(item) for item in taken)
+            self.pending = [item for item in self.pending if id(item) not in in_batch]
+            return taken
+
+    # Add the results of a batch or of single samples, and finish the jobs
+    # that are complete.
+    def _finish(self, items, images, nfe, steps=None):
+        for i, item in enumerate(items):
+            name = f'{item.name}/{item.fname}'
+            item.job.results[name] = images[i]
+            item.job.nfe[name] = nfe[i]
+            if steps is not None:
+                item.job.steps[name] = steps[i]
+        for job in {item.job.id: item.job for item in items}.values():
+            if len(job.results) == job.num_items:
+                job.status = 'done'
+                job.future.set_result(job.results)
+
+    # Early stopping: stream the first batch, then the compatible items
+    # queued with the same key as slots free up.
+    def _stream(self, batch, jobs):
+        spec = batch[0].spec
+        net = self.networks[spec.network]
+        sampler_kwargs = dict(spec.sampler)
+        monitor = ConvergenceMonitor(sampler_kwargs.pop('early_stop'), tol=sampler_kwargs.pop('stop_tol', 1e-3),
+            window=sampler_kwargs.pop('stop_window', 5), min_steps=sampler_kwargs.pop('stop_min_steps', None))
+        first = [batch]
+        def refill(n, like):
+            taken = first.pop() if len(first) > 0 else self._take(batch[0].key, n, like.source if like is not None else None)
+            if len(taken) == 0:
+                return []
+            for item in taken:
+                item.job.status = 'running'
+                jobs[item.job.id] = item.job
+            return stream_items(net, taken, stack_slices(taken, device=self.device), class_idx=spec.class_idx, espirit=spec.espirit,
+                num_coils=spec.num_coils, coil_energy=spec.coil_energy, rng=spec.rng)
+        for r in stream_dps_sampler(net, refill, max_batch_size=self.max_batch_size, monitor=monitor, device=self.device, **sampler_kwargs):
+            image = r.item.op.sens_projection(r.image[None].to(r.item.op.dtype))[0] * r.item.scale
+            self._finish([r.item.source], [image.cpu().numpy()], [r.nfe], [dict(steps=r.steps, nfe=r.nfe, converged=r.converged)])
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            jobs = {item.job.id: item.job for item in batch}
+            for job in jobs.values():
+                job.status = 'running'
+            spec = batch[0].spec
+            try:
+                if spec.sampler.get('early_stop', None) is not None:
+                    self._stream(batch, jobs)
+                    continue
+                net = self.networks[spec.network]
+                tensors = stack_slices(batch, device=self.device)
+                images, nfe = reconstruct_batch(net, batch, tensors, class_idx=spec.class_idx, espirit=spec.espirit,
+                    num_coils=spec.num_coils, coil_energy=spec.coil_energy, rng=spec.rng, **spec.sampler)
+                self._finish(batch, images.cpu().numpy(), nfe.tolist())
+            except Exception as e:
+                with self._cond:
+                    self.pending = [item for item in self.pending if item.job.id not in jobs]
+                for job in jobs.values():
+                    if job.future.done():
+                        continue
+                    job.status = 'failed'
+                    job.error = repr(e)
+                    job.future.set_exception(e)
+
+#----------------------------------------------------------------------------
+# HTTP front end (JSON in, .npz out):
+#
+#   POST /networks           {"network": ...}  preload a network.
+#   GET  /networks           list the resident networks.
+#   POST /jobs               job spec => {"id": ...}
+#   GET  /jobs/<id>          status, with the network evaluations per sample.
+#   GET  /jobs/<id>/result   wait for the job, return the images as .npz.
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    def _send(self, code, body, content_type='application/json'):
+        body = json.dumps(body).encode('utf-8') if content_type == 'application/json' else body
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        recon = self.server.recon
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/networks':
+                recon.load_network(spec['network'])
+                return self._send(200, dict(networks=list(recon.networks)))
+            if self.path == '/jobs':
+                return self._send(200, dict(id=recon.submit(spec)))
+            return self._send(404, dict(error=f'Unknown path {self.path}'))
+        except Exception as e:
+            return self._send(400, dict(error=repr(e)))
+
+    def do_GET(self):
+        recon = self.server.recon
+        parts = self.path.strip('/').split('/')
+        if parts == ['networks']:
+            return self._send(200, dict(networks=list(recon.networks)))
+        if len(parts) < 2 or parts[0] != 'jobs' or parts[1] not in recon.jobs:
+            return self._send(404, dict(error=f'Unknown path {self.path}'))
+        if len(parts) == 2:
+            return self._send(200, recon.status(parts[1]))
+        try:
+            results = recon.result(parts[1])
+        except Exception as e:
+            return self._send(500, dict(error=repr(e)))
+        buf = io.BytesIO()
+        np.savez(buf, **results)
+        return self._send(200, buf.getvalue(), content_type='application/octet-stream')
+
+    def log_message(self, format, *args):
+        if self.server.recon.verbose:
+            super().log_message(format, *args)
+
+def start_http_server(recon, host='127.0.0.1', port=8765):
+    httpd = http.server.ThreadingHTTPServer((host, port), _RequestHandler)
+    httpd.daemon_threads = True
+    httpd.recon = recon
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+#----------------------------------------------------------------------------
+# Client for the HTTP front end.
+
+class ReconstructionClient:
+    def __init__(self, url='http://127.0.0.1:8765'):
+        self.url = url.rstrip('/')
+
+    def _request(self, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+
+    def load_network(self, network):
+        return json.loads(self._request('/networks', dict(network=network)))
+
+    def submit(self, **spec):
+        return json.loads(self._request('/jobs', spec))['id']
+
+    def status(self, job_id):
+        return json.loads(self._request(f'/jobs/{job_id}'))
+
+    def result(self, job_id):
+        with np.load(io.BytesIO(self._request(f'/jobs/{job_id}/result'))) as data:
+            return {name: data[name] for name in data.files}
+
+    def reconstruct(self, **spec):
+        return self.result(self.submit(**spec))
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--host',                    help='Address to listen on', metavar='ADDR',                             type=str, default='127.0.0.1', show_default=True)
+@click.option('--port',                    help='Port to listen on', metavar='INT',                                 type=click.IntRange(min=1), default=8765, show_default=True)
+@click.option('--network', 'networks',     help='Network pickle to preload (repeatable)', metavar='PATH|URL',       type=str, multiple=True)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=8, show_default=True)
+@click.option('--batch_timeout',           help='Seconds to wait for jobs to coalesce', metavar='FLOAT',            type=click.FloatRange(min=0), default=0.05, show_default=True)
+
+def main(host, port, networks, max_batch_size, batch_timeout, device=torch.device('cuda')):
+    """Serve posterior sampling jobs over HTTP, keeping networks loaded.
+
+    Examples:
+
+    \b
+    # Start the server with a preloaded network
+    python serve.py --network=network-snapshot.pkl --batch=16
+
+    \b
+    # Submit a job from Python and wait for the images
+    from serve import ReconstructionClient
+    images = ReconstructionClient().reconstruct(network='network-snapshot.pkl',
+        data='ksp_coils_undersampled_coeff2.pt', likelihood_step_size=15,
+        sampler=dict(num_steps=300, sigma_max=5, discretization='vp', schedule='vp', scaling='vp'))
+    """
+    recon = ReconstructionServer(device=device, max_batch_size=max_batch_size, batch_timeout=batch_timeout)
+    for network_pkl in networks:
+        recon.load_network(network_pkl)
+    httpd = start_http_server(recon, host=host, port=port)
+    print(f'Listening on http://{host}:{port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        httpd.shutdown()
+        recon.stop()
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------
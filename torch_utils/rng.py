@@ -0,0 +1,98 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Counter-based random number generation with one stream per seed,
+vectorized over a whole batch of seeds."""
+
+import functools
+import numpy as np
+import torch
+
+#----------------------------------------------------------------------------
+# Philox4x32-10 (Salmon et al., "Parallel Random Numbers: As Easy as 1, 2,
+# 3", SC 2011) on int64 tensors holding uint32 values. Maps counters [..., 4]
+# and keys [..., 2] to 4 random words each. The 32x32-bit products are
+# split into 16-bit halves so that they fit int64.
+
+_philox_m = (0xD2511F53, 0xCD9E8D57)
+_philox_w = (0x9E3779B9, 0xBB67AE85)
+_mask32 = 0xFFFFFFFF
+
+def _mulhilo32(a, m):
+    lo = (a & 0xFFFF) * m
+    hi = (a >> 16) * m
+    mid = lo + ((hi & 0xFFFF) << 16)
+    return (hi >> 16) + (mid >> 32), mid & _mask32
+
+def philox4x32(counter, key, rounds=10):
+    c0, c1, c2, c3 = counter.unbind(-1)
+    k0, k1 = key.unbind(-1)
+    for _ in range(rounds):
+        hi0, lo0 = _mulhilo32(c0, _philox_m[0])
+        hi1, lo1 = _mulhilo32(c2, _philox_m[1])
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0, k1 = (k0 + _philox_w[0]) & _mask32, (k1 + _philox_w[1]) & _mask32
+    return torch.stack([c0, c1, c2, c3], dim=-1)
+
+@functools.lru_cache(maxsize=None)
+def _compiled_philox4x32():
+    return torch.compile(philox4x32, dynamic=True)
+
+#----------------------------------------------------------------------------
+# Drop-in replacement of StackedRandomGenerator (see generate.py) without a
+# loop over the seeds. Every value is a function of (seed, call index,
+# element index) only: the seed is the Philox key, and the counter holds the
+# element index and the number of earlier calls for that seed. The streams
+# are thus reproducible per seed regardless of the batch they are drawn in,
+# or of the number of GPUs, and one call draws the whole batch at once. The
+# streams differ from those of StackedRandomGenerator. Normals come from
+# Box-Muller on 32-bit uniforms. In eager mode, the rounds run as separate
+# elementwise kernels; compile fuses them with torch.compile.
+
+class PhiloxRandomGenerator:
+    def __init__(self, device, seeds, compile=False):
+        super().__init__()
+        self.philox = _compiled_philox4x32() if compile else philox4x32
+        seeds = torch.as_tensor(np.asarray(seeds, dtype=np.int64), device=device)
+        self.key = torch.stack([seeds & _mask32, (seeds >> 32) & _mask32], dim=-1) # [N, 2]
+        self.calls = 0
+
+    # Random words [N, num_words] of the next call.
+    def _words(self, num_words):
+        call = self.calls
+        self.calls += 1
+        num_blocks = (num_words + 3) // 4
+        block = torch.arange(num_blocks, dtype=torch.int64, device=self.key.device)
+        counter = torch.stack([block & _mask32, block >> 32, torch.full_like(block, call & _mask32), torch.full_like(block, call >> 32)], dim=-1)
+        words = self.philox(counter[None], self.key[:, None]) # [N, blocks, 4]
+        return words.flatten(1)[:, :num_words]
+
+    # Uniforms in (0, 1), float64.
+    def _uniform(self, num_values):
+        return (self._words(num_values).to(torch.float64) + 0.5) * (1 / 2**32)
+
+    def randn(self, size, dtype=None, layout=torch.strided, device=None, **kwargs):
+        assert size[0] == self.key.shape[0]
+        assert layout == torch.strided
+        num_values = int(np.prod(size[1:]))
+        u = self._uniform(2 * ((num_values + 1) // 2)).reshape(size[0], -1, 2)
+        radius = (-2 * u[..., 0].log()).sqrt()
+        theta = (2 * np.pi) * u[..., 1]
+        z = torch.stack([radius * theta.cos(), radius * theta.sin()], dim=-1).flatten(1)[:, :num_values]
+        return z.reshape(size).to(dtype=(dtype if dtype is not None else torch.get_default_dtype()), device=device)
+
+    def randn_like(self, input):
+        return self.randn(input.shape, dtype=input.dtype, layout=input.layout, device=input.device)
+
+    def randint(self, *args, size, dtype=torch.int64, device=None, **kwargs):
+        assert size[0] == self.key.shape[0]
+        low, high = (0, args[0]) if len(args) == 1 else args
+        num_values = int(np.prod(size[1:]))
+        values = low + (self._uniform(num_values) * (high - low)).floor().to(torch.int64).clamp(max=high - low - 1)
+        return values.reshape(size).to(dtype=dtype, device=device)
+
+#----------------------------------------------------------------------------
@@ -12,6 +12,7 @@ DEBUG = 0 # replaced the original with the one from Yamin
 
 import numpy as np
 import torch
+import torch.utils.checkpoint
 from torch_utils import persistence
 from torch.nn.functional import silu
 
@@ -163,6 +164,7 @@ class UNetBlock(torch.nn.Module):
         self.dropout = dropout
         self.skip_scale = skip_scale
         self.adaptive_scale = adaptive_scale
+        self.checkpoint = False # Recompute activations in the backward pass instead of storing them.
 
         self.norm0 = GroupNorm(num_channels=in_channels, eps=eps)
         self.conv0 = Conv2d(in_channels=in_channels, out_channels=out_channels, kernel=3, up=up, down=down, resample_filter=resample_filter, resize_resolution=resize_resolution, **init)
@@ -181,6 +183,11 @@ class UNetBlock(torch.nn.Module):
             self.proj = Conv2d(in_channels=out_channels, out_channels=out_channels,resize_resolution=resize_resolution, kernel=1, **init_zero)
 
     def forward(self, x, emb):
+        if self.checkpoint and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(self._forward, x, emb, use_reentrant=False)
+        return self._forward(x, emb)
+
+    def _forward(self, x, emb):
         orig = x
         x = self.conv0(silu(self.norm0(x)))
 
@@ -237,6 +244,44 @@ class FourierEmbedding(torch.nn.Module):
         x = torch.cat([x.cos(), x.sin()], dim=1)
         return x
 
+#----------------------------------------------------------------------------
+# Activation checkpointing shared by SongUNet and DhariwalUNet, used to cut
+# the memory of backpropagating through the denoiser (e.g. DPS posterior
+# sampling). Granularity:
+#   'none':  store all activations (default).
+#   'block': recompute every UNetBlock in the backward pass.
+#   'level': recompute every resolution level as a single segment.
+# Only the given resolutions are checkpointed (None = all).
+
+checkpoint_granularities = ['none', 'block', 'level']
+
+def _resolution_levels(blocks):
+    levels = []
+    for name in blocks.keys():
+        res = int(name.split('x')[0])
+        if levels and levels[-1][0] == res:
+            levels[-1][1].append(name)
+        else:
+            levels.append((res, [name]))
+    return levels
+
+def _set_checkpointing(unet, granularity, resolutions):
+    assert granularity in checkpoint_granularities
+    unet.checkpoint_granularity = granularity
+    unet.checkpoint_resolutions = None if resolutions is None else set(int(res) for res in resolutions)
+    for blocks in [unet.enc, unet.dec]:
+        for name, block in blocks.items():
+            if isinstance(block, UNetBlock):
+                block.checkpoint = (granularity == 'block' and _checkpoint_level(unet, int(name.split('x')[0])))
+
+def _checkpoint_level(unet, res):
+    return unet.checkpoint_resolutions is None or res in unet.checkpoint_resolutions
+
+def _run_level(unet, res, fn, *args):
+    if unet.checkpoint_granularity == 'level' and _checkpoint_level(unet, res) and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
+
 #----------------------------------------------------------------------------
 # Reimplementation of the DDPM++ and NCSN++ architectures from the paper
 # "Score-Based Generative Modeling through Stochastic Differential
@@ -272,6 +317,8 @@ class SongUNet(torch.nn.Module):
 
         super().__init__()
         self.label_dropout = label_dropout
+        self.checkpoint_granularity = 'none'
+        self.checkpoint_resolutions = None
         emb_channels = model_channels * channel_mult_emb
         noise_channels = model_channels * channel_mult_noise
         init = dict(init_mode='xavier_uniform')
@@ -345,26 +392,13 @@ class SongUNet(torch.nn.Module):
                 self.dec[f'{res}x{res}_aux_norm'] = GroupNorm(num_channels=cout, eps=1e-6)
                 self.dec[f'{res}x{res}_aux_conv'] = Conv2d(in_channels=cout, out_channels=out_channels, kernel=3, **init_zero)
 
-    def forward(self, x, noise_labels, class_labels, augment_labels=None):
-        
-        # Mapping.
-        emb = self.map_noise(noise_labels)
-        emb = emb.reshape(emb.shape[0], 2, -1).flip(1).reshape(*emb.shape) # swap sin/cos
-        if self.map_label is not None:
-            tmp = class_labels
-            if self.training and self.label_dropout:
-                tmp = tmp * (torch.rand([x.shape[0], 1], device=x.device) >= self.label_dropout).to(tmp.dtype)
-            emb = emb + self.map_label(tmp * np.sqrt(self.map_label.in_features))
-        if self.map_augment is not None and augment_labels is not None:
-            emb = emb + self.map_augment(augment_labels)
-        emb = silu(self.map_layer0(emb))
-        emb = silu(self.map_layer1(emb))
+    def set_checkpointing(self, granularity='none', resolutions=None):
+        _set_checkpointing(self, granularity, resolutions)
 
-        # Encoder.
+    def _encode_level(self, names, x, aux, emb):
         skips = []
-        aux = x
-
-        for name, block in self.enc.items():
+        for name in names:
+            block = self.enc[name]
             if 'aux_down' in name:
                 aux = block(aux)
             elif 'aux_skip' in name:
@@ -374,11 +408,13 @@ class SongUNet(torch.nn.Module):
             else:
                 x = block(x, emb) if isinstance(block, UNetBlock) else block(x)
                 skips.append(x)
+        return x, aux, skips
 
-        # Decoder.
-        aux = None
+    def _decode_level(self, names, x, aux, emb, skips):
+        skips = list(skips)
         tmp = None
-        for name, block in self.dec.items():
+        for name in names:
+            block = self.dec[name]
             if 'aux_up' in name:
                 aux = block(aux)
             elif 'aux_norm' in name:
@@ -402,6 +438,34 @@ class SongUNet(torch.nn.Module):
                     
                     x = torch.cat([x, skips.pop()], dim=1)
                 x = block(x, emb)
+        return x, aux, skips
+
+    def forward(self, x, noise_labels, class_labels, augment_labels=None):
+        
+        # Mapping.
+        emb = self.map_noise(noise_labels)
+        emb = emb.reshape(emb.shape[0], 2, -1).flip(1).reshape(*emb.shape) # swap sin/cos
+        if self.map_label is not None:
+            tmp = class_labels
+            if self.training and self.label_dropout:
+                tmp = tmp * (torch.rand([x.shape[0], 1], device=x.device) >= self.label_dropout).to(tmp.dtype)
+            emb = emb + self.map_label(tmp * np.sqrt(self.map_label.in_features))
+        if self.map_augment is not None and augment_labels is not None:
+            emb = emb + self.map_augment(augment_labels)
+        emb = silu(self.map_layer0(emb))
+        emb = silu(self.map_layer1(emb))
+
+        # Encoder.
+        skips = []
+        aux = x
+        for res, names in _resolution_levels(self.enc):
+            x, aux, level_skips = _run_level(self, res, self._encode_level, names, x, aux, emb)
+            skips += level_skips
+
+        # Decoder.
+        aux = None
+        for res, names in _resolution_levels(self.dec):
+            x, aux, skips = _run_level(self, res, self._decode_level, names, x, aux, emb, skips)
         if DEBUG: print('FINAL OUTPUT SIZE: {}'.format(aux.shape)) 
         return aux
 
@@ -431,6 +495,8 @@ class DhariwalUNet(torch.nn.Module):
     ):
         super().__init__()
         self.label_dropout = label_dropout
+        self.checkpoint_granularity = 'none'
+        self.checkpoint_resolutions = None
         emb_channels = model_channels * channel_mult_emb
         init = dict(init_mode='kaiming_uniform', init_weight=np.sqrt(1/3), init_bias=np.sqrt(1/3))
         init_zero = dict(init_mode='kaiming_uniform', init_weight=0, init_bias=0)
@@ -478,6 +544,26 @@ class DhariwalUNet(torch.nn.Module):
         self.out_norm = GroupNorm(num_channels=cout)
         self.out_conv = Conv2d(in_channels=cout, out_channels=out_channels, kernel=3, **init_zero)
 
+    def set_checkpointing(self, granularity='none', resolutions=None):
+        _set_checkpointing(self, granularity, resolutions)
+
+    def _encode_level(self, names, x, emb):
+        skips = []
+        for name in names:
+            block = self.enc[name]
+            x = block(x, emb) if isinstance(block, UNetBlock) else block(x)
+            skips.append(x)
+        return x, skips
+
+    def _decode_level(self, names, x, emb, skips):
+        skips = list(skips)
+        for name in names:
+            block = self.dec[name]
+            if x.shape[1] != block.in_channels:
+                x = torch.cat([x, skips.pop()], dim=1)
+            x = block(x, emb)
+        return x, skips
+
     def forward(self, x, noise_labels, class_labels, augment_labels=None):
         # Mapping.
         #NOTE(1) t_emb = embedding(timestep), aug_emb = linear(onehot(aug))
@@ -500,15 +586,13 @@ class DhariwalUNet(torch.nn.Module):
         #NOTE embeddings calculated above are projected by linear and then used to scale and shift to intermediate feature maps
         #   as in Dhariwal and Nichol.
         skips = []
-        for block in self.enc.values():
-            x = block(x, emb) if isinstance(block, UNetBlock) else block(x)
-            skips.append(x)
+        for res, names in _resolution_levels(self.enc):
+            x, level_skips = _run_level(self, res, self._encode_level, names, x, emb)
+            skips += level_skips
 
         # Decoder.
-        for block in self.dec.values():
-            if x.shape[1] != block.in_channels:
-                x = torch.cat([x, skips.pop()], dim=1)
-            x = block(x, emb)
+        for res, names in _resolution_levels(self.dec):
+            x, skips = _run_level(self, res, self._decode_level, names, x, emb, skips)
         x = self.out_conv(silu(self.out_norm(x)))
         return x
 
@@ -0,0 +1,156 @@
+# Copyright (c) 2022, NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# This work is licensed under a Creative Commons
+# Attribution-NonCommercial-ShareAlike 4.0 International License.
+# You should have received a copy of the license along with this
+# work. If not, see http://creativecommons.org/licenses/by-nc-sa/4.0/
+
+"""Successive-halving tuning of the DPS likelihood step size per slice."""
+
+import os
+import json
+import click
+import pickle
+import numpy as np
+import torch
+import dnnlib
+from generate import StackedRandomGenerator, parse_int_list
+from posterior.operators import construct_operator
+from posterior.checkpointing import enable_checkpointing
+from posterior.coils import compress_coils
+from posterior.espirit import estimate_sens_maps
+from posterior.data import stack_slices
+from posterior.store import open_slices, is_store, KspaceStore, store_version
+from posterior.tuner import tune_step_size
+from posterior.schedules import load_schedule
+from posterior.solvers import solver_names
+from reconstruct import parse_float_list
+
+#----------------------------------------------------------------------------
+
+@click.command()
+@click.option('--network', 'network_pkl',  help='Network pickle filename', metavar='PATH|URL',                      type=str, required=True)
+@click.option('--data', 'data_path',       help='k-space store, directory of k-space files, or manifest', metavar='DIR|TXT|JSON', type=str, required=True)
+@click.option('--outdir',                  help='Where to save the results', metavar='DIR',                         type=str, required=True)
+@click.option('--candidates',              help='Candidate likelihood step sizes', metavar='LIST',                  type=parse_float_list, default='0.5,1,2,3,5,7.5,10,15,20', show_default=True)
+@click.option('--eta',                     help='Halving factor per rung', metavar='INT',                           type=click.IntRange(min=2), default=3, show_default=True)
+@click.option('--score',                   help='Candidate score', metavar='auto|residual|nmse',                    type=click.Choice(['auto', 'residual', 'nmse']), default='auto', show_default=True)
+@click.option('--seed',                    help='Random seed of the shared latent', metavar='INT',                  type=int, default=0, show_default=True)
+@click.option('--class', 'class_idx',      help='Class label  [default: random]', metavar='INT',                    type=click.IntRange(min=0), default=None)
+@click.option('--batch', 'max_batch_size', help='Maximum batch size', metavar='INT',                                type=click.IntRange(min=1), default=8, show_default=True)
+@click.option('--checkpoint',              help='Checkpoint denoiser activations', metavar='none|block|level', type=click.Choice(['none', 'block', 'level']), default='none', show_default=True)
+@click.option('--checkpoint_res',          help='Resolutions to checkpoint  [default: all]', metavar='LIST',        type=parse_int_list, default=None)
+@click.option('--espirit',                 help='Estimate the maps with ESPIRiT (cached)',                          is_flag=True)
+@click.option('--coils', 'num_coils',      help='Compress to this many virtual coils', metavar='INT',               type=click.IntRange(min=1), default=None)
+@click.option('--coil_energy',             help='Compress to the coils retaining this energy', metavar='FLOAT',     type=click.FloatRange(min=0, max=1, min_open=True), default=None)
+
+@click.option('--steps', 'num_steps',      help='Number of sampling steps', metavar='INT',                          type=click.IntRange(min=1), default=300, show_default=True)
+@click.option('--schedule_file',           help='Optimized noise levels (replaces --steps)', metavar='JSON',        type=str, default=None)
+@click.option('--sigma_min',               help='Lowest noise level  [default: varies]', metavar='FLOAT',           type=click.FloatRange(min=0, min_open=True), default=0.002)
+@click.option('--sigma_max',               help='Highest noise level  [default: varies]', metavar='FLOAT',          type=click.FloatRange(min=0, min_open=True), default=5)
+@click.option('--rho',                     help='Time step exponent', metavar='FLOAT',                              type=click.FloatRange(min=0, min_open=True), default=7, show_default=True)
+@click.option('--S_churn', 'S_churn',      help='Stochasticity strength', metavar='FLOAT',                          type=click.FloatRange(min=0), default=0, show_default=True)
+@click.option('--S_min', 'S_min',          help='Stoch. min noise level', metavar='FLOAT',                          type=click.FloatRange(min=0), default=0, show_default=True)
+@click.option('--S_max', 'S_max',          help='Stoch. max noise level', metavar='FLOAT',                          type=click.FloatRange(min=0), default='inf', show_default=True)
+@click.option('--S_noise', 'S_noise',      help='Stoch. noise inflation', metavar='FLOAT',                          type=float, default=1, show_default=True)
+
+@click.option('--disc', 'discretization',  help='Ablate time step discretization {t_i}', metavar='vp|ve|iddpm|edm', type=click.Choice(['vp', 've', 'iddpm', 'edm']), default='vp', show_default=True)
+@click.option('--schedule',                help='Ablate noise schedule sigma(t)', metavar='vp|ve|linear',           type=click.Choice(['vp', 've', 'linear']), default='vp', show_default=True)
+@click.option('--scaling',                 help='Ablate signal scaling s(t)', metavar='vp|none',                    type=click.Choice(['vp', 'none']), default='vp', show_default=True)
+@click.option('--solver',                  help='ODE solver', metavar='euler|heun|ddim|dpmpp_2m|dpmpp_3m|unipc', type=click.Choice(solver_names), default='euler', show_default=True)
+@click.option('--likelihood',              help='Data-consistency mode', metavar='dps|closed_form|cg',              type=click.Choice(['dps', 'closed_form', 'cg']), default='dps', show_default=True)
+@click.option('--cg_lambda',               help='CG data-consistency weight of D', metavar='FLOAT',                 type=click.FloatRange(min=0, min_open=True), default=1, show_default=True)
+@click.option('--cg_iters',                help='CG iterations per step', metavar='INT',                            type=click.IntRange(min=1), default=5, show_default=True)
+@click.option('--cg_tol',                  help='CG relative residual tolerance', metavar='FLOAT',                  type=click.FloatRange(min=0), default=1e-6, show_default=True)
+
+def main(network_pkl, data_path, outdir, candidates, eta, score, seed, class_idx, max_batch_size, checkpoint, checkpoint_res, espirit, num_coils, coil_energy, schedule_file, device=torch.device('cuda'), **sampler_kwargs):
+    """Tune the likelihood step size of every slice by successive halving.
+
+    All candidates of a slice run batched from a shared latent. They are
+    scored at geometrically spaced step counts on the data-consistency
+    residual, or on the NMSE against the reference (GT, or alpha with a
+    basis) when the file has one. Only the best 1/eta continue at each
+    rung. Writes results.json with the per-rung scores, the best
+    reconstruction per slice, and tuned.json, a manifest for reconstruct.py
+    with the median best step size per file (or, for a k-space store, a
+    store index with the step size per subject).
+
+    Examples:
+
+    \b
+    # Tune 9 candidate step sizes on every file under data/
+    python tune.py --data=data --outdir=tuned --network=network-snapshot.pkl
+
+    \b
+    # Then reconstruct with the tuned step sizes
+    python reconstruct.py --data=tuned/tuned.json --outdir=out --network=network-snapshot.pkl
+    """
+    # Load network.
+    print(f'Loading network from "{network_pkl}"...')
+    with dnnlib.util.open_url(network_pkl) as f:
+        net = pickle.load(f)['ema'].to(device)
+    if checkpoint != 'none':
+        example = torch.randn([max_batch_size, net.img_channels, net.img_resolution, net.img_resolution], device=device)
+        net = enable_checkpointing(net, checkpoint, checkpoint_res, x=example)
+
+    slices, num_files = open_slices(data_path, num_coeffs=net.img_channels // 2)
+    print(f'Tuning {len(candidates)} step sizes on {len(slices)} slices from {num_files} files...')
+    sampler_kwargs = {key: value for key, value in sampler_kwargs.items() if value is not None}
+    if schedule_file is not None:
+        sampler_kwargs['sigma_steps'] = load_schedule(schedule_file).sigma_steps
+    os.makedirs(outdir, exist_ok=True)
+    results = dict()
+    for s in slices:
+        print(f'{s.name}:')
+        ksp, mask, sens, basis = stack_slices([s], device=device)
+        if espirit:
+            sens = estimate_sens_maps(ksp, verbose=False)
+        if num_coils is not None or coil_energy is not None:
+            ksp, sens, _ = compress_coils(ksp, sens, num_coils=num_coils, energy=coil_energy)
+        op = construct_operator(sens, mask, basis)
+        y = op.compress(ksp)
+        scale = torch.quantile(op.adjoint(y).abs().flatten(), 0.99)
+        y = y / scale
+        gt = s.gt[None].to(device) / scale if s.gt is not None and score != 'residual' else None
+        assert gt is not None or score != 'nmse', f'{s.name}: no reference image for --score=nmse'
+
+        rnd = StackedRandomGenerator(device, [seed])
+        latents = rnd.randn([1, net.img_channels, *op.img_shape], device=device)
+        class_labels = None
+        if net.label_dim:
+            class_labels = torch.eye(net.label_dim, device=device)[rnd.randint(net.label_dim, size=[1], device=device)]
+        if class_idx is not None:
+            class_labels[:, :] = 0
+            class_labels[:, class_idx] = 1
+
+        r = tune_step_size(net, latents, op, y, candidates, gt=gt, class_labels=class_labels, seed=seed,
+            max_batch_size=max_batch_size, eta=eta, **sampler_kwargs)
+        image = op.sens_projection(r.images[r.best][None].to(op.dtype))[0] * scale
+        np.save(os.path.join(outdir, f'{s.name}.npy'), image.cpu().numpy())
+        results[s.name] = dict(path=s.path, subject=s.get('subject', None), best=r.best, score='nmse' if gt is not None else 'residual', milestones=r.milestones,
+            scores={str(k): v for k, v in r.scores.items()}, num_evals=r.num_evals, full_evals=r.full_evals)
+
+    # Per-file manifest with the median best step size over its slices, or
+    # for a k-space store, a copy of its index with the tuned step sizes.
+    with open(os.path.join(outdir, 'results.json'), 'wt') as f:
+        json.dump(results, f, indent=2)
+    best = dict()
+    for r in results.values():
+        best.setdefault(r['path'] if r['path'] is not None else r['subject'], []).append(r['best'])
+    best = {key: float(np.median(values)) for key, values in best.items()}
+    if is_store(data_path):
+        store = KspaceStore(data_path)
+        subjects = [dict(s, overrides=dict(s.overrides, likelihood_step_size=best[s.name])) for s in store.subjects]
+        manifest = dict(version=store_version, root=os.path.abspath(store.path), subjects=subjects)
+    else:
+        manifest = [dict(path=os.path.abspath(path), likelihood_step_size=step_size) for path, step_size in best.items()]
+    with open(os.path.join(outdir, 'tuned.json'), 'wt') as f:
+        json.dump(manifest, f, indent=2)
+    print('Done.')
+
+#----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+#----------------------------------------------------------------------------